@@ -1,4 +1,36 @@
+from .aio import AsyncGeminiClient, BackgroundLoop, build_async_gemini_client, shared_background_loop
+from .context_cache import ContextCacheRegistry, shared_context_cache
 from .gemini import GeminiClient, build_gemini_client
+from .http import PooledSession, prewarm_in_background, shared_session
+from .ratelimit import RateLimitedError, RateLimiter, shared_rate_limiter
+from .resilience import CircuitOpenError, DeadlineExceededError, Resilience, ResiliencePolicy, shared_resilience
+from .routing import ModelRouter, RouteDecision, shared_model_router
+from .tokens import TokenBudget, estimate_tokens, shared_token_budget
 
-__all__ = ["GeminiClient", "build_gemini_client"]
-
+__all__ = [
+    "AsyncGeminiClient",
+    "BackgroundLoop",
+    "CircuitOpenError",
+    "ContextCacheRegistry",
+    "DeadlineExceededError",
+    "GeminiClient",
+    "ModelRouter",
+    "PooledSession",
+    "RateLimitedError",
+    "RateLimiter",
+    "Resilience",
+    "ResiliencePolicy",
+    "RouteDecision",
+    "TokenBudget",
+    "build_async_gemini_client",
+    "build_gemini_client",
+    "estimate_tokens",
+    "prewarm_in_background",
+    "shared_background_loop",
+    "shared_context_cache",
+    "shared_model_router",
+    "shared_rate_limiter",
+    "shared_resilience",
+    "shared_session",
+    "shared_token_budget",
+]
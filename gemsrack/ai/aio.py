@@ -0,0 +1,389 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, AsyncIterator, Coroutine, TypeVar
+
+import requests
+
+from ..config import Shared, env_int
+from .gemini import (
+    GeminiClient,
+    _IMAGE_CHUNK_BYTES,
+    _InlineImageDecoder,
+    _SSEDecoder,
+    _cached_content_name,
+    _candidate_text,
+    _generated_text,
+    _image_error,
+    _image_payload,
+    _total_tokens,
+)
+from .resilience import DeadlineExceededError, Resilience
+
+if TYPE_CHECKING:
+    import httpx
+
+T = TypeVar("T")
+
+
+class BackgroundLoop:
+    """
+    専用スレッドで回すイベントループ。
+    同期コード（Flask / Slack Bolt のワーカースレッド）から submit でコルーチンを投げ込むと、
+    何百本の Gemini 呼び出しが同時に待っていても OS スレッドはこの 1 本で済む。
+    """
+
+    def __init__(self, *, name: str = "gemini-aio") -> None:
+        self.name = name
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.submitted = 0
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is not None and self._loop.is_running():
+                return self._loop
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def _run() -> None:
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=_run, name=self.name, daemon=True)
+            self._thread.start()
+            ready.wait()
+            self._loop = loop
+            return loop
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> Future[T]:
+        """コルーチンをループに投げ、完了を待てる concurrent.futures.Future を返す（呼び出し元はブロックしない）"""
+        loop = self._ensure_started()
+        with self._lock:
+            self._pending += 1
+            self.submitted += 1
+        fut = asyncio.run_coroutine_threadsafe(coro, loop)
+        fut.add_done_callback(self._done)
+        return fut
+
+    def _done(self, _: Future) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    def run(self, coro: Coroutine[Any, Any, T], *, timeout: float | None = None) -> T:
+        """
+        submit して結果を待つ（ループのスレッド自身からは呼ばないこと）。
+        待っている間、呼び出し元のスレッドは塞がったまま（空くのは Gemini の応答待ち・再試行・ヘッジ用のスレッドだけ）。
+        呼び出し元も空けたいときは submit の Future に完了時の処理を登録する。
+        """
+        fut = self.submit(coro)
+        try:
+            return fut.result(timeout=timeout)
+        except TimeoutError:
+            fut.cancel()
+            raise
+
+    def stop(self) -> None:
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        if thread is not None:
+            thread.join(timeout=5)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self._loop is not None and self._loop.is_running(),
+                "pending": self._pending,
+                "submitted": self.submitted,
+            }
+
+
+# httpcore の接続プールは「待ちリクエスト × 接続数」を毎回走査するため、1 つのプールに接続を
+# 数百本持たせると CPU がそこで詰まる。小さなプールに分けて順番に使う
+_SHARD_CONNECTIONS = 16
+
+
+class _ShardedSession:
+    def __init__(self, clients: list["httpx.AsyncClient"]) -> None:
+        self.clients = clients
+        self._next = 0
+
+    def pick(self) -> "httpx.AsyncClient":
+        # ループのスレッドからしか呼ばれないのでロック不要
+        c = self.clients[self._next % len(self.clients)]
+        self._next += 1
+        return c
+
+
+_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _ShardedSession]" = weakref.WeakKeyDictionary()
+_sessions_lock = threading.Lock()
+
+
+def async_session() -> "httpx.AsyncClient":
+    """
+    実行中のイベントループ用の共有 HTTP クライアント（keep-alive の接続プール）。
+    httpx.AsyncClient はループをまたいで使えないので、ループごとに作る。
+    - `GEMINI_ASYNC_MAX_CONNECTIONS`: 同時接続数の上限（既定 256。16 本ずつのプールに分ける）
+    """
+    import httpx  # 遅延import（非同期経路を使わない環境では不要）
+
+    loop = asyncio.get_running_loop()
+    with _sessions_lock:
+        session = _sessions.get(loop)
+        if session is None or any(c.is_closed for c in session.clients):
+            max_conn = max(1, env_int("GEMINI_ASYNC_MAX_CONNECTIONS", 256))
+            shards = max(1, -(-max_conn // _SHARD_CONNECTIONS))
+            per_shard = max(1, -(-max_conn // shards))
+            limits = httpx.Limits(max_connections=per_shard, max_keepalive_connections=per_shard, keepalive_expiry=60.0)
+            # 証明書ストアの読み込みは重いので、TLS の設定は全プールで 1 つを共有する
+            verify = httpx.create_ssl_context()
+            session = _sessions[loop] = _ShardedSession(
+                [httpx.AsyncClient(limits=limits, verify=verify, follow_redirects=False) for _ in range(shards)]
+            )
+    return session.pick()
+
+
+@dataclass(frozen=True)
+class AsyncGeminiClient:
+    """
+    GeminiClient と同じ呼び出し口の asyncio 版（httpx.AsyncClient を使う）。
+
+    モデル/thinking/ベース URL などの設定は元の GeminiClient（config）をそのまま使い、
+    再試行・ブレーカー・ヘッジも同じ Resilience を共有する（同期/非同期の呼び出しが同じ健全性を見る）。
+    例外は同期版と同じ種類に揃える（接続エラー → requests.ConnectionError、HTTP エラー → status_code を持つ例外）。
+    """
+
+    config: GeminiClient
+    http: "httpx.AsyncClient | None" = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def from_client(cls, client: GeminiClient) -> "AsyncGeminiClient":
+        return cls(config=client)
+
+    @property
+    def model(self) -> str:
+        return self.config.model
+
+    @property
+    def image_model(self) -> str:
+        return self.config.image_model
+
+    @property
+    def thinking_budget(self) -> int | None:
+        return self.config.thinking_budget
+
+    @property
+    def resilience(self) -> Resilience | None:
+        return self.config.resilience
+
+    def with_overrides(
+        self,
+        *,
+        model: str = "",
+        image_model: str = "",
+        thinking_budget: int | None = None,
+    ) -> "AsyncGeminiClient":
+        cfg = self.config.with_overrides(model=model, image_model=image_model, thinking_budget=thinking_budget)
+        return self if cfg is self.config else replace(self, config=cfg)
+
+    async def _post(
+        self,
+        url: str,
+        *,
+        key: str,
+        timeout: float,
+        json: dict,
+        stream: bool = False,
+        hedge: bool = False,
+        deadline_at: float | None = None,
+    ) -> "httpx.Response":
+        import httpx
+
+        http = self.http or async_session()
+        headers = self.config._headers()
+
+        async def send(t: float) -> httpx.Response:
+            # stream は (接続, 断片間の待ち時間) で指定する（同期版と同じ）
+            to = httpx.Timeout(t, connect=min(10.0, t)) if stream else httpx.Timeout(t)
+            try:
+                req = http.build_request("POST", url, headers=headers, json=json, timeout=to)
+                r = await http.send(req, stream=stream)
+            except httpx.TimeoutException as e:
+                raise requests.Timeout(f"{type(e).__name__}: {e}") from e
+            except httpx.TransportError as e:
+                raise requests.ConnectionError(f"{type(e).__name__}: {e}") from e
+            if stream and r.status_code >= 400:
+                # エラー本文（Retry-After の代わりの RetryInfo など）を読めるようにしておく
+                await r.aread()
+                await r.aclose()
+            return r
+
+        if self.resilience is None:
+            return await send(timeout)
+        return await self.resilience.call_async(key, send, attempt_timeout=timeout, deadline_at=deadline_at, hedge=hedge)
+
+    async def generate_text(
+        self,
+        *,
+        system_instruction: str,
+        user_text: str,
+        response_mime_type: str | None = None,
+        temperature: float | None = None,
+        max_output_tokens: int | None = None,
+        cached_content: str | None = None,
+        usage: dict | None = None,
+    ) -> str:
+        cfg = self.config
+        payload = cfg._text_payload(
+            system_instruction=system_instruction,
+            user_text=user_text,
+            response_mime_type=response_mime_type,
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+            cached_content=cached_content,
+        )
+        url = cfg._url(f"models/{cfg.model}:generateContent")
+        r = await self._post(url, key=cfg.model, json=payload, timeout=60, hedge=True)
+        r.raise_for_status()
+        return _generated_text(r.json(), usage)
+
+    async def stream_text(
+        self,
+        *,
+        system_instruction: str,
+        user_text: str,
+        response_mime_type: str | None = None,
+        temperature: float | None = None,
+        max_output_tokens: int | None = None,
+        cached_content: str | None = None,
+        usage: dict | None = None,
+    ) -> AsyncIterator[str]:
+        cfg = self.config
+        payload = cfg._text_payload(
+            system_instruction=system_instruction,
+            user_text=user_text,
+            response_mime_type=response_mime_type,
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+            cached_content=cached_content,
+        )
+        url = cfg._url(f"models/{cfg.model}:streamGenerateContent?alt=sse")
+        deadline_at = self.resilience.deadline_at() if self.resilience is not None else None
+        r = await self._post(url, key=cfg.model, json=payload, timeout=60, stream=True, deadline_at=deadline_at)
+        try:
+            r.raise_for_status()
+            got_candidate = False
+            dec = _SSEDecoder()
+
+            async def _events() -> AsyncIterator[dict]:
+                async for line in r.aiter_lines():
+                    data = dec.feed(line)
+                    if data is not None:
+                        yield data
+                data = dec.flush()
+                if data is not None:
+                    yield data
+
+            async for data in _events():
+                if deadline_at is not None and time.monotonic() > deadline_at:
+                    raise DeadlineExceededError(f"Gemini stream ({cfg.model}) exceeded its deadline")
+                if data.get("candidates"):
+                    got_candidate = True
+                if usage is not None and data.get("usageMetadata"):
+                    usage.update(data["usageMetadata"])
+                t = _candidate_text(data)
+                if t:
+                    yield t
+            if not got_candidate:
+                raise RuntimeError("Gemini stream ended without candidates")
+        finally:
+            await r.aclose()
+
+    async def count_tokens(self, *, system_instruction: str, user_text: str = "") -> int:
+        cfg = self.config
+        payload = cfg._count_tokens_payload(system_instruction=system_instruction, user_text=user_text)
+        r = await self._post(cfg._url(f"models/{cfg.model}:countTokens"), key=cfg.model, json=payload, timeout=15)
+        r.raise_for_status()
+        return _total_tokens(r.json())
+
+    async def create_cached_content(
+        self,
+        *,
+        system_instruction: str,
+        ttl_seconds: int,
+        display_name: str | None = None,
+    ) -> tuple[str, datetime | None]:
+        cfg = self.config
+        payload = cfg._cached_content_payload(
+            system_instruction=system_instruction, ttl_seconds=ttl_seconds, display_name=display_name
+        )
+        r = await self._post(cfg._url("cachedContents"), key=cfg.model, json=payload, timeout=30)
+        r.raise_for_status()
+        return _cached_content_name(r.json())
+
+    async def delete_cached_content(self, name: str) -> None:
+        http = self.http or async_session()
+        r = await http.delete(self.config._url(name), headers=self.config._headers(), timeout=10)
+        if r.status_code != 404:
+            r.raise_for_status()
+
+    async def generate_image(
+        self, *, prompt: str, aspect_ratio: str = "1:1", stats: dict | None = None
+    ) -> tuple[bytes, str]:
+        import httpx
+
+        cfg = self.config
+        url = cfg._url(f"models/{cfg.image_model}:generateContent")
+        payload = _image_payload(prompt=prompt, aspect_ratio=aspect_ratio)
+        r = await self._post(url, key=cfg.image_model, json=payload, timeout=90, stream=True)
+        try:
+            if r.status_code >= 400:
+                raise httpx.HTTPStatusError(_image_error(r.status_code, r.text), request=r.request, response=r)
+            dec = _InlineImageDecoder()
+            async for chunk in r.aiter_bytes(_IMAGE_CHUNK_BYTES):
+                dec.feed(chunk)
+            return dec.finish(stats)
+        finally:
+            await r.aclose()
+
+
+def build_async_gemini_client(client: GeminiClient | None = None) -> AsyncGeminiClient | None:
+    """build_gemini_client と同じ環境変数で作る（client を渡せばその設定を使う）"""
+    if client is None:
+        from .gemini import build_gemini_client
+
+        client = build_gemini_client()
+    return AsyncGeminiClient.from_client(client) if client is not None else None
+
+
+def async_enabled() -> bool:
+    """`GEMINI_ASYNC`: `on` で AI Gem（テキスト）の Gemini 呼び出しを共有イベントループで行う（`off` 既定）"""
+    return (os.environ.get("GEMINI_ASYNC") or "off").strip().lower() in ("on", "1", "true")
+
+
+_shared: Shared[BackgroundLoop] = Shared()
+
+
+def shared_background_loop() -> BackgroundLoop:
+    """プロセス内で共有するイベントループ（最初に使うときにスレッドを起こす）"""
+    return _shared.get(BackgroundLoop)
+
+
+def run_in_background(coro: Coroutine[Any, Any, T], *, timeout: float | None = None) -> T:
+    """共有ループで実行して結果を待つ（呼び出し元のスレッドは完了まで塞がる。BackgroundLoop.run を参照）"""
+    return shared_background_loop().run(coro, timeout=timeout)
+
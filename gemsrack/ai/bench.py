@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .aio import AsyncGeminiClient, BackgroundLoop
+from .gemini import GeminiClient
+from .http import PooledSession
+
+# fake サーバはシステムプロンプトの長さに比例して待つので、1000 文字にして --latency 秒待たせる
+_SYSTEM_PROMPT = "x" * 1000
+
+
+class _ThreadPeak:
+    """計測中のプロセス内スレッド数の最大値"""
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self) -> "_ThreadPeak":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:  # noqa: ANN002
+        self._stop.set()
+        self._thread.join()
+
+
+def _summary(mode: str, latencies: list[float], errors: int, wall: float, peak_threads: int) -> dict:
+    xs = sorted(latencies)
+
+    def _pct(q: float) -> float | None:
+        return round(xs[min(len(xs) - 1, int(len(xs) * q))] * 1000.0, 1) if xs else None
+
+    n = len(latencies) + errors
+    return {
+        "mode": mode,
+        "requests": n,
+        "errors": errors,
+        "wall_s": round(wall, 2),
+        "rps": round(n / wall, 1) if wall > 0 else None,
+        "p50_ms": _pct(0.5),
+        "p95_ms": _pct(0.95),
+        # 計測用のサンプラー 1 本を除く
+        "peak_threads": peak_threads - 1,
+    }
+
+
+def bench_threads(base_url: str, *, requests: int, concurrency: int, stream: bool, image: bool = False) -> dict:
+    """従来の経路: 1 リクエスト = 1 スレッドが応答を待つ"""
+    client = GeminiClient(api_key="bench", model="bench", base_url=base_url, http=PooledSession(pool_maxsize=concurrency))
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def _one(i: int) -> None:
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            if image:
+                client.generate_image(prompt=f"req {i}")
+            elif stream:
+                "".join(client.stream_text(system_instruction=_SYSTEM_PROMPT, user_text=f"req {i}"))
+            else:
+                client.generate_text(system_instruction=_SYSTEM_PROMPT, user_text=f"req {i}")
+        except Exception:
+            with lock:
+                errors += 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    with _ThreadPeak() as peak:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench") as ex:
+            list(ex.map(_one, range(requests)))
+        wall = time.perf_counter() - started
+    return _summary("threads", latencies, errors, wall, peak.peak)
+
+
+def bench_async(base_url: str, *, requests: int, concurrency: int, stream: bool, image: bool = False) -> dict:
+    """非同期の経路: 全リクエストを 1 本のイベントループで待つ"""
+    client = AsyncGeminiClient.from_client(GeminiClient(api_key="bench", model="bench", base_url=base_url))
+    latencies: list[float] = []
+    errors = 0
+
+    async def _one(i: int, sem: asyncio.Semaphore) -> None:
+        nonlocal errors
+        async with sem:
+            started = time.perf_counter()
+            try:
+                if image:
+                    await client.generate_image(prompt=f"req {i}")
+                elif stream:
+                    async for _ in client.stream_text(system_instruction=_SYSTEM_PROMPT, user_text=f"req {i}"):
+                        pass
+                else:
+                    await client.generate_text(system_instruction=_SYSTEM_PROMPT, user_text=f"req {i}")
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    async def _all() -> None:
+        sem = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(_one(i, sem) for i in range(requests)))
+
+    loop = BackgroundLoop(name="bench-aio")
+    with _ThreadPeak() as peak:
+        started = time.perf_counter()
+        loop.run(_all())
+        wall = time.perf_counter() - started
+    loop.stop()
+    return _summary("async", latencies, errors, wall, peak.peak)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_fake_server(latency: float, *, latency_dist: str, errors: str) -> tuple[subprocess.Popen, str]:
+    # 計測するプロセスのスレッド数に混ざらないよう、fake サーバは別プロセスで動かす
+    port = _free_port()
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gemsrack.ai.fake_server",
+            "--port",
+            str(port),
+            "--latency-per-kchar",
+            str(latency),
+            "--stream-interval",
+            "0.01",
+            "--latency",
+            latency_dist or "0",
+            "--errors",
+            errors,
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    assert proc.stdout is not None
+    proc.stdout.readline()  # "[fake-gemini] listening on ..."
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Gemini client load benchmark (threads vs asyncio) against a local fake server")
+    ap.add_argument("--requests", type=int, default=400)
+    ap.add_argument("--concurrency", type=int, default=200)
+    ap.add_argument("--latency", type=float, default=0.5, help="fake サーバの 1 リクエストあたりの待ち秒数")
+    ap.add_argument("--mode", choices=("both", "threads", "async"), default="both")
+    ap.add_argument("--latency-dist", default="", help="fake サーバの呼び出しごとの待ち秒数の分布（例: lognormal:0.3,0.5）")
+    ap.add_argument("--errors", default="", help="fake サーバが確率で返すエラー（例: 429:0.05,503:0.02）")
+    ap.add_argument("--stream", action="store_true", help="streamGenerateContent で計測する")
+    ap.add_argument("--image", action="store_true", help="画像生成（generate_image）で計測する")
+    ap.add_argument("--base-url", default="", help="既に起動している fake サーバを使う")
+    args = ap.parse_args(argv)
+
+    proc = None
+    base_url = args.base_url
+    if not base_url:
+        proc, base_url = _start_fake_server(args.latency, latency_dist=args.latency_dist, errors=args.errors)
+    try:
+        opts = {"requests": args.requests, "concurrency": args.concurrency, "stream": args.stream, "image": args.image}
+        results = []
+        if args.mode in ("both", "threads"):
+            results.append(bench_threads(base_url, **opts))
+        if args.mode in ("both", "async"):
+            results.append(bench_async(base_url, **opts))
+        usage = PooledSession().get(f"{base_url}/_fake/stats", timeout=5).json()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    cols = ["mode", "requests", "errors", "wall_s", "rps", "p50_ms", "p95_ms", "peak_threads"]
+    print("\t".join(cols))
+    for r in results:
+        print("\t".join(str(r[c]) for c in cols))
+    # fake サーバ側で数えたトークン数と返したエラー（再試行した分も含む）
+    print(json.dumps({"models": usage.get("models"), "errors": usage.get("errors")}, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
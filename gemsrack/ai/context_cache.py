@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from ..config import Shared, env_int
+from .gemini import GeminiClient
+
+
+@dataclass(frozen=True)
+class _Entry:
+    key: str  # model + system_instruction のハッシュ（Gem を更新すると変わる）
+    name: str  # cachedContents/...
+    expires_at: datetime
+
+
+class ContextCacheRegistry:
+    """
+    Gem（owner = "{team_id}/{gem_name}"）ごとの Gemini cachedContents を管理する。
+
+    - 長い system_instruction（min_chars 以上）だけを対象に、初回実行時に遅延作成する
+    - 期限の refresh_margin 秒前までは名前で使い回し、それ以降は作り直す
+    - Gem の定義が変わる（ハッシュが変わる）と作り直し、古いものは裏で削除する
+    - 作成に失敗した内容（最小トークン数未満など）は retry_after 秒は作成を試みない
+    ※ プロセス内のみ（インスタンスごとに 1 つずつ作られる）
+    """
+
+    def __init__(
+        self,
+        *,
+        ttl_seconds: int = 3600,
+        min_chars: int = 4000,
+        refresh_margin: int = 60,
+        retry_after: int = 600,
+    ) -> None:
+        self.ttl_seconds = max(60, int(ttl_seconds))
+        self.min_chars = max(0, int(min_chars))
+        self.refresh_margin = max(0, int(refresh_margin))
+        self.retry_after = max(0, int(retry_after))
+        self._lock = threading.Lock()
+        self._entries: dict[str, _Entry] = {}
+        self._owner_locks: dict[str, threading.Lock] = {}
+        self._failed: dict[str, datetime] = {}
+        self.created = 0
+        self.reused = 0
+        self.failures = 0
+
+    def resolve(self, gemini: GeminiClient, *, owner: str, system_instruction: str) -> tuple[str | None, str]:
+        """
+        使える cachedContents の名前と状態（`hit` / `created` / `skipped` / `failed`）を返す。
+        名前が None のときは通常どおり system_instruction を送る。
+        """
+        if len(system_instruction) < self.min_chars:
+            return None, "skipped"
+        key = hashlib.sha256(f"{gemini.model}\n{system_instruction}".encode("utf-8")).hexdigest()
+
+        with self._lock:
+            lock = self._owner_locks.setdefault(owner, threading.Lock())
+        # 同じ Gem の初回実行が重なっても作成は 1 回だけ（他の Gem は待たせない）
+        with lock:
+            now = datetime.now(timezone.utc)
+            with self._lock:
+                cur = self._entries.get(owner)
+                failed_until = self._failed.get(key)
+            if cur is not None and cur.key == key and cur.expires_at - now > timedelta(seconds=self.refresh_margin):
+                with self._lock:
+                    self.reused += 1
+                return cur.name, "hit"
+            if failed_until is not None and now < failed_until:
+                return None, "failed"
+
+            try:
+                name, expire = gemini.create_cached_content(
+                    system_instruction=system_instruction,
+                    ttl_seconds=self.ttl_seconds,
+                    display_name=f"gemsrack:{owner}",
+                )
+            except Exception as e:
+                print(f"[gemini] context cache create failed ({owner}): {type(e).__name__} {e}")
+                with self._lock:
+                    self.failures += 1
+                    self._failed[key] = now + timedelta(seconds=self.retry_after)
+                return None, "failed"
+
+            entry = _Entry(key=key, name=name, expires_at=expire or now + timedelta(seconds=self.ttl_seconds))
+            with self._lock:
+                self._entries[owner] = entry
+                self.created += 1
+        if cur is not None and cur.name != name:
+            self._delete_in_background(gemini, cur.name)
+        return name, "created"
+
+    def invalidate(self, owner: str, name: str | None = None) -> None:
+        """Gemini 側で消えていた（404 など）場合に呼ぶ。次回の resolve で作り直す"""
+        with self._lock:
+            cur = self._entries.get(owner)
+            if cur is not None and (name is None or cur.name == name):
+                del self._entries[owner]
+
+    def _delete_in_background(self, gemini: GeminiClient, name: str) -> None:
+        def _run() -> None:
+            try:
+                gemini.delete_cached_content(name)
+            except Exception as e:
+                # 消せなくても TTL で消える
+                print(f"[gemini] context cache delete failed ({name}): {type(e).__name__} {e}")
+
+        threading.Thread(target=_run, name="gemini-context-cache-delete", daemon=True).start()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "ttl_seconds": self.ttl_seconds,
+                "min_chars": self.min_chars,
+                "created": self.created,
+                "reused": self.reused,
+                "failures": self.failures,
+            }
+
+
+_shared: Shared[ContextCacheRegistry] = Shared()
+
+
+def shared_context_cache() -> ContextCacheRegistry | None:
+    """
+    プロセス内で共有するレジストリ（無効なら None）。
+    - `GEMINI_CONTEXT_CACHE`: `on`（既定）/ `off`
+    - `GEMINI_CONTEXT_CACHE_TTL_SECONDS`: cachedContents の TTL（既定 3600）
+    - `GEMINI_CONTEXT_CACHE_MIN_CHARS`: これより短い system_instruction はキャッシュしない（既定 4000 ≒ 1000 トークン強）
+    """
+    if (os.environ.get("GEMINI_CONTEXT_CACHE") or "on").strip().lower() in ("off", "0", "false", "none"):
+        return None
+    return _shared.get(
+        lambda: ContextCacheRegistry(
+            ttl_seconds=env_int("GEMINI_CONTEXT_CACHE_TTL_SECONDS", 3600),
+            min_chars=env_int("GEMINI_CONTEXT_CACHE_MIN_CHARS", 4000),
+        )
+    )
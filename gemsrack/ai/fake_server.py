@@ -0,0 +1,528 @@
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import math
+import random
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import urlparse
+
+# cachedContents の最小サイズ（実 API のモデル別最小トークン数の代わり。文字数で判定）
+_FAKE_MIN_CACHE_CHARS = 1000
+
+# 画像 1 枚の出力トークン数（実 API の 1024x1024 と同じ値）
+_IMAGE_TOKENS = 1290
+
+
+def _tokens(text: str) -> int:
+    # 実 API に合わせる必要はないので概算（4 文字 ≒ 1 トークン）
+    return max(1, len(text) // 4)
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    応答の待ち秒数の分布（モデル呼び出しごとに 1 回引く）。
+    - `0.2` / `const:0.2`: 固定
+    - `uniform:0.1,0.5`: 一様分布
+    - `normal:0.3,0.1`: 正規分布（平均, 標準偏差。負の値は 0）
+    - `lognormal:0.3,0.5`: 対数正規分布（中央値, σ。長いテールのある API らしい分布）
+    - `exp:0.3`: 指数分布（平均）
+    - `<分布>+tail:0.05,3`: 5% の確率で 3 秒にする（p99 だけ遅い状況を作る）
+    """
+    spec = (spec or "").strip() or "0"
+    tail: tuple[float, float] | None = None
+    if "+tail:" in spec:
+        spec, _, t = spec.partition("+tail:")
+        p, d = (float(v) for v in t.split(","))
+        tail = (p, d)
+    kind, _, args = spec.partition(":")
+    if not args:
+        kind, args = "const", kind
+    xs = [float(v) for v in args.split(",")]
+    if kind == "const":
+        base: Callable[[random.Random], float] = lambda rng: xs[0]  # noqa: E731
+    elif kind == "uniform":
+        base = lambda rng: rng.uniform(xs[0], xs[1])  # noqa: E731
+    elif kind == "normal":
+        base = lambda rng: rng.gauss(xs[0], xs[1])  # noqa: E731
+    elif kind == "lognormal":
+        base = lambda rng: rng.lognormvariate(math.log(xs[0]), xs[1])  # noqa: E731
+    elif kind == "exp":
+        base = lambda rng: rng.expovariate(1.0 / xs[0]) if xs[0] > 0 else 0.0  # noqa: E731
+    else:
+        raise ValueError(f"unknown latency distribution: {kind}")
+
+    def sample(rng: random.Random) -> float:
+        if tail is not None and rng.random() < tail[0]:
+            return tail[1]
+        return max(0.0, base(rng))
+
+    return sample
+
+
+def parse_errors(spec: str) -> dict[int, float]:
+    """`429:0.05,503:0.02` -> {429: 0.05, 503: 0.02}（モデル呼び出しごとに、その確率でそのステータスを返す）"""
+    out: dict[int, float] = {}
+    for item in (spec or "").split(","):
+        if item.strip():
+            status, _, p = item.partition(":")
+            out[int(status)] = float(p)
+    return out
+
+
+def fake_png(seed: str, size_bytes: int) -> bytes:
+    """約 size_bytes の PNG（seed ごとに違うノイズ画像。圧縮が効かないので実際の写真に近い大きさになる）"""
+    width = 256
+    height = max(1, size_bytes // (width * 3 + 1))
+    rng = random.Random(seed)
+    pixels = rng.randbytes(width * 3 * height)
+    raw = b"".join(b"\x00" + pixels[y * width * 3 : (y + 1) * width * 3] for y in range(height))
+
+    def _chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + _chunk(b"IHDR", ihdr) + _chunk(b"IDAT", zlib.compress(raw, 1)) + _chunk(b"IEND", b"")
+
+
+class FakeGeminiState:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.cached: dict[str, dict] = {}
+        # 直近のリクエストだけ残す（長い負荷試験でも fake サーバ自身のメモリが増え続けないように）。総数は request_count
+        self.requests: deque[dict] = deque(maxlen=256)
+        self.request_count = 0
+        # 次の POST から順に適用する障害（status / retry_after / delay）
+        self.faults: deque[dict] = deque()
+        # モデルごとのトークン数の集計と、返したエラーの数
+        self.usage: dict[str, Counter[str]] = {}
+        self.errors: Counter[int] = Counter()
+
+    def account(self, model: str, usage: dict, *, images: int = 0) -> None:
+        with self.lock:
+            c = self.usage.setdefault(model, Counter())
+            c["requests"] += 1
+            c["prompt_tokens"] += int(usage.get("promptTokenCount") or 0)
+            c["output_tokens"] += int(usage.get("candidatesTokenCount") or 0)
+            c["cached_tokens"] += int(usage.get("cachedContentTokenCount") or 0)
+            if images:
+                c["images"] += images
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.request_count,
+                "models": {m: dict(c) for m, c in self.usage.items()},
+                "errors": {str(k): v for k, v in sorted(self.errors.items())},
+                "cached_contents": len(self.cached),
+            }
+
+    def reset(self) -> None:
+        with self.lock:
+            self.requests.clear()
+            self.request_count = 0
+            self.faults.clear()
+            self.usage.clear()
+            self.errors.clear()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # ヘッダと本文を別々に書くため、Nagle + 遅延 ACK で 40ms 待たされないようにする
+    disable_nagle_algorithm = True
+    server: "FakeGeminiServer"
+
+    def log_message(self, format: str, *args) -> None:  # noqa: A002, ANN002
+        return
+
+    # ---- helpers ----
+
+    def _json(self, status: int, body: dict) -> None:
+        raw = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _error(self, status: int, message: str, *, retry_after: float | None = None) -> None:
+        with self.server.state.lock:
+            self.server.state.errors[status] += 1
+        raw = json.dumps({"error": {"code": status, "message": message}}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _body(self) -> dict:
+        n = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(n) if n else b""
+        return json.loads(raw or b"{}")
+
+    # ---- routes ----
+
+    def do_HEAD(self) -> None:  # noqa: N802
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self) -> None:  # noqa: N802
+        path = urlparse(self.path).path
+        body = self._body()
+        if path.startswith("/_fake/"):
+            return self._control(path, body)
+        state = self.server.state
+        with state.lock:
+            state.requests.append({"path": path, "body": body})
+            state.request_count += 1
+            fault = state.faults.popleft() if state.faults else None
+        if fault is not None:
+            if fault.get("delay"):
+                time.sleep(float(fault["delay"]))
+            if fault.get("status"):
+                return self._error(int(fault["status"]), "injected fault", retry_after=fault.get("retry_after"))
+
+        if path == "/v1beta/cachedContents":
+            return self._create_cached(body)
+        if path.startswith("/v1beta/models/") and ":" in path:
+            model, _, method = path[len("/v1beta/models/") :].partition(":")
+            if method in ("generateContent", "streamGenerateContent"):
+                # 分布から引いた待ち時間と、確率で入れるエラー
+                delay, status = self.server.draw()
+                if delay:
+                    time.sleep(delay)
+                if status:
+                    return self._error(status, "injected fault", retry_after=self.server.retry_after)
+            if method == "generateContent":
+                if "IMAGE" in ((body.get("generationConfig") or {}).get("responseModalities") or []):
+                    return self._image(model, body)
+                return self._generate(model, body)
+            if method == "streamGenerateContent":
+                return self._stream(model, body)
+            if method == "countTokens":
+                return self._count(body)
+        return self._error(404, f"unknown path: {path}")
+
+    def _control(self, path: str, body: dict) -> None:
+        """`/_fake/config`（分布やエラー率を変える）/ `/_fake/reset`（集計を消す）"""
+        if path == "/_fake/config":
+            try:
+                self.server.configure(**body)
+            except (TypeError, ValueError) as e:
+                return self._error(400, str(e))
+            return self._json(200, self.server.config())
+        if path == "/_fake/reset":
+            self.server.state.reset()
+            return self._json(200, {})
+        return self._error(404, f"unknown path: {path}")
+
+    def do_GET(self) -> None:  # noqa: N802
+        path = urlparse(self.path).path
+        if path == "/_fake/stats":
+            return self._json(200, {**self.server.state.stats(), "config": self.server.config()})
+        name = path[len("/v1beta/") :]
+        with self.server.state.lock:
+            c = self.server.state.cached.get(name)
+        if c is None:
+            return self._error(404, f"{name} not found")
+        return self._json(200, c["meta"])
+
+    def do_DELETE(self) -> None:  # noqa: N802
+        path = urlparse(self.path).path
+        name = path[len("/v1beta/") :]
+        with self.server.state.lock:
+            removed = self.server.state.cached.pop(name, None)
+        if removed is None:
+            return self._error(404, f"{name} not found")
+        return self._json(200, {})
+
+    def _create_cached(self, body: dict) -> None:
+        text = "".join(p.get("text") or "" for p in ((body.get("systemInstruction") or {}).get("parts") or []))
+        if len(text) < _FAKE_MIN_CACHE_CHARS:
+            return self._error(400, "Cached content is too small")
+        ttl = int(str(body.get("ttl") or "3600s").rstrip("s"))
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        expire = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+        meta = {
+            "name": name,
+            "model": body.get("model"),
+            "displayName": body.get("displayName"),
+            "expireTime": expire.isoformat().replace("+00:00", "Z"),
+            "usageMetadata": {"totalTokenCount": _tokens(text)},
+        }
+        with self.server.state.lock:
+            self.server.state.cached[name] = {"meta": meta, "system": text, "expire": expire}
+        return self._json(200, meta)
+
+    def _resolve(self, body: dict) -> tuple[str, int, str | None]:
+        """(system_instruction, cached_tokens, error)"""
+        name = body.get("cachedContent")
+        if name:
+            if body.get("system_instruction") or body.get("systemInstruction"):
+                return "", 0, "CachedContent can not be used with system_instruction"
+            with self.server.state.lock:
+                c = self.server.state.cached.get(name)
+            if c is None or c["expire"] <= datetime.now(timezone.utc):
+                return "", 0, f"{name} not found"
+            return c["system"], _tokens(c["system"]), None
+        si = body.get("system_instruction") or body.get("systemInstruction") or {}
+        return "".join(p.get("text") or "" for p in si.get("parts") or []), 0, None
+
+    def _reply_text(self, model: str, body: dict) -> str:
+        user = "".join(
+            p.get("text") or "" for c in body.get("contents") or [] for p in (c.get("parts") or [])
+        )
+        out = f"[fake:{model}] {user[:200]}"
+        cap = (body.get("generationConfig") or {}).get("maxOutputTokens")
+        if cap and _tokens(out) > int(cap):
+            out = out[: int(cap) * 4]
+        return out
+
+    def _usage(self, system: str, cached_tokens: int, body: dict, out: str) -> dict:
+        user = json.dumps(body.get("contents") or [])
+        u = {
+            "promptTokenCount": _tokens(system) + _tokens(user),
+            "candidatesTokenCount": _tokens(out),
+        }
+        if cached_tokens:
+            u["cachedContentTokenCount"] = cached_tokens
+        return u
+
+    def _count(self, body: dict) -> None:
+        req = body.get("generateContentRequest") or body
+        system, _, err = self._resolve(req)
+        if err:
+            return self._error(404 if "not found" in err else 400, err)
+        # countTokens は課金されないので集計しない
+        return self._json(200, {"totalTokens": self._usage(system, 0, req, "")["promptTokenCount"]})
+
+    def _generate(self, model: str, body: dict) -> None:
+        system, cached_tokens, err = self._resolve(body)
+        if err:
+            return self._error(404 if "not found" in err else 400, err)
+        # 送られてきたプロンプトの大きさに比例して遅くする（キャッシュ分は速い）
+        time.sleep(self.server.latency_per_kchar * (len(system) - (cached_tokens * 4)) / 1000.0)
+        out = self._reply_text(model, body)
+        usage = self._usage(system, cached_tokens, body, out)
+        self.server.state.account(model, usage)
+        return self._json(
+            200,
+            {
+                "candidates": [{"content": {"role": "model", "parts": [{"text": out}]}, "finishReason": "STOP"}],
+                "usageMetadata": usage,
+            },
+        )
+
+    def _image(self, model: str, body: dict) -> None:
+        """画像生成（generate_image が読む 2 つの形: candidates の inlineData / generatedImages）"""
+        prompt = "".join(p.get("text") or "" for c in body.get("contents") or [] for p in (c.get("parts") or []))
+        png = fake_png(f"{model}:{prompt}:{time.monotonic_ns()}", self.server.image_bytes)
+        b64 = base64.b64encode(png).decode("ascii")
+        usage = {"promptTokenCount": _tokens(prompt), "candidatesTokenCount": _IMAGE_TOKENS}
+        self.server.state.account(model, usage, images=1)
+        if self.server.image_shape == "generated_images":
+            return self._json(200, {"generatedImages": [{"image": {"mimeType": "image/png", "imageBytes": b64}}]})
+        parts = [{"text": f"[fake:{model}] {prompt[:80]}"}, {"inlineData": {"mimeType": "image/png", "data": b64}}]
+        return self._json(
+            200,
+            {
+                "candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP"}],
+                "usageMetadata": usage,
+            },
+        )
+
+    def _stream(self, model: str, body: dict) -> None:
+        system, cached_tokens, err = self._resolve(body)
+        if err:
+            return self._error(404 if "not found" in err else 400, err)
+        time.sleep(self.server.latency_per_kchar * (len(system) - (cached_tokens * 4)) / 1000.0)
+        out = self._reply_text(model, body)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [out[i : i + 16] for i in range(0, len(out), 16)] or [""]
+        for i, piece in enumerate(pieces):
+            ev: dict = {"candidates": [{"content": {"role": "model", "parts": [{"text": piece}]}}]}
+            if i == len(pieces) - 1:
+                ev["usageMetadata"] = self._usage(system, cached_tokens, body, out)
+                self.server.state.account(model, ev["usageMetadata"])
+            chunk = f"data: {json.dumps(ev)}\r\n\r\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+            time.sleep(self.server.stream_interval)
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    """
+    テスト/ローカル開発用の Gemini API もどき（generateContent / streamGenerateContent / countTokens / cachedContents）。
+    応答は入力のエコー。画像（responseModalities に IMAGE）にはノイズの PNG を返す。
+    GeminiClient(base_url=server.base_url)、またはアプリなら `GEMINI_API_BASE_URL` で向け先を切り替える。
+
+    - latency: モデル呼び出しごとの待ち秒数の分布（parse_latency の書式）。latency_per_kchar の分に足す
+    - errors: ステータスごとの発生確率（parse_errors の書式 / dict）。inject は次の数回に確実に入れる
+    - トークン数の集計とエラー数: stats()（HTTP なら `GET /_fake/stats`）
+    """
+
+    daemon_threads = True
+    # 負荷試験で数百本を同時に張っても接続を拒否しないように
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        *,
+        latency_per_kchar: float = 0.02,
+        stream_interval: float = 0.05,
+        latency: str = "0",
+        errors: str | dict[int, float] = "",
+        retry_after: float | None = None,
+        image_bytes: int = 256 * 1024,
+        image_shape: str = "inline",
+        seed: int | None = None,
+    ) -> None:
+        super().__init__((host, port), _Handler)
+        self.state = FakeGeminiState()
+        self.latency_per_kchar = latency_per_kchar
+        self.stream_interval = stream_interval
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.retry_after: float | None = None
+        self.configure(
+            latency=latency, errors=errors, retry_after=retry_after, image_bytes=image_bytes, image_shape=image_shape
+        )
+
+    def configure(
+        self,
+        *,
+        latency: str | None = None,
+        errors: str | dict | None = None,
+        retry_after: float | None = None,
+        image_bytes: int | None = None,
+        image_shape: str | None = None,
+        stream_interval: float | None = None,
+    ) -> None:
+        """動かしたまま設定を変える（指定した項目だけ）"""
+        with self._rng_lock:
+            if latency is not None:
+                self.latency = str(latency)
+                self._latency = parse_latency(self.latency)
+            if errors is not None:
+                self.errors = (
+                    parse_errors(errors) if isinstance(errors, str) else {int(k): float(v) for k, v in errors.items()}
+                )
+            if retry_after is not None:
+                self.retry_after = float(retry_after)
+            if image_bytes is not None:
+                self.image_bytes = max(1024, int(image_bytes))
+            if image_shape is not None:
+                if image_shape not in ("inline", "generated_images"):
+                    raise ValueError(f"unknown image shape: {image_shape}")
+                self.image_shape = image_shape
+            if stream_interval is not None:
+                self.stream_interval = float(stream_interval)
+
+    def config(self) -> dict:
+        return {
+            "latency": self.latency,
+            "errors": {str(k): v for k, v in self.errors.items()},
+            "retry_after": self.retry_after,
+            "image_bytes": self.image_bytes,
+            "image_shape": self.image_shape,
+            "latency_per_kchar": self.latency_per_kchar,
+            "stream_interval": self.stream_interval,
+        }
+
+    def draw(self) -> tuple[float, int | None]:
+        """モデル呼び出し 1 回分の (待ち秒数, 返すエラーのステータス or None)"""
+        with self._rng_lock:
+            delay = self._latency(self._rng)
+            r = self._rng.random()
+            for status, p in self.errors.items():
+                if r < p:
+                    return delay, status
+                r -= p
+            return delay, None
+
+    def stats(self) -> dict:
+        return self.state.stats()
+
+    def handle_error(self, request, client_address) -> None:  # noqa: ANN001
+        # クライアント側のタイムアウト/ヘッジの負けで切られた接続は想定内
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    def inject(
+        self,
+        status: int | None = None,
+        *,
+        count: int = 1,
+        retry_after: float | None = None,
+        delay: float = 0.0,
+    ) -> None:
+        """次の count 回の POST に障害を入れる（status=None で遅延だけ）"""
+        with self.state.lock:
+            for _ in range(max(1, count)):
+                self.state.faults.append({"status": status, "retry_after": retry_after, "delay": delay})
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeGeminiServer":
+        threading.Thread(target=self.serve_forever, name="fake-gemini", daemon=True).start()
+        return self
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Local fake Gemini API server")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8089)
+    ap.add_argument("--latency-per-kchar", type=float, default=0.02, help="システムプロンプト 1000 文字あたりの待ち秒数")
+    ap.add_argument("--stream-interval", type=float, default=0.05, help="ストリーミングの断片間の待ち秒数")
+    ap.add_argument("--latency", default="0", help="呼び出しごとの待ち秒数の分布（例: lognormal:0.3,0.5+tail:0.02,5）")
+    ap.add_argument("--errors", default="", help="確率で返すエラー（例: 429:0.05,503:0.02）")
+    ap.add_argument("--retry-after", type=float, default=None, help="エラーに付ける Retry-After 秒")
+    ap.add_argument("--image-kb", type=int, default=256, help="生成する画像の大きさ（KB）")
+    ap.add_argument("--image-shape", choices=("inline", "generated_images"), default="inline")
+    ap.add_argument("--seed", type=int, default=None, help="分布の乱数のシード（再現用）")
+    args = ap.parse_args(argv)
+    srv = FakeGeminiServer(
+        args.host,
+        args.port,
+        latency_per_kchar=args.latency_per_kchar,
+        stream_interval=args.stream_interval,
+        latency=args.latency,
+        errors=args.errors,
+        retry_after=args.retry_after,
+        image_bytes=args.image_kb * 1024,
+        image_shape=args.image_shape,
+        seed=args.seed,
+    )
+    print(f"[fake-gemini] listening on {srv.base_url}", flush=True)
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,11 +1,21 @@
 from __future__ import annotations
 
+import binascii
+import io
+import json
 import os
-from dataclasses import dataclass
+import re
+import time
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
+from typing import Iterator
 
 import requests
 import base64
 
+from .http import GEMINI_API_BASE, PooledSession, gemini_base_url, shared_session
+from .resilience import DeadlineExceededError, Resilience, shared_resilience
+
 
 @dataclass(frozen=True)
 class GeminiClient:
@@ -13,22 +23,75 @@ class GeminiClient:
     model: str = "gemini-2.5-flash"
     image_model: str = "gemini-2.5-flash-image"
     thinking_budget: int | None = 0  # 0 で thinking 無効（コスト/レイテンシ優先）
+    # 接続プール（未指定ならプロセス共有のものを使う）
+    http: PooledSession | None = field(default=None, repr=False, compare=False)
+    # API のベース URL（テスト用のローカル fake サーバに向けるときに差し替える）
+    base_url: str = GEMINI_API_BASE
+    # 再試行/ブレーカー/ヘッジ/全体期限（None なら 1 回だけ投げる）
+    resilience: Resilience | None = field(default=None, repr=False, compare=False)
 
-    def generate_text(
+    def with_overrides(
         self,
         *,
-        system_instruction: str,
-        user_text: str,
-        response_mime_type: str | None = None,
-        temperature: float | None = None,
-        max_output_tokens: int | None = None,
-    ) -> str:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:generateContent"
-        headers = {
+        model: str = "",
+        image_model: str = "",
+        thinking_budget: int | None = None,
+    ) -> "GeminiClient":
+        """
+        Gem ごとの設定で上書きしたクライアント（空 / None の項目は元のまま）。
+        接続プールと再試行/ブレーカーの設定は元のクライアントと共有する。
+        """
+        changes: dict[str, object] = {}
+        if model and model != self.model:
+            changes["model"] = model
+        if image_model and image_model != self.image_model:
+            changes["image_model"] = image_model
+        if thinking_budget is not None and thinking_budget != self.thinking_budget:
+            changes["thinking_budget"] = int(thinking_budget)
+        if not changes:
+            return self
+        return replace(self, **changes)
+
+    def _post(
+        self,
+        url: str,
+        *,
+        key: str,
+        timeout: float,
+        stream: bool = False,
+        hedge: bool = False,
+        deadline_at: float | None = None,
+        **kwargs,  # noqa: ANN003
+    ) -> requests.Response:
+        http = self.http or shared_session()
+
+        def send(t: float) -> requests.Response:
+            # stream は (接続, 断片間の待ち時間) で指定する
+            return http.post(url, timeout=(min(10.0, t), t) if stream else t, stream=stream, **kwargs)
+
+        if self.resilience is None:
+            return send(timeout)
+        return self.resilience.call(key, send, attempt_timeout=timeout, deadline_at=deadline_at, hedge=hedge)
+
+    def _url(self, path: str) -> str:
+        return f"{self.base_url.rstrip('/')}/v1beta/{path}"
+
+    def _headers(self) -> dict[str, str]:
+        return {
             "x-goog-api-key": self.api_key,
             "Content-Type": "application/json",
         }
 
+    def _text_payload(
+        self,
+        *,
+        system_instruction: str,
+        user_text: str,
+        response_mime_type: str | None,
+        temperature: float | None,
+        max_output_tokens: int | None,
+        cached_content: str | None = None,
+    ) -> dict[str, object]:
         generation_config: dict[str, object] = {}
         if self.thinking_budget is not None:
             generation_config["thinkingConfig"] = {"thinkingBudget": int(self.thinking_budget)}
@@ -40,109 +103,416 @@ class GeminiClient:
             generation_config["maxOutputTokens"] = int(max_output_tokens)
 
         payload: dict[str, object] = {
-            "system_instruction": {"parts": [{"text": system_instruction}]},
             "contents": [{"role": "user", "parts": [{"text": user_text}]}],
         }
+        if cached_content:
+            # system_instruction は cachedContents 側に入っている（両方は指定できない）
+            payload["cachedContent"] = cached_content
+        else:
+            payload["system_instruction"] = {"parts": [{"text": system_instruction}]}
         if generation_config:
             payload["generationConfig"] = generation_config
+        return payload
+
+    def generate_text(
+        self,
+        *,
+        system_instruction: str,
+        user_text: str,
+        response_mime_type: str | None = None,
+        temperature: float | None = None,
+        max_output_tokens: int | None = None,
+        cached_content: str | None = None,
+        usage: dict | None = None,
+    ) -> str:
+        """
+        cached_content: create_cached_content で作った名前（`cachedContents/...`）。指定時は system_instruction を送らない。
+        usage: 渡すとレスポンスの usageMetadata（promptTokenCount / cachedContentTokenCount など）を書き込む。
+        """
+        url = self._url(f"models/{self.model}:generateContent")
+        payload = self._text_payload(
+            system_instruction=system_instruction,
+            user_text=user_text,
+            response_mime_type=response_mime_type,
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+            cached_content=cached_content,
+        )
 
-        r = requests.post(url, headers=headers, json=payload, timeout=60)
+        # テキスト生成は冪等なのでヘッジ（遅いときの重複リクエスト）の対象にする
+        r = self._post(url, key=self.model, headers=self._headers(), json=payload, timeout=60, hedge=True)
         r.raise_for_status()
-        data = r.json()
+        return _generated_text(r.json(), usage)
 
-        # candidates[0].content.parts[*].text を結合
-        candidates = data.get("candidates") or []
-        if not candidates:
-            raise RuntimeError(f"Gemini response has no candidates: {data}")
-        content = (candidates[0] or {}).get("content") or {}
-        parts = content.get("parts") or []
-        texts: list[str] = []
-        for p in parts:
-            t = (p or {}).get("text")
-            if isinstance(t, str):
-                texts.append(t)
-        return "".join(texts).strip()
+    def stream_text(
+        self,
+        *,
+        system_instruction: str,
+        user_text: str,
+        response_mime_type: str | None = None,
+        temperature: float | None = None,
+        max_output_tokens: int | None = None,
+        cached_content: str | None = None,
+        usage: dict | None = None,
+    ) -> Iterator[str]:
+        """
+        streamGenerateContent（SSE）でテキストを生成し、届いた断片（差分）を順に返す。
+        全文は断片を連結したもの（generate_text と違い strip はしない）。
+        cached_content / usage は generate_text と同じ（usage は最後に届いた値）。
+        """
+        url = self._url(f"models/{self.model}:streamGenerateContent?alt=sse")
+        payload = self._text_payload(
+            system_instruction=system_instruction,
+            user_text=user_text,
+            response_mime_type=response_mime_type,
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+            cached_content=cached_content,
+        )
+
+        # 再試行は応答ヘッダが届くまで。届いた後は全体期限だけ見る
+        deadline_at = self.resilience.deadline_at() if self.resilience is not None else None
+        r = self._post(
+            url, key=self.model, headers=self._headers(), json=payload, timeout=60, stream=True, deadline_at=deadline_at
+        )
+        try:
+            r.raise_for_status()
+            got_candidate = False
+            for data in _iter_sse_json(r):
+                if deadline_at is not None and time.monotonic() > deadline_at:
+                    raise DeadlineExceededError(f"Gemini stream ({self.model}) exceeded its deadline")
+                if data.get("candidates"):
+                    got_candidate = True
+                if usage is not None and data.get("usageMetadata"):
+                    usage.update(data["usageMetadata"])
+                t = _candidate_text(data)
+                if t:
+                    yield t
+            if not got_candidate:
+                raise RuntimeError("Gemini stream ended without candidates")
+        finally:
+            r.close()
+
+    def count_tokens(self, *, system_instruction: str, user_text: str = "") -> int:
+        """countTokens API でリクエストのトークン数を実測する（生成はしない）"""
+        url = self._url(f"models/{self.model}:countTokens")
+        payload = self._count_tokens_payload(system_instruction=system_instruction, user_text=user_text)
+        r = self._post(url, key=self.model, headers=self._headers(), json=payload, timeout=15)
+        r.raise_for_status()
+        return _total_tokens(r.json())
+
+    def _count_tokens_payload(self, *, system_instruction: str, user_text: str) -> dict[str, object]:
+        request: dict[str, object] = {
+            "model": f"models/{self.model}",
+            # contents は空にできないので、入力が無いときは 1 文字だけ入れる
+            "contents": [{"role": "user", "parts": [{"text": user_text or "."}]}],
+        }
+        if system_instruction:
+            request["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+        return {"generateContentRequest": request}
+
+    def create_cached_content(
+        self,
+        *,
+        system_instruction: str,
+        ttl_seconds: int,
+        display_name: str | None = None,
+    ) -> tuple[str, datetime | None]:
+        """
+        system_instruction を Gemini 側にキャッシュ（cachedContents）して (name, expire_time) を返す。
+        モデルごとに最小トークン数があり、短すぎると 400 になる。
+        """
+        payload = self._cached_content_payload(
+            system_instruction=system_instruction, ttl_seconds=ttl_seconds, display_name=display_name
+        )
+        r = self._post(self._url("cachedContents"), key=self.model, headers=self._headers(), json=payload, timeout=30)
+        r.raise_for_status()
+        return _cached_content_name(r.json())
+
+    def _cached_content_payload(
+        self, *, system_instruction: str, ttl_seconds: int, display_name: str | None
+    ) -> dict[str, object]:
+        payload: dict[str, object] = {
+            "model": f"models/{self.model}",
+            "systemInstruction": {"parts": [{"text": system_instruction}]},
+            "ttl": f"{max(1, int(ttl_seconds))}s",
+        }
+        if display_name:
+            payload["displayName"] = display_name[:128]
+        return payload
+
+    def delete_cached_content(self, name: str) -> None:
+        r = (self.http or shared_session()).delete(self._url(name), headers=self._headers(), timeout=10)
+        if r.status_code != 404:
+            r.raise_for_status()
 
     def generate_image(
         self,
         *,
         prompt: str,
         aspect_ratio: str = "1:1",
+        stats: dict | None = None,
     ) -> tuple[bytes, str]:
         """
         Generate an image from a text prompt using Gemini image model.
 
         Returns (image_bytes, mime_type).
+        応答は少しずつ読みながら base64 をデコードする（応答全体の JSON / base64 文字列をメモリに持たない）。
+        stats: 渡すと応答のバイト数（response_bytes）とデコード中に持っていた最大バイト数（peak_bytes）を書き込む。
         """
-        def _call(model_name: str) -> requests.Response:
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent"
-            return requests.post(url, headers=headers, json=payload, timeout=90)
+        url = self._url(f"models/{self.image_model}:generateContent")
+        payload = _image_payload(prompt=prompt, aspect_ratio=aspect_ratio)
+        # 廃止モデル（404）などのフォールバックは呼び出し側（ModelRouter）で行う
+        r = self._post(url, key=self.image_model, headers=self._headers(), json=payload, timeout=90, stream=True)
+        try:
+            if not r.ok:
+                raise requests.HTTPError(_image_error(r.status_code, r.text), response=r)
+            dec = _InlineImageDecoder()
+            for chunk in r.iter_content(chunk_size=_IMAGE_CHUNK_BYTES):
+                dec.feed(chunk)
+            return dec.finish(stats)
+        finally:
+            r.close()
 
-        headers = {
-            "x-goog-api-key": self.api_key,
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "contents": [
-                {
-                    "parts": [
-                        {"text": prompt},
-                    ]
-                }
-            ],
-            "generationConfig": {
-                "responseModalities": ["TEXT", "IMAGE"],
-                "imageConfig": {"aspectRatio": aspect_ratio},
-            },
-        }
-        r = _call(self.image_model)
-        if not r.ok and r.status_code == 404 and self.image_model != "gemini-2.5-flash-image":
-            # 旧モデル名や廃止モデルが設定されている場合、安定版に 1 回だけフォールバックする。
-            r = _call("gemini-2.5-flash-image")
 
-        if not r.ok:
-            detail = (r.text or "").strip().replace("\n", " ")
-            detail = detail[:500]
-            raise RuntimeError(f"Gemini image API error ({r.status_code}): {detail}")
-        data = r.json()
+def _generated_text(data: dict, usage: dict | None) -> str:
+    if usage is not None:
+        usage.update(data.get("usageMetadata") or {})
+    candidates = data.get("candidates") or []
+    if not candidates:
+        raise RuntimeError(f"Gemini response has no candidates: {data}")
+    return _candidate_text(data).strip()
 
+
+def _cached_content_name(data: dict) -> tuple[str, datetime | None]:
+    name = data.get("name")
+    if not name:
+        raise RuntimeError(f"Gemini cachedContents response has no name: {data}")
+    expire = data.get("expireTime")
+    return str(name), _parse_rfc3339(expire) if expire else None
+
+
+def _total_tokens(data: dict) -> int:
+    if "totalTokens" not in data:
+        raise RuntimeError(f"Gemini countTokens response has no totalTokens: {data}")
+    return int(data["totalTokens"])
+
+
+def _image_payload(*, prompt: str, aspect_ratio: str) -> dict[str, object]:
+    return {
+        "contents": [
+            {
+                "parts": [
+                    {"text": prompt},
+                ]
+            }
+        ],
+        "generationConfig": {
+            "responseModalities": ["TEXT", "IMAGE"],
+            "imageConfig": {"aspectRatio": aspect_ratio},
+        },
+    }
+
+
+def _image_error(status: int, text: str) -> str:
+    detail = (text or "").strip().replace("\n", " ")
+    return f"Gemini image API error ({status}): {detail[:500]}"
+
+
+def _parse_image_response(data: dict) -> tuple[bytes, str]:
+    image_b64 = None
+    mime = "image/png"
+
+    try:
+        candidates = data.get("candidates") or []
+        if candidates:
+            parts = ((candidates[0] or {}).get("content") or {}).get("parts") or []
+            for part in parts:
+                inline = (part or {}).get("inlineData") or (part or {}).get("inline_data") or {}
+                b64 = inline.get("data")
+                if b64:
+                    image_b64 = b64
+                    mime = inline.get("mimeType") or inline.get("mime_type") or mime
+                    break
+    except Exception:
         image_b64 = None
-        mime = "image/png"
 
+    # Fallbacks for alternative wire formats seen in samples
+    if not image_b64:
         try:
-            candidates = data.get("candidates") or []
-            if candidates:
-                parts = ((candidates[0] or {}).get("content") or {}).get("parts") or []
-                for part in parts:
-                    inline = (part or {}).get("inlineData") or (part or {}).get("inline_data") or {}
-                    b64 = inline.get("data")
-                    if b64:
-                        image_b64 = b64
-                        mime = inline.get("mimeType") or inline.get("mime_type") or mime
-                        break
+            images = data.get("generatedImages") or []
+            if images:
+                image = (images[0] or {}).get("image") or {}
+                image_b64 = image.get("base64") or image.get("imageBytes")
+                mime = image.get("mimeType") or mime
         except Exception:
             image_b64 = None
 
-        # Fallbacks for alternative wire formats seen in samples
-        if not image_b64:
-            try:
-                images = data.get("generatedImages") or []
-                if images:
-                    image = (images[0] or {}).get("image") or {}
-                    image_b64 = image.get("base64") or image.get("imageBytes")
-                    mime = image.get("mimeType") or mime
-            except Exception:
-                image_b64 = None
+    if not image_b64:
+        raise RuntimeError(f"Gemini image response missing bytes: {data}")
+
+    try:
+        raw = base64.b64decode(image_b64)
+    except Exception as e:
+        raise RuntimeError(f"Failed to decode image bytes: {type(e).__name__}") from e
 
-        if not image_b64:
-            raise RuntimeError(f"Gemini image response missing bytes: {data}")
+    return raw, mime
 
+
+# 画像の応答を読む単位（base64 で 4 の倍数にそろえてデコードする）
+_IMAGE_CHUNK_BYTES = 64 * 1024
+
+
+class _InlineImageDecoder:
+    """
+    generateContent（画像）の応答を断片ごとに受け取り、最初の画像の base64 を逐次デコードする。
+
+    `"data"` / `"base64"` / `"imageBytes"` の値に入ったら、閉じ引用符までを 4 文字単位でデコードして書き出す。
+    それ以外の JSON（mimeType やテキストの part など。小さい）は base64 を空文字にした形で残し、最後に読む。
+    2 枚目以降の画像は読み捨てる。画像が無ければ残した JSON を _parse_image_response に渡して同じエラーにする。
+    """
+
+    _VALUE = re.compile(rb'"(?:data|base64|imageBytes)"\s*:\s*"')
+
+    def __init__(self) -> None:
+        self._json = bytearray()
+        self._scan_from = 0
+        self._out = io.BytesIO()
+        self._carry = b""  # 4 文字に満たない base64 の端数
+        self._in_value = False
+        self._images = 0
+        self.response_bytes = 0
+        self.peak_bytes = 0
+
+    def feed(self, chunk: bytes) -> None:
+        self.response_bytes += len(chunk)
+        while chunk:
+            if self._in_value:
+                end = chunk.find(b'"')
+                seg = chunk if end < 0 else chunk[:end]
+                if self._images == 1:
+                    self._decode(seg)
+                if end < 0:
+                    break
+                self._in_value = False
+                if self._images == 1 and self._carry:
+                    self._decode(b"=" * (-len(self._carry) % 4))
+                chunk = chunk[end:]
+                continue
+            self._json += chunk
+            chunk = b""
+            m = self._VALUE.search(self._json, self._scan_from)
+            if m is None:
+                # キーが断片の境目にまたがっていても次で見つかるよう、末尾は読み直す
+                self._scan_from = max(0, len(self._json) - 32)
+                break
+            chunk = bytes(self._json[m.end() :])
+            del self._json[m.end() :]
+            self._scan_from = len(self._json)
+            self._in_value = True
+            self._images += 1
+        self.peak_bytes = max(self.peak_bytes, len(self._json) + self._out.tell() + len(self._carry) + _IMAGE_CHUNK_BYTES)
+
+    def _decode(self, seg: bytes) -> None:
+        # JSON では "/" が "\/" とエスケープされることがある（base64 にバックスラッシュは出てこない）
+        buf = self._carry + (seg.replace(b"\\", b"") if b"\\" in seg else seg)
+        n = len(buf) - len(buf) % 4
+        self._carry = buf[n:]
+        if n:
+            try:
+                self._out.write(binascii.a2b_base64(buf[:n]))
+            except binascii.Error as e:
+                raise RuntimeError(f"Failed to decode image bytes: {type(e).__name__}") from e
+            self.peak_bytes = max(self.peak_bytes, len(self._json) + self._out.tell() + n)
+
+    def finish(self, stats: dict | None = None) -> tuple[bytes, str]:
+        if stats is not None:
+            stats["response_bytes"] = self.response_bytes
+            stats["peak_bytes"] = self.peak_bytes
         try:
-            raw = base64.b64decode(image_b64)
-        except Exception as e:
-            raise RuntimeError(f"Failed to decode image bytes: {type(e).__name__}") from e
+            data = json.loads(bytes(self._json))
+        except ValueError as e:
+            raise RuntimeError(f"Gemini image response is not valid JSON: {type(e).__name__}") from e
+        if not self._images or self._in_value or not self._out.tell():
+            return _parse_image_response(data)
+        # getvalue は中身をコピーせずに返す（BytesIO の内部バッファをそのまま使う）
+        return self._out.getvalue(), _image_mime(data)
+
+
+def _image_mime(data: dict) -> str:
+    """（base64 を抜いた応答から）最初の画像の mimeType"""
+    for c in (data.get("candidates") or [])[:1]:
+        for part in ((c or {}).get("content") or {}).get("parts") or []:
+            inline = (part or {}).get("inlineData") or (part or {}).get("inline_data")
+            if isinstance(inline, dict) and "data" in inline:
+                return inline.get("mimeType") or inline.get("mime_type") or "image/png"
+    for image in (data.get("generatedImages") or [])[:1]:
+        return ((image or {}).get("image") or {}).get("mimeType") or "image/png"
+    return "image/png"
+
+
+def _parse_rfc3339(v: str) -> datetime | None:
+    # 例: 2026-01-01T00:00:00.123456789Z（Python はマイクロ秒までしか読めないので切り詰める）
+    try:
+        head, _, frac = v.rstrip("Z").partition(".")
+        dt = datetime.fromisoformat(head + (f".{frac[:6]}" if frac else ""))
+        return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+    except ValueError:
+        return None
+
+
+def _candidate_text(data: dict) -> str:
+    # candidates[0].content.parts[*].text を結合
+    candidates = data.get("candidates") or []
+    if not candidates:
+        return ""
+    content = (candidates[0] or {}).get("content") or {}
+    texts: list[str] = []
+    for p in content.get("parts") or []:
+        t = (p or {}).get("text")
+        if isinstance(t, str):
+            texts.append(t)
+    return "".join(texts)
+
+
+class _SSEDecoder:
+    """
+    text/event-stream を 1 行ずつ受け取り、各イベントの data を JSON として返す。
+    data 行が複数に分かれていれば改行で連結し、空行でイベントを区切る。
+    """
+
+    def __init__(self) -> None:
+        self._buf: list[str] = []
+
+    def feed(self, line: str) -> dict | None:
+        if not line:
+            return self.flush()
+        if line.startswith(":"):
+            return None
+        if line.startswith("data:"):
+            v = line[5:]
+            self._buf.append(v[1:] if v.startswith(" ") else v)
+        return None
+
+    def flush(self) -> dict | None:
+        if not self._buf:
+            return None
+        chunk = "\n".join(self._buf)
+        self._buf = []
+        if chunk.strip() and chunk.strip() != "[DONE]":
+            return json.loads(chunk)
+        return None
+
 
-        return raw, mime
+def _iter_sse_json(r: requests.Response) -> Iterator[dict]:
+    dec = _SSEDecoder()
+    for raw in r.iter_lines(decode_unicode=False):
+        data = dec.feed(raw.decode("utf-8") if isinstance(raw, bytes) else raw)
+        if data is not None:
+            yield data
+    data = dec.flush()
+    if data is not None:
+        yield data
 
 
 def build_gemini_client() -> GeminiClient | None:
@@ -164,4 +534,7 @@ def build_gemini_client() -> GeminiClient | None:
         model=model,
         image_model=image_model,
         thinking_budget=thinking_budget,
+        http=shared_session(),
+        base_url=gemini_base_url(),
+        resilience=shared_resilience(),
     )
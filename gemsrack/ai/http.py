@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import os
+import socket
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..config import Shared, env_int
+
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com"
+
+
+def gemini_base_url() -> str:
+    """`GEMINI_API_BASE_URL`: Gemini API の向け先（ローカルの fake サーバなど。既定は本番の API）"""
+    return (os.environ.get("GEMINI_API_BASE_URL") or "").strip().rstrip("/") or GEMINI_API_BASE
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """アイドル中の接続が経路上（Cloud Run の egress/NAT など）で切られないよう TCP keepalive を付ける"""
+
+    def __init__(self, *, keepalive_seconds: int, **kwargs) -> None:  # noqa: ANN003
+        self._keepalive_seconds = keepalive_seconds
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:  # noqa: ANN002, ANN003
+        if self._keepalive_seconds > 0:
+            from urllib3.connection import HTTPConnection
+
+            opts = list(HTTPConnection.default_socket_options)
+            opts.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            for name, value in (
+                ("TCP_KEEPIDLE", self._keepalive_seconds),
+                ("TCP_KEEPINTVL", max(1, self._keepalive_seconds // 3)),
+                ("TCP_KEEPCNT", 3),
+            ):
+                if hasattr(socket, name):
+                    opts.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+            kwargs["socket_options"] = opts
+        super().init_poolmanager(*args, **kwargs)
+
+
+class PooledSession:
+    """
+    Gemini API 用の共有 HTTP セッション（keep-alive の接続プール）。
+
+    requests.post を毎回呼ぶと TCP+TLS の接続を毎回張り直すため、
+    1 プロセスで 1 つのプールを共有して接続を使い回す。
+    Cookie は保存しない（スレッド間で共有しても状態を持たないようにする）。
+    """
+
+    def __init__(self, *, pool_maxsize: int = 16, keepalive_seconds: int = 60) -> None:
+        self.pool_maxsize = max(1, int(pool_maxsize))
+        self._session = requests.Session()
+        self._session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self._adapter = _KeepAliveAdapter(
+            keepalive_seconds=max(0, int(keepalive_seconds)),
+            pool_connections=4,
+            pool_maxsize=self.pool_maxsize,
+        )
+        self._session.mount("https://", self._adapter)
+        self._session.mount("http://", self._adapter)
+        self.prewarmed_connections = 0
+
+    def post(self, url: str, **kwargs) -> requests.Response:  # noqa: ANN003
+        return self._session.post(url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:  # noqa: ANN003
+        return self._session.get(url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:  # noqa: ANN003
+        return self._session.delete(url, **kwargs)
+
+    def prewarm(self, base_url: str = "", *, connections: int = 1, timeout: float = 5.0) -> int:
+        """
+        base_url へ HEAD を投げて接続（TLS ハンドシェイク済み）をプールに用意しておく。
+        同時に投げた数だけ接続が開くので、connections 本を並列に開く。成功した本数を返す。
+        """
+        n = max(0, min(int(connections), self.pool_maxsize))
+        base_url = base_url or gemini_base_url()
+        ok = 0
+        lock = threading.Lock()
+
+        def _one() -> None:
+            nonlocal ok
+            try:
+                r = self._session.head(base_url, timeout=timeout, allow_redirects=False)
+                r.close()
+                with lock:
+                    ok += 1
+            except Exception as e:
+                print(f"[gemini] prewarm failed: {type(e).__name__} {e}")
+
+        threads = [threading.Thread(target=_one, daemon=True) for _ in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=timeout + 1.0)
+        self.prewarmed_connections += ok
+        return ok
+
+    def stats(self) -> dict:
+        """
+        ホストごとの接続数とリクエスト数。
+        reused_requests = requests - connections_opened（新規接続を張らずに済んだ回数）。
+        """
+        hosts = []
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened = int(getattr(pool, "num_connections", 0))
+            reqs = int(getattr(pool, "num_requests", 0))
+            idle = pool.pool.qsize() if getattr(pool, "pool", None) is not None else 0
+            hosts.append(
+                {
+                    "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                    "connections_opened": opened,
+                    "requests": reqs,
+                    "reused_requests": max(0, reqs - opened),
+                    "idle_slots": idle,
+                }
+            )
+        return {
+            "pool_maxsize": self.pool_maxsize,
+            "prewarmed_connections": self.prewarmed_connections,
+            "hosts": hosts,
+        }
+
+
+_shared: Shared[PooledSession] = Shared()
+
+
+def shared_session() -> PooledSession:
+    """
+    プロセス内で共有するセッション。
+    - `GEMINI_HTTP_POOL_SIZE`: ホストごとに保持する接続数（既定 16。gunicorn のスレッド数 + バックグラウンド実行分）
+    - `GEMINI_HTTP_KEEPALIVE_SECONDS`: TCP keepalive の間隔（既定 60。0 で無効）
+    """
+    return _shared.get(
+        lambda: PooledSession(
+            pool_maxsize=env_int("GEMINI_HTTP_POOL_SIZE", 16),
+            keepalive_seconds=env_int("GEMINI_HTTP_KEEPALIVE_SECONDS", 60),
+        )
+    )
+
+
+def prewarm_in_background() -> threading.Thread | None:
+    """
+    起動直後の初回実行がハンドシェイク待ちにならないよう、裏で接続を開いておく。
+    - `GEMINI_HTTP_PREWARM`: 開いておく接続数（既定 1。0 で無効。GEMINI_API_KEY が無い場合も行わない）
+    """
+    n = env_int("GEMINI_HTTP_PREWARM", 1)
+    if n <= 0 or not os.environ.get("GEMINI_API_KEY"):
+        return None
+
+    def _run() -> None:
+        t0 = time.perf_counter()
+        ok = shared_session().prewarm(connections=n)
+        if ok:
+            print(f"[gemini] prewarmed {ok} connection(s) in {(time.perf_counter() - t0) * 1000:.0f}ms")
+
+    t = threading.Thread(target=_run, name="gemini-prewarm", daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,333 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from typing import Callable
+
+from ..config import Shared, env_int
+
+
+class RateLimitedError(RuntimeError):
+    """レート制限の順番待ちが期限内に回ってこなかった"""
+
+    def __init__(self, scope: str, retry_in: float) -> None:
+        super().__init__(f"Gemini rate limit ({scope}) is busy; retry in {retry_in:.0f}s")
+        self.scope = scope
+        self.retry_in = retry_in
+
+
+class TokenBucket:
+    """
+    1 分あたり rate_per_minute だけ連続的に補充されるバケット（容量も 1 分ぶん）。
+    settle で使い過ぎた分を後から引くと残量がマイナスになり、その分だけ次の取得が遅れる。
+    """
+
+    def __init__(self, rate_per_minute: float) -> None:
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60.0
+        self.available = self.capacity
+        self._at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.available = min(self.capacity, self.available + (now - self._at) * self.rate)
+        self._at = now
+
+    def wait_for(self, n: float, now: float) -> float:
+        """n を取れるまでの秒数（0 なら今すぐ取れる）。容量より大きい要求は満杯になれば通す"""
+        self._refill(now)
+        need = min(n, self.capacity)
+        if self.available >= need:
+            return 0.0
+        return (need - self.available) / self.rate
+
+    def take(self, n: float, now: float) -> None:
+        self._refill(now)
+        self.available -= min(n, self.capacity)
+
+    def adjust(self, delta: float, now: float) -> None:
+        self._refill(now)
+        self.available = min(self.capacity, self.available + delta)
+
+    def settle(self, reserved: float, actual: float, now: float) -> None:
+        """take(reserved) した分を actual に合わせる。返すのは実際に引いた分（容量で頭打ち）までで、容量も超えない"""
+        self.adjust(min(reserved, self.capacity) - actual, now)
+
+    def utilization(self, now: float) -> float:
+        self._refill(now)
+        return round(1.0 - max(0.0, self.available) / self.capacity, 4) if self.capacity else 0.0
+
+
+class _Waiter:
+    __slots__ = ("team_id", "tokens", "wake", "queued")
+
+    def __init__(self, team_id: str, tokens: int, wake: Callable[[], None]) -> None:
+        self.team_id = team_id
+        self.tokens = tokens
+        self.wake = wake
+        self.queued = False
+
+
+class RateLimiter:
+    """
+    Gemini 呼び出しのレート制限（リクエスト数 / トークン数 × 全体 / チームごと のトークンバケット）。
+
+    - 上限に達したら即失敗させず、到着順に並べて max_wait 秒まで待たせる（超えたら RateLimitedError）
+    - 全体のバケットは先に並んだ人に優先して回す。自チームの上限で待っている人は他チームを塞がない
+    - トークン数は実行前の見積もり（入力 + 出力上限）で確保し、実行後に settle で実際の使用量に合わせる
+    - 0 の上限は無制限
+    ※ プロセス内のみ（インスタンス数で割った値を設定する）
+    """
+
+    def __init__(
+        self,
+        *,
+        rpm: int = 0,
+        tpm: int = 0,
+        team_rpm: int = 0,
+        team_tpm: int = 0,
+        max_wait: float = 30.0,
+    ) -> None:
+        self.rpm = max(0, int(rpm))
+        self.tpm = max(0, int(tpm))
+        self.team_rpm = max(0, int(team_rpm))
+        self.team_tpm = max(0, int(team_tpm))
+        self.max_wait = max(0.0, float(max_wait))
+        self._lock = threading.Lock()
+        self._global = (
+            TokenBucket(self.rpm) if self.rpm else None,
+            TokenBucket(self.tpm) if self.tpm else None,
+        )
+        self._teams: dict[str, tuple[TokenBucket | None, TokenBucket | None]] = {}
+        self._queue: list[_Waiter] = []
+        self.granted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.waited_seconds = 0.0
+
+    def _team(self, team_id: str) -> tuple[TokenBucket | None, TokenBucket | None]:
+        b = self._teams.get(team_id)
+        if b is None:
+            b = self._teams[team_id] = (
+                TokenBucket(self.team_rpm) if self.team_rpm else None,
+                TokenBucket(self.team_tpm) if self.team_tpm else None,
+            )
+        return b
+
+    @staticmethod
+    def _wait(buckets: tuple[TokenBucket | None, TokenBucket | None], tokens: int, now: float) -> float:
+        req, tok = buckets
+        return max(req.wait_for(1, now) if req else 0.0, tok.wait_for(tokens, now) if tok else 0.0)
+
+    @staticmethod
+    def _take(buckets: tuple[TokenBucket | None, TokenBucket | None], tokens: int, now: float) -> None:
+        req, tok = buckets
+        if req:
+            req.take(1, now)
+        if tok:
+            tok.take(tokens, now)
+
+    def _try_grant(self, w: _Waiter, now: float) -> float:
+        """（ロック内）w が今取れるなら取って 0、取れないなら次に見直すまでの秒数"""
+        team_wait = self._wait(self._team(w.team_id), w.tokens, now)
+        if team_wait > 0:
+            return team_wait
+        # 全体のバケットは、自チームの上限に引っかかっていない先客を優先する
+        for other in self._queue:
+            if other is w:
+                break
+            if self._wait(self._team(other.team_id), other.tokens, now) == 0:
+                return max(0.01, self._wait(self._global, other.tokens, now))
+        global_wait = self._wait(self._global, w.tokens, now)
+        if global_wait > 0:
+            return global_wait
+        self._take(self._global, w.tokens, now)
+        self._take(self._team(w.team_id), w.tokens, now)
+        return 0.0
+
+    def _enter(self, team_id: str, tokens: int, wake: Callable[[], None]) -> _Waiter:
+        w = _Waiter(team_id, max(0, int(tokens)), wake)
+        with self._lock:
+            self._queue.append(w)
+        return w
+
+    def _poll(self, w: _Waiter) -> tuple[float, int]:
+        """(次に見直すまでの秒数。0 なら取得済み, 何番目か)"""
+        with self._lock:
+            wait = self._try_grant(w, time.monotonic())
+            if wait == 0:
+                self._leave(w)
+                self.granted += 1
+                return 0.0, 0
+            if not w.queued:
+                w.queued = True
+                self.queued += 1
+            return wait, self._queue.index(w) + 1
+
+    def _leave(self, w: _Waiter, *, rejected: bool = False) -> None:
+        """（ロック内）列から外し、後ろの人に見直してもらう"""
+        if w in self._queue:
+            self._queue.remove(w)
+        if rejected:
+            self.rejected += 1
+        for other in self._queue:
+            other.wake()
+
+    def _give_up(self, w: _Waiter) -> RateLimitedError:
+        now = time.monotonic()
+        with self._lock:
+            self._leave(w, rejected=True)
+            team_wait = self._wait(self._team(w.team_id), w.tokens, now)
+            global_wait = self._wait(self._global, w.tokens, now)
+        return RateLimitedError("team" if team_wait > 0 else "global", max(team_wait, global_wait))
+
+    def acquire(
+        self,
+        *,
+        team_id: str,
+        tokens: int,
+        on_queued: Callable[[int], None] | None = None,
+        max_wait: float | None = None,
+    ) -> float:
+        """
+        1 リクエスト分（+ tokens）を確保する。待った秒数を返す。
+        待つ間は on_queued(何番目か) を順番が変わるたびに呼ぶ。期限までに取れなければ RateLimitedError。
+        """
+        started = time.monotonic()
+        end = started + (self.max_wait if max_wait is None else max_wait)
+        event = threading.Event()
+        w = self._enter(team_id, tokens, event.set)
+        last_position = 0
+        try:
+            while True:
+                event.clear()
+                wait, position = self._poll(w)
+                if wait == 0:
+                    return self._done(started)
+                if time.monotonic() >= end:
+                    raise self._give_up(w)
+                if on_queued is not None and position != last_position:
+                    last_position = position
+                    _notify(on_queued, position)
+                event.wait(min(wait, max(0.0, end - time.monotonic())))
+        except BaseException:
+            # 期限切れ以外（割り込みなど）でも列に残さない
+            with self._lock:
+                self._leave(w)
+            raise
+
+    async def acquire_async(
+        self,
+        *,
+        team_id: str,
+        tokens: int,
+        on_queued: Callable[[int], None] | None = None,
+        max_wait: float | None = None,
+    ) -> float:
+        """acquire のイベントループ版（待つ間スレッドを占有しない。on_queued は同期関数のまま別スレッドで呼ぶ）"""
+        started = time.monotonic()
+        end = started + (self.max_wait if max_wait is None else max_wait)
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        w = self._enter(team_id, tokens, lambda: loop.call_soon_threadsafe(event.set))
+        last_position = 0
+        try:
+            while True:
+                event.clear()
+                wait, position = self._poll(w)
+                if wait == 0:
+                    return self._done(started)
+                if time.monotonic() >= end:
+                    raise self._give_up(w)
+                if on_queued is not None and position != last_position:
+                    last_position = position
+                    await asyncio.to_thread(_notify, on_queued, position)
+                try:
+                    await asyncio.wait_for(event.wait(), min(wait, max(0.0, end - time.monotonic())))
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                self._leave(w)
+            raise
+
+    def _done(self, started: float) -> float:
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            with self._lock:
+                self.waited_seconds += waited
+        return waited
+
+    def settle(self, *, team_id: str, reserved: int, actual: int) -> None:
+        """確保した見積もり reserved を実際の使用量 actual に合わせる（余りは返し、超過分は後から引く）"""
+        if reserved == actual:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for b in (self._global[1], self._team(team_id)[1]):
+                if b is not None:
+                    b.settle(float(reserved), float(actual), now)
+            for w in self._queue:
+                w.wake()
+
+    def stats(self, *, top_teams: int = 10) -> dict:
+        now = time.monotonic()
+
+        def _bucket(b: TokenBucket | None) -> dict | None:
+            if b is None:
+                return None
+            return {"per_minute": int(b.capacity), "available": round(b.available, 1), "utilization": b.utilization(now)}
+
+        with self._lock:
+            teams = [
+                {"team_id": t, "requests": _bucket(req), "tokens": _bucket(tok)}
+                for t, (req, tok) in self._teams.items()
+            ]
+            teams.sort(
+                key=lambda d: max((d["requests"] or {}).get("utilization", 0), (d["tokens"] or {}).get("utilization", 0)),
+                reverse=True,
+            )
+            return {
+                "max_wait_seconds": self.max_wait,
+                "global": {"requests": _bucket(self._global[0]), "tokens": _bucket(self._global[1])},
+                "teams": teams[: max(0, top_teams)],
+                "waiting": len(self._queue),
+                "granted": self.granted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "waited_seconds": round(self.waited_seconds, 1),
+            }
+
+
+def _notify(on_queued: Callable[[int], None], position: int) -> None:
+    try:
+        on_queued(position)
+    except Exception as e:
+        # 順番待ちの表示に失敗しても待ち続ける
+        print(f"[gemini] rate limit notify failed: {type(e).__name__} {e}")
+
+
+_shared: Shared[RateLimiter | None] = Shared()
+
+
+def shared_rate_limiter() -> RateLimiter | None:
+    """
+    プロセス内で共有するレート制限（すべて 0 なら None = 無制限）。
+    - `GEMINI_RPM` / `GEMINI_TPM`: プロジェクト全体の 1 分あたりのリクエスト数 / トークン数
+    - `GEMINI_TEAM_RPM` / `GEMINI_TEAM_TPM`: ワークスペース（チーム）ごとの上限
+    - `GEMINI_RATE_LIMIT_WAIT_SECONDS`: 順番待ちの上限（既定 30）
+    """
+
+    def _build() -> RateLimiter | None:
+        limiter = RateLimiter(
+            rpm=env_int("GEMINI_RPM", 0),
+            tpm=env_int("GEMINI_TPM", 0),
+            team_rpm=env_int("GEMINI_TEAM_RPM", 0),
+            team_tpm=env_int("GEMINI_TEAM_TPM", 0),
+            max_wait=env_int("GEMINI_RATE_LIMIT_WAIT_SECONDS", 30),
+        )
+        if not (limiter.rpm or limiter.tpm or limiter.team_rpm or limiter.team_tpm):
+            return None
+        return limiter
+
+    return _shared.get(_build)
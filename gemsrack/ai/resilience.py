@@ -0,0 +1,503 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable
+
+import requests
+
+from ..config import Shared, env_int
+
+# 一時的な失敗として再試行するステータス（それ以外の 4xx はリクエスト側の問題なので即返す）
+RETRYABLE_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(RuntimeError):
+    """モデルが連続して失敗しているため、呼び出さずに失敗させた"""
+
+    def __init__(self, key: str, retry_in: float) -> None:
+        super().__init__(f"Gemini ({key}) is temporarily unavailable; retry in {retry_in:.0f}s")
+        self.key = key
+        self.retry_in = retry_in
+
+
+class DeadlineExceededError(TimeoutError):
+    """呼び出し全体の期限（再試行込み）を超えた"""
+
+
+@dataclass(frozen=True)
+class ResiliencePolicy:
+    max_attempts: int = 3
+    base_delay: float = 0.5  # 指数バックオフの初期値（full jitter）
+    max_delay: float = 8.0
+    deadline: float = 90.0  # 1 回の呼び出し全体（再試行・待ち時間込み）の上限
+    breaker_failures: int = 5  # 連続失敗でオープン
+    breaker_cooldown: float = 30.0  # オープン後、試しに 1 回通すまでの秒数
+    hedge: bool = False  # 遅いリクエストに重複リクエストを重ねる（トークン消費が増える）
+    hedge_min_delay: float = 1.0
+    hedge_min_samples: int = 20
+
+
+class CircuitBreaker:
+    """キー（モデル名）ごとの closed → open → half-open"""
+
+    def __init__(self, *, failure_threshold: int = 5, cooldown: float = 30.0) -> None:
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown = max(0.0, float(cooldown))
+        self._lock = threading.Lock()
+        # key -> [連続失敗数, オープンした時刻(monotonic) or None, 試行中か]
+        self._state: dict[str, list] = {}
+
+    def before(self, key: str) -> None:
+        with self._lock:
+            st = self._state.get(key)
+            if st is None or st[1] is None:
+                return
+            waited = time.monotonic() - st[1]
+            if waited < self.cooldown or st[2]:
+                raise CircuitOpenError(key, max(0.0, self.cooldown - waited))
+            # half-open: 1 本だけ通して様子を見る
+            st[2] = True
+
+    def is_open(self, key: str) -> bool:
+        """呼んでも CircuitOpenError になる状態か（状態は変えない）"""
+        with self._lock:
+            st = self._state.get(key)
+            if st is None or st[1] is None:
+                return False
+            return st[2] or time.monotonic() - st[1] < self.cooldown
+
+    def success(self, key: str) -> None:
+        with self._lock:
+            self._state.pop(key, None)
+
+    def release(self, key: str) -> None:
+        """half-open の試行枠を成否を付けずに返す（期限切れ・キャンセルなどモデルの状態が分からないまま終わったとき）"""
+        with self._lock:
+            st = self._state.get(key)
+            if st is not None:
+                st[2] = False
+
+    def failure(self, key: str) -> None:
+        with self._lock:
+            st = self._state.setdefault(key, [0, None, False])
+            st[0] += 1
+            if st[2] or st[0] >= self.failure_threshold:
+                st[1] = time.monotonic()
+                st[2] = False
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                k: {
+                    "state": "closed" if st[1] is None else ("half_open" if st[2] else "open"),
+                    "consecutive_failures": st[0],
+                    "open_for_seconds": round(now - st[1], 1) if st[1] is not None else None,
+                }
+                for k, st in self._state.items()
+            }
+
+
+class LatencyTracker:
+    """キーごとの直近の成功レイテンシ（ヘッジの発火タイミング = p95 に使う）"""
+
+    def __init__(self, *, window: int = 200) -> None:
+        self._lock = threading.Lock()
+        self._window = max(10, int(window))
+        self._samples: dict[str, deque[float]] = {}
+
+    def add(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self._window)).append(seconds)
+
+    def p95(self, key: str, *, min_samples: int = 20) -> float | None:
+        with self._lock:
+            s = self._samples.get(key)
+            if s is None or len(s) < min_samples:
+                return None
+            xs = sorted(s)
+        return xs[min(len(xs) - 1, int(len(xs) * 0.95))]
+
+
+class Resilience:
+    """
+    Gemini 呼び出しの再試行・サーキットブレーカー・ヘッジ・全体期限をまとめたもの。
+    send(timeout) は 1 回分の HTTP リクエストを投げて Response を返す関数。
+    """
+
+    def __init__(
+        self,
+        policy: ResiliencePolicy | None = None,
+        *,
+        breaker: CircuitBreaker | None = None,
+        latencies: LatencyTracker | None = None,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        self.policy = policy or ResiliencePolicy()
+        self.breaker = breaker or CircuitBreaker(
+            failure_threshold=self.policy.breaker_failures, cooldown=self.policy.breaker_cooldown
+        )
+        self.latencies = latencies or LatencyTracker()
+        self._sleep = sleep
+        self._executor: ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def deadline_at(self, deadline: float | None = None) -> float:
+        return time.monotonic() + (deadline if deadline is not None else self.policy.deadline)
+
+    def call(
+        self,
+        key: str,
+        send: Callable[[float], requests.Response],
+        *,
+        attempt_timeout: float,
+        deadline_at: float | None = None,
+        hedge: bool = False,
+    ) -> requests.Response:
+        """
+        成功、または再試行しても仕方のない応答（4xx など）ならその Response を返す。
+        再試行し尽くした/期限切れの場合は最後の Response（呼び出し元で raise_for_status）か例外。
+        """
+        p = self.policy
+        end = deadline_at if deadline_at is not None else self.deadline_at()
+        attempt = 0
+        last_resp: requests.Response | None = None
+        last_exc: Exception | None = None
+        while True:
+            self.breaker.before(key)
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                self.breaker.release(key)
+                break
+            timeout = min(attempt_timeout, remaining)
+            attempt += 1
+            retry_after: float | None = None
+            started = time.monotonic()
+            try:
+                if hedge and p.hedge:
+                    r = self._send_hedged(key, send, timeout)
+                else:
+                    r = send(timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.breaker.failure(key)
+                last_exc, last_resp = e, None
+            except Exception:
+                # 想定外の例外（ストリームの途中切断など）でも half-open の試行枠を残さない（残すと open のまま戻らない）
+                self.breaker.failure(key)
+                raise
+            except BaseException:
+                # キャンセル・割り込みはモデルの障害ではないので、試行枠だけ返す
+                self.breaker.release(key)
+                raise
+            else:
+                if r.status_code not in RETRYABLE_STATUS:
+                    # 4xx はモデル側の障害ではないのでブレーカーは成功扱い
+                    self.breaker.success(key)
+                    if r.ok:
+                        self.latencies.add(key, time.monotonic() - started)
+                    return r
+                self.breaker.failure(key)
+                retry_after = _retry_after_seconds(r)
+                if last_resp is not None:
+                    last_resp.close()
+                last_resp, last_exc = r, None
+
+            if attempt >= max(1, p.max_attempts):
+                break
+            if retry_after is not None:
+                delay = retry_after
+            else:
+                delay = random.uniform(0, min(p.max_delay, p.base_delay * (2 ** (attempt - 1))))
+            if time.monotonic() + delay >= end:
+                # Retry-After が期限を超える → 待っても間に合わないので今の結果で返す
+                break
+            with self._lock:
+                self.retries += 1
+            self._sleep(delay)
+
+        if last_resp is not None:
+            return last_resp
+        if last_exc is not None and time.monotonic() < end:
+            raise last_exc
+        raise DeadlineExceededError(f"Gemini call ({key}) exceeded its deadline") from last_exc
+
+    def _send_hedged(self, key: str, send: Callable[[float], requests.Response], timeout: float) -> requests.Response:
+        p = self.policy
+        p95 = self.latencies.p95(key, min_samples=p.hedge_min_samples)
+        if p95 is None:
+            return send(timeout)
+        delay = max(p.hedge_min_delay, p95)
+        if delay >= timeout:
+            return send(timeout)
+
+        ex = self._pool()
+        primary = ex.submit(send, timeout)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        with self._lock:
+            self.hedges += 1
+        hedged = ex.submit(send, timeout - delay)
+
+        pending: set[Future] = {primary, hedged}
+        fallback: requests.Response | None = None
+        first_exc: BaseException | None = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                exc = f.exception()
+                if exc is not None:
+                    first_exc = first_exc or exc
+                    continue
+                r = f.result()
+                if r.status_code in RETRYABLE_STATUS:
+                    fallback = fallback or r
+                    continue
+                if f is hedged:
+                    with self._lock:
+                        self.hedge_wins += 1
+                # 負けた方は待たずに、終わったら捨てる
+                for other in pending:
+                    other.add_done_callback(_close_future_response)
+                return r
+        if fallback is not None:
+            return fallback
+        assert first_exc is not None
+        raise first_exc
+
+    async def call_async(
+        self,
+        key: str,
+        send: Callable[[float], Awaitable[Any]],
+        *,
+        attempt_timeout: float,
+        deadline_at: float | None = None,
+        hedge: bool = False,
+    ) -> Any:
+        """
+        call のイベントループ版（待ち時間は asyncio.sleep、ヘッジはタスクで重ねる）。
+        send(timeout) は 1 回分のリクエストを投げて Response（status_code / headers / json() を持つもの）を返すコルーチン。
+        接続エラー/タイムアウトは requests.ConnectionError / requests.Timeout で送出すること。
+        ブレーカーとレイテンシ統計は同期版と共有する。
+        """
+        p = self.policy
+        end = deadline_at if deadline_at is not None else self.deadline_at()
+        attempt = 0
+        last_resp: Any = None
+        last_exc: Exception | None = None
+        while True:
+            self.breaker.before(key)
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                self.breaker.release(key)
+                break
+            timeout = min(attempt_timeout, remaining)
+            attempt += 1
+            retry_after: float | None = None
+            started = time.monotonic()
+            try:
+                if hedge and p.hedge:
+                    r = await self._send_hedged_async(key, send, timeout)
+                else:
+                    r = await send(timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.breaker.failure(key)
+                last_exc, last_resp = e, None
+            except Exception:
+                # 想定外の例外（ストリームの途中切断など）でも half-open の試行枠を残さない（残すと open のまま戻らない）
+                self.breaker.failure(key)
+                raise
+            except BaseException:
+                # キャンセル・割り込みはモデルの障害ではないので、試行枠だけ返す
+                self.breaker.release(key)
+                raise
+            else:
+                if r.status_code not in RETRYABLE_STATUS:
+                    self.breaker.success(key)
+                    if 200 <= r.status_code < 400:
+                        self.latencies.add(key, time.monotonic() - started)
+                    return r
+                self.breaker.failure(key)
+                retry_after = _retry_after_seconds(r)
+                if last_resp is not None:
+                    await _aclose(last_resp)
+                last_resp, last_exc = r, None
+
+            if attempt >= max(1, p.max_attempts):
+                break
+            if retry_after is not None:
+                delay = retry_after
+            else:
+                delay = random.uniform(0, min(p.max_delay, p.base_delay * (2 ** (attempt - 1))))
+            if time.monotonic() + delay >= end:
+                break
+            with self._lock:
+                self.retries += 1
+            await asyncio.sleep(delay)
+
+        if last_resp is not None:
+            return last_resp
+        if last_exc is not None and time.monotonic() < end:
+            raise last_exc
+        raise DeadlineExceededError(f"Gemini call ({key}) exceeded its deadline") from last_exc
+
+    async def _send_hedged_async(self, key: str, send: Callable[[float], Awaitable[Any]], timeout: float) -> Any:
+        p = self.policy
+        p95 = self.latencies.p95(key, min_samples=p.hedge_min_samples)
+        if p95 is None:
+            return await send(timeout)
+        delay = max(p.hedge_min_delay, p95)
+        if delay >= timeout:
+            return await send(timeout)
+
+        primary = asyncio.ensure_future(send(timeout))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        with self._lock:
+            self.hedges += 1
+        hedged = asyncio.ensure_future(send(timeout - delay))
+
+        pending: set[asyncio.Future] = {primary, hedged}
+        fallback: Any = None
+        first_exc: BaseException | None = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for f in done:
+                exc = f.exception()
+                if exc is not None:
+                    first_exc = first_exc or exc
+                    continue
+                r = f.result()
+                if r.status_code in RETRYABLE_STATUS:
+                    fallback = fallback or r
+                    continue
+                if f is hedged:
+                    with self._lock:
+                        self.hedge_wins += 1
+                # 負けた方は取り消す（接続は httpx が閉じる）
+                for other in pending:
+                    other.cancel()
+                return r
+        if fallback is not None:
+            return fallback
+        assert first_exc is not None
+        raise first_exc
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="gemini-hedge")
+            return self._executor
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = {"retries": self.retries, "hedges": self.hedges, "hedge_wins": self.hedge_wins}
+        return {
+            **counters,
+            "hedge_enabled": self.policy.hedge,
+            "max_attempts": self.policy.max_attempts,
+            "deadline_seconds": self.policy.deadline,
+            "breakers": self.breaker.snapshot(),
+        }
+
+
+def is_transient_error(e: BaseException) -> bool:
+    """
+    時間をおけば通る見込みのある失敗か（通信エラー・タイムアウト・RETRYABLE_STATUS・Google API の一時的なエラー）。
+    400 などリクエスト側の問題や、コードの例外は False（やり直しても同じ結果になる）。
+    """
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return True
+    # requests.HTTPError / httpx.HTTPStatusError はどちらも response.status_code を持つ
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    try:
+        from google.api_core import exceptions as gexc  # type: ignore
+    except ImportError:
+        return False
+    return isinstance(
+        e,
+        (gexc.ServiceUnavailable, gexc.DeadlineExceeded, gexc.InternalServerError, gexc.TooManyRequests, gexc.Aborted),
+    )
+
+
+def _close_future_response(f: Future) -> None:
+    if f.exception() is None:
+        f.result().close()
+
+
+async def _aclose(r: Any) -> None:
+    close = getattr(r, "aclose", None)
+    if close is not None:
+        await close()
+
+
+def _retry_after_seconds(r: Any) -> float | None:
+    """Retry-After ヘッダ（秒 or HTTP-date）、無ければ Google の RetryInfo（"retryDelay": "30s"）"""
+    v = (r.headers.get("Retry-After") or "").strip()
+    if v:
+        try:
+            return max(0.0, float(v))
+        except ValueError:
+            pass
+        try:
+            dt = parsedate_to_datetime(v)
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            return max(0.0, (dt - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    try:
+        details = ((r.json() or {}).get("error") or {}).get("details") or []
+    except ValueError:
+        return None
+    for d in details:
+        delay = (d or {}).get("retryDelay")
+        if isinstance(delay, str) and delay.endswith("s"):
+            try:
+                return max(0.0, float(delay[:-1]))
+            except ValueError:
+                continue
+    return None
+
+
+_shared: Shared[Resilience] = Shared()
+
+
+def shared_resilience() -> Resilience:
+    """
+    プロセス内で共有する設定（ブレーカーとレイテンシ統計をモデル単位で共有するため）。
+    - `GEMINI_MAX_ATTEMPTS`（既定 3）/ `GEMINI_DEADLINE_SECONDS`（既定 90）
+    - `GEMINI_BREAKER_FAILURES`（既定 5）/ `GEMINI_BREAKER_COOLDOWN_SECONDS`（既定 30）
+    - `GEMINI_HEDGE`（`on` / `off` 既定）: p95 を超えたテキスト生成に重複リクエストを送る
+    """
+
+    def _build() -> Resilience:
+        d = ResiliencePolicy()
+        return Resilience(
+            ResiliencePolicy(
+                max_attempts=max(1, env_int("GEMINI_MAX_ATTEMPTS", d.max_attempts)),
+                deadline=float(max(1, env_int("GEMINI_DEADLINE_SECONDS", int(d.deadline)))),
+                breaker_failures=max(1, env_int("GEMINI_BREAKER_FAILURES", d.breaker_failures)),
+                breaker_cooldown=float(max(0, env_int("GEMINI_BREAKER_COOLDOWN_SECONDS", int(d.breaker_cooldown)))),
+                hedge=(os.environ.get("GEMINI_HEDGE") or "off").strip().lower() in ("on", "1", "true"),
+            )
+        )
+
+    return _shared.get(_build)
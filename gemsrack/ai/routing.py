@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
+
+import requests
+
+from ..config import Shared, env_int
+from .resilience import RETRYABLE_STATUS, CircuitBreaker, CircuitOpenError, DeadlineExceededError, shared_resilience
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    model: str  # 今回使うモデル
+    reason: str  # `primary` / `breaker_open` / `unhealthy` / `slo` / `large_input`
+    primary: str
+    alternate: str | None = None  # model が失敗したときに 1 回だけ試すモデル
+
+
+class _HealthWindow:
+    """直近 window_seconds 秒の (時刻, レイテンシ秒, 成功か)"""
+
+    def __init__(self, window_seconds: float, max_samples: int = 500) -> None:
+        self.window_seconds = window_seconds
+        self.samples: deque[tuple[float, float, bool]] = deque(maxlen=max_samples)
+
+    def add(self, latency: float, ok: bool) -> None:
+        self.samples.append((time.monotonic(), latency, ok))
+
+    def snapshot(self) -> dict:
+        cutoff = time.monotonic() - self.window_seconds
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        n = len(self.samples)
+        oks = sorted(lat for _, lat, ok in self.samples if ok)
+        failures = n - len(oks)
+
+        def _pct(q: float) -> float | None:
+            if not oks:
+                return None
+            return round(oks[min(len(oks) - 1, int(len(oks) * q))] * 1000.0, 1)
+
+        return {
+            "samples": n,
+            "error_rate": round(failures / n, 4) if n else 0.0,
+            "p50_ms": _pct(0.5),
+            "p95_ms": _pct(0.95),
+        }
+
+
+class ModelRouter:
+    """
+    実行ごとに使うモデルを選ぶ（primary か、安くて速い fallback か）。
+
+    - primary のブレーカーが開いている / 直近のエラー率が高い → fallback
+    - Gem に目標応答時間（SLO）があり、primary の p95 が超えている（fallback の方が速い）→ fallback
+    - SLO のある Gem で入力が large_input_tokens 以上 → fallback
+    - 選んだモデルが一時的な障害（404 / 429 / 5xx / 接続エラー）で失敗したら、もう一方で 1 回だけ実行する
+    モデルごとの健全性は直近 window_seconds 秒の実行結果から計算する（プロセス内のみ）。
+    古い結果は窓から外れるので、primary が回復すれば自然に primary へ戻る。
+    """
+
+    def __init__(
+        self,
+        *,
+        fallback_model: str = "gemini-2.5-flash-lite",
+        image_fallback_model: str = "gemini-2.5-flash-image",
+        window_seconds: float = 300.0,
+        min_samples: int = 10,
+        max_error_rate: float = 0.5,
+        large_input_tokens: int = 20000,
+        breaker: CircuitBreaker | None = None,
+    ) -> None:
+        self.fallback_model = fallback_model
+        self.image_fallback_model = image_fallback_model
+        self.window_seconds = max(10.0, float(window_seconds))
+        self.min_samples = max(1, int(min_samples))
+        self.max_error_rate = float(max_error_rate)
+        self.large_input_tokens = max(0, int(large_input_tokens))
+        self.breaker = breaker
+        self._lock = threading.Lock()
+        self._health: dict[str, _HealthWindow] = {}
+        self._decisions: Counter[tuple[str, str]] = Counter()
+        self.error_fallbacks = 0
+
+    def health(self, model: str) -> dict:
+        with self._lock:
+            w = self._health.get(model)
+            return w.snapshot() if w is not None else {"samples": 0, "error_rate": 0.0, "p50_ms": None, "p95_ms": None}
+
+    def choose(
+        self,
+        *,
+        primary: str,
+        fallback: str | None,
+        input_tokens: int = 0,
+        slo_ms: int | None = None,
+    ) -> RouteDecision:
+        reason = "primary"
+        if fallback and fallback != primary:
+            h = self.health(primary)
+            enough = h["samples"] >= self.min_samples
+            if self.breaker is not None and self.breaker.is_open(primary):
+                reason = "breaker_open"
+            elif enough and h["error_rate"] >= self.max_error_rate:
+                reason = "unhealthy"
+            elif slo_ms and enough and h["p95_ms"] is not None and h["p95_ms"] > slo_ms:
+                fb = self.health(fallback)
+                if fb["samples"] < self.min_samples or (fb["p95_ms"] or 0.0) < h["p95_ms"]:
+                    reason = "slo"
+            if reason == "primary" and slo_ms and self.large_input_tokens and input_tokens >= self.large_input_tokens:
+                reason = "large_input"
+
+        if reason == "primary":
+            alternate = fallback if fallback and fallback != primary else None
+            d = RouteDecision(model=primary, reason=reason, primary=primary, alternate=alternate)
+        else:
+            d = RouteDecision(model=fallback or primary, reason=reason, primary=primary, alternate=primary)
+        with self._lock:
+            self._decisions[(d.model, d.reason)] += 1
+        return d
+
+    def call(self, decision: RouteDecision, fn: Callable[[str], T]) -> tuple[T, str]:
+        """fn(model) を実行して (結果, 実際に使ったモデル) を返す。必要なら alternate で 1 回だけやり直す"""
+        try:
+            return self._timed(decision.model, fn), decision.model
+        except Exception as e:
+            alt = decision.alternate
+            if not alt or alt == decision.model or not _should_fall_back(e):
+                raise
+            print(f"[gemini] {decision.model} failed ({type(e).__name__}); falling back to {alt}")
+            with self._lock:
+                self.error_fallbacks += 1
+            return self._timed(alt, fn), alt
+
+    def _timed(self, model: str, fn: Callable[[str], T]) -> T:
+        started = time.monotonic()
+        try:
+            out = fn(model)
+        except Exception as e:
+            # ブレーカーで呼ばなかった / リクエスト側の問題（400 など）はモデルの健全性に数えない
+            if _is_model_failure(e):
+                self._record(model, time.monotonic() - started, ok=False)
+            raise
+        self._record(model, time.monotonic() - started, ok=True)
+        return out
+
+    async def call_async(self, decision: RouteDecision, fn: Callable[[str], Awaitable[T]]) -> tuple[T, str]:
+        """call のイベントループ版（fn(model) はコルーチンを返す）。健全性の記録は同期版と共有する"""
+        try:
+            return await self._timed_async(decision.model, fn), decision.model
+        except Exception as e:
+            alt = decision.alternate
+            if not alt or alt == decision.model or not _should_fall_back(e):
+                raise
+            print(f"[gemini] {decision.model} failed ({type(e).__name__}); falling back to {alt}")
+            with self._lock:
+                self.error_fallbacks += 1
+            return await self._timed_async(alt, fn), alt
+
+    async def _timed_async(self, model: str, fn: Callable[[str], Awaitable[T]]) -> T:
+        started = time.monotonic()
+        try:
+            out = await fn(model)
+        except Exception as e:
+            if _is_model_failure(e):
+                self._record(model, time.monotonic() - started, ok=False)
+            raise
+        self._record(model, time.monotonic() - started, ok=True)
+        return out
+
+    def _record(self, model: str, latency: float, *, ok: bool) -> None:
+        with self._lock:
+            w = self._health.get(model)
+            if w is None:
+                w = self._health[model] = _HealthWindow(self.window_seconds)
+            w.add(latency, ok)
+
+    def stats(self) -> dict:
+        with self._lock:
+            decisions = [
+                {"model": m, "reason": r, "count": c} for (m, r), c in sorted(self._decisions.items())
+            ]
+            models = list(self._health.keys())
+            error_fallbacks = self.error_fallbacks
+        return {
+            "fallback_model": self.fallback_model,
+            "image_fallback_model": self.image_fallback_model,
+            "window_seconds": self.window_seconds,
+            "decisions": decisions,
+            "error_fallbacks": error_fallbacks,
+            "models": {m: self.health(m) for m in models},
+        }
+
+
+def _status(e: BaseException) -> int | None:
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+
+def _is_model_failure(e: BaseException) -> bool:
+    if isinstance(e, CircuitOpenError):
+        return False
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, DeadlineExceededError)):
+        return True
+    status = _status(e)
+    return status is not None and (status in RETRYABLE_STATUS or status == 404)
+
+
+def _should_fall_back(e: BaseException) -> bool:
+    # 期限切れは待ち時間を使い切っているので、別モデルでやり直さない
+    if isinstance(e, DeadlineExceededError):
+        return False
+    if isinstance(e, (CircuitOpenError, requests.ConnectionError, requests.Timeout)):
+        return True
+    status = _status(e)
+    return status is not None and (status in RETRYABLE_STATUS or status == 404)
+
+
+_shared: Shared[ModelRouter] = Shared()
+
+
+def shared_model_router() -> ModelRouter:
+    """
+    プロセス内で共有するルーター。
+    - `GEMINI_FALLBACK_MODEL`: テキスト生成の fallback（既定 `gemini-2.5-flash-lite`。`none` で無効）
+    - `GEMINI_IMAGE_FALLBACK_MODEL`: 画像生成の fallback（既定 `gemini-2.5-flash-image`。`none` で無効）
+    - `GEMINI_ROUTE_WINDOW_SECONDS`（既定 300）/ `GEMINI_ROUTE_MIN_SAMPLES`（既定 10）
+    - `GEMINI_ROUTE_MAX_ERROR_PERCENT`（既定 50）: これ以上のエラー率で fallback に切り替える
+    - `GEMINI_ROUTE_LARGE_INPUT_TOKENS`（既定 20000。0 で無効）: SLO のある Gem でこれ以上の入力は fallback
+    """
+    return _shared.get(
+        lambda: ModelRouter(
+            fallback_model=_env_model("GEMINI_FALLBACK_MODEL", "gemini-2.5-flash-lite"),
+            image_fallback_model=_env_model("GEMINI_IMAGE_FALLBACK_MODEL", "gemini-2.5-flash-image"),
+            window_seconds=env_int("GEMINI_ROUTE_WINDOW_SECONDS", 300),
+            min_samples=env_int("GEMINI_ROUTE_MIN_SAMPLES", 10),
+            max_error_rate=env_int("GEMINI_ROUTE_MAX_ERROR_PERCENT", 50) / 100.0,
+            large_input_tokens=env_int("GEMINI_ROUTE_LARGE_INPUT_TOKENS", 20000),
+            breaker=shared_resilience().breaker,
+        )
+    )
+
+
+def _env_model(name: str, default: str) -> str:
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    v = raw.strip()
+    return "" if v.lower() in ("", "none", "off") else v
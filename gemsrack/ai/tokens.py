@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from ..config import Shared, env_int
+from .gemini import GeminiClient
+
+# これ以降のコードポイント（CJK・かな・全角記号など）は 1 文字 ≒ 1 トークンとみなす
+_WIDE_FROM = 0x2E80
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Gemini のトークン数の概算（API を呼ばない）。多めに見積もる側に寄せている。
+    ASCII は 4 文字 ≒ 1 トークン、CJK は 1 文字 ≒ 1 トークン、その他は 2 文字 ≒ 1 トークン。
+    """
+    if not text:
+        return 0
+    ascii_n = wide = 0
+    for ch in text:
+        o = ord(ch)
+        if o < 0x80:
+            ascii_n += 1
+        elif o >= _WIDE_FROM:
+            wide += 1
+    other = len(text) - ascii_n - wide
+    return max(1, math.ceil(ascii_n / 4 + other / 2 + wide))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> tuple[str, bool]:
+    """estimate_tokens で max_tokens に収まるよう先頭から切り詰める。(text, 切り詰めたか) を返す"""
+    if max_tokens <= 0:
+        return "", bool(text)
+    if estimate_tokens(text) <= max_tokens:
+        return text, False
+    cost = 0.0
+    cut = 0
+    for i, ch in enumerate(text):
+        o = ord(ch)
+        cost += 0.25 if o < 0x80 else (1.0 if o >= _WIDE_FROM else 0.5)
+        if cost > max_tokens:
+            cut = i
+            break
+    # 行の途中で切れないよう、近くに改行があればそこで切る
+    nl = text.rfind("\n", max(0, cut - 200), cut)
+    if nl > 0:
+        cut = nl
+    return text[:cut].rstrip(), True
+
+
+class TokenBudget:
+    """
+    Gemini に送る前のトークン見積もり。
+
+    - システムプロンプトのトークン数は（モデル + 内容）ごとにキャッシュする。
+      verify=True なら初回だけ countTokens API で実測し、失敗したら概算を使う
+    - max_input_tokens を超える入力は、呼び出し側で truncate_to_tokens で切り詰める
+    - cap_output=True なら、呼び出し側で出力形式に応じた maxOutputTokens を付ける
+    ※ プロセス内のみ
+    """
+
+    def __init__(
+        self,
+        *,
+        max_input_tokens: int = 32000,
+        verify: bool = False,
+        cap_output: bool = True,
+        max_entries: int = 512,
+    ) -> None:
+        self.max_input_tokens = max(1, int(max_input_tokens))
+        self.verify = bool(verify)
+        self.cap_output = bool(cap_output)
+        self.max_entries = max(1, int(max_entries))
+        self._lock = threading.Lock()
+        self._system: OrderedDict[str, tuple[int, str]] = OrderedDict()
+        self.counted = 0
+        self.count_failures = 0
+
+    def system_tokens(self, gemini: GeminiClient, system_instruction: str) -> tuple[int, str]:
+        """(トークン数, `counted` / `estimated`)"""
+        key = hashlib.sha256(f"{gemini.model}\n{system_instruction}".encode("utf-8")).hexdigest()
+        with self._lock:
+            hit = self._system.get(key)
+            if hit is not None:
+                self._system.move_to_end(key)
+                return hit
+
+        entry = (estimate_tokens(system_instruction), "estimated")
+        if self.verify:
+            try:
+                entry = (gemini.count_tokens(system_instruction=system_instruction), "counted")
+                with self._lock:
+                    self.counted += 1
+            except Exception as e:
+                # 実測できなくても概算で続ける（同じプロンプトでは再試行しない）
+                print(f"[gemini] countTokens failed: {type(e).__name__} {e}")
+                with self._lock:
+                    self.count_failures += 1
+
+        with self._lock:
+            self._system[key] = entry
+            while len(self._system) > self.max_entries:
+                self._system.popitem(last=False)
+        return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_input_tokens": self.max_input_tokens,
+                "verify": self.verify,
+                "cap_output": self.cap_output,
+                "system_prompts": len(self._system),
+                "counted": self.counted,
+                "count_failures": self.count_failures,
+            }
+
+
+_shared: Shared[TokenBudget] = Shared()
+
+
+def shared_token_budget() -> TokenBudget:
+    """
+    プロセス内で共有する設定。
+    - `GEMINI_MAX_INPUT_TOKENS`: 1 実行で送る入力（システムプロンプト込み）の上限（既定 32000）
+    - `GEMINI_COUNT_TOKENS`: `on` で Gem のシステムプロンプトを countTokens で実測する（`off` 既定。プロンプトごとに 1 回）
+    - `GEMINI_CAP_OUTPUT_TOKENS`: `on`（既定）で Slack に載る長さから maxOutputTokens を決める / `off`
+    """
+    return _shared.get(
+        lambda: TokenBudget(
+            max_input_tokens=env_int("GEMINI_MAX_INPUT_TOKENS", 32000),
+            verify=(os.environ.get("GEMINI_COUNT_TOKENS") or "off").strip().lower() in ("on", "1", "true"),
+            cap_output=(os.environ.get("GEMINI_CAP_OUTPUT_TOKENS") or "on").strip().lower()
+            not in ("off", "0", "false", "none"),
+        )
+    )
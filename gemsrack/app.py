@@ -4,9 +4,16 @@ import os
 
 from flask import Flask
 
+from .ai import prewarm_in_background, shared_session
 from .config import Settings, load_settings
 from .gems.store import build_store
-from .metrics import build_metrics_store
+from .metrics import (
+    LiveFeedMetricsStore,
+    RunLogMetricsStore,
+    build_live_usage_ring,
+    build_metrics_store,
+    build_run_event_log,
+)
 from .routes import admin_auth_bp, admin_bp, api_bp, health_bp, metrics_bp, slack_bp, web_bp
 from .slack import SlackBuildResult, build_slack
 
@@ -40,9 +47,23 @@ def create_app(settings: Settings | None = None) -> Flask:
         app.extensions["gem_store_error"] = f"{type(e).__name__}: {str(e) or type(e).__name__}"
 
     # Metrics store（Gem利用計測/KPI用）
+    # 直近のライブ集計（SSE 配信用）は永続化先に関わらずプロセス内のリングバッファで持つ
+    live = build_live_usage_ring()
+    app.extensions["metrics_live"] = live
+    # 実行単位のログ（失敗の調査用）。使えなくても日次集計は止めない
+    try:
+        run_log = build_run_event_log()
+        app.extensions["run_log"] = run_log
+        app.extensions["run_log_error"] = None
+    except Exception as e:
+        run_log = None
+        app.extensions["run_log"] = None
+        app.extensions["run_log_error"] = f"{type(e).__name__}: {str(e) or type(e).__name__}"
     try:
         mstore = build_metrics_store()
-        app.extensions["metrics_store"] = mstore
+        if run_log is not None:
+            mstore = RunLogMetricsStore(mstore, run_log)
+        app.extensions["metrics_store"] = LiveFeedMetricsStore(mstore, live)
         app.extensions["metrics_store_error"] = None
     except Exception as e:
         app.extensions["metrics_store"] = None
@@ -52,6 +73,10 @@ def create_app(settings: Settings | None = None) -> Flask:
     app.extensions["slack_handler"] = slack.handler
     app.extensions["slack_error"] = slack.error
 
+    # Gemini への接続はプロセスで共有するプールを使い回す（起動直後の初回実行向けに裏で接続を開いておく）
+    app.extensions["gemini_http"] = shared_session()
+    prewarm_in_background()
+
     app.register_blueprint(health_bp)
     app.register_blueprint(slack_bp)
     app.register_blueprint(api_bp)
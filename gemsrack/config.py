@@ -1,7 +1,11 @@
 from __future__ import annotations
 
 import os
+import threading
 from dataclasses import dataclass
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
 
 
 @dataclass(frozen=True)
@@ -21,3 +25,31 @@ def load_settings() -> Settings:
         # Slack外の閲覧UI用（単一ワークスペース想定のデフォルト）
         default_team_id=(os.environ.get("GEMSRACK_TEAM_ID") or os.environ.get("GEMSRACK_DEFAULT_TEAM_ID") or "local"),
     )
+
+
+def env_int(name: str, default: int) -> int:
+    """整数の環境変数（未設定・空・数値でなければ default）"""
+    raw = (os.environ.get(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        return default
+
+
+class Shared(Generic[T]):
+    """
+    環境変数から組み立てて、プロセス内で共有するオブジェクトの入れ物（各モジュールの `shared_*()` が使う）。
+    最初に get したときに factory で作る。factory が None を返したら覚えず、次の get でまた作る。
+    """
+
+    def __init__(self) -> None:
+        self._value: T | None = None
+        self._lock = threading.Lock()
+
+    def get(self, factory: Callable[[], T]) -> T:
+        with self._lock:
+            if self._value is None:
+                self._value = factory()
+            return self._value  # type: ignore[return-value]
@@ -1,6 +1,6 @@
-from .models import Gem
+from .models import Gem, GenerationConfig
 from .service import GemCommandResult, handle_gem_command
 from .store import GemStore, build_store
 
-__all__ = ["Gem", "GemCommandResult", "GemStore", "build_store", "handle_gem_command"]
+__all__ = ["Gem", "GemCommandResult", "GemStore", "GenerationConfig", "build_store", "handle_gem_command"]
 
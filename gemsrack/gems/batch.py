@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterator
+
+from ..config import Shared, env_int
+
+
+def split_batch_input(raw: str) -> list[str]:
+    """
+    バッチ入力を 1 件ずつに分ける。
+    - JSON 配列: 要素ごと（文字列はそのまま、それ以外は JSON 文字列にする）
+    - NDJSON: 空でない行がすべて JSON として読めれば 1 行 1 件
+    - それ以外: 空でない行ごと（URL 一覧など）
+    """
+    text = (raw or "").strip()
+    if not text:
+        return []
+    if text.startswith("["):
+        try:
+            arr = json.loads(text)
+        except ValueError:
+            arr = None
+        if isinstance(arr, list):
+            return [_item_text(v) for v in arr if _item_text(v)]
+
+    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+    if all(ln[0] in "{[" for ln in lines):
+        try:
+            return [_item_text(json.loads(ln)) for ln in lines]
+        except ValueError:
+            pass
+    return lines
+
+
+def _item_text(v: object) -> str:
+    if isinstance(v, str):
+        return v.strip()
+    return json.dumps(v, ensure_ascii=False)
+
+
+@dataclass(frozen=True)
+class BatchItemResult:
+    index: int
+    input: str
+    ok: bool
+    output: str
+    latency_ms: float
+
+    def to_dict(self) -> dict:
+        d: dict = {"index": self.index, "input": self.input, "ok": self.ok, "latency_ms": self.latency_ms}
+        d["output" if self.ok else "error"] = self.output
+        return d
+
+
+class BatchRunner:
+    """
+    1 つの Gem を複数の入力に適用する（プロセス共有のワーカープール）。
+
+    - 全体の同時実行数は workers まで（Gemini / Slack API の上限を超えないように）
+    - チーム単位でも per_team までに抑え、1 チームの大きなバッチで他チームを待たせない
+      （空くまでワーカーを占有しないよう、投入前に待つ）
+    - 結果は完了した順に返す。1 件の失敗で全体は止めない
+    """
+
+    def __init__(self, *, workers: int = 4, per_team: int = 2, max_items: int = 100) -> None:
+        self.workers = max(1, int(workers))
+        self.per_team = max(1, min(int(per_team), self.workers))
+        self.max_items = max(1, int(max_items))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gem-batch")
+        self._lock = threading.Lock()
+        self._team_slots: dict[str, threading.BoundedSemaphore] = {}
+        self.running_batches = 0
+
+    def _slots(self, team_id: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            sem = self._team_slots.get(team_id)
+            if sem is None:
+                sem = self._team_slots[team_id] = threading.BoundedSemaphore(self.per_team)
+            return sem
+
+    def run(
+        self,
+        *,
+        team_id: str,
+        items: list[str],
+        fn: Callable[[str], tuple[bool, str]],
+    ) -> Iterator[BatchItemResult]:
+        """
+        fn(input) -> (ok, output) を各入力に適用し、完了した順に結果を返す。
+        途中で読むのをやめると（クライアント切断など）、未投入の入力は実行しない。
+        """
+        slots = self._slots(team_id)
+        results: queue.Queue[BatchItemResult] = queue.Queue()
+        cancelled = threading.Event()
+
+        def _one(i: int, item: str) -> None:
+            started = time.perf_counter()
+            try:
+                ok, out = fn(item)
+            except Exception as e:
+                ok, out = False, f"{type(e).__name__}: {str(e) or type(e).__name__}"
+            finally:
+                slots.release()
+            results.put(
+                BatchItemResult(
+                    index=i,
+                    input=item,
+                    ok=bool(ok),
+                    output=out,
+                    latency_ms=round((time.perf_counter() - started) * 1000.0, 1),
+                )
+            )
+
+        def _dispatch() -> None:
+            for i, item in enumerate(items):
+                slots.acquire()
+                if cancelled.is_set():
+                    slots.release()
+                    results.put(BatchItemResult(index=i, input=item, ok=False, output="cancelled", latency_ms=0.0))
+                    continue
+                self._executor.submit(_one, i, item)
+
+        with self._lock:
+            self.running_batches += 1
+        threading.Thread(target=_dispatch, name="gem-batch-dispatch", daemon=True).start()
+        try:
+            for _ in range(len(items)):
+                yield results.get()
+        finally:
+            cancelled.set()
+            with self._lock:
+                self.running_batches -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "per_team": self.per_team,
+                "max_items": self.max_items,
+                "running_batches": self.running_batches,
+            }
+
+
+_shared: Shared[BatchRunner] = Shared()
+
+
+def shared_batch_runner() -> BatchRunner:
+    """
+    プロセス内で共有するワーカープール。
+    - `GEM_BATCH_WORKERS`: 全体の同時実行数（既定 4）
+    - `GEM_BATCH_TEAM_CONCURRENCY`: チームごとの同時実行数（既定 2）
+    - `GEM_BATCH_MAX_ITEMS`: 1 回のバッチの最大件数（既定 100）
+    """
+    return _shared.get(
+        lambda: BatchRunner(
+            workers=env_int("GEM_BATCH_WORKERS", 4),
+            per_team=env_int("GEM_BATCH_TEAM_CONCURRENCY", 2),
+            max_items=env_int("GEM_BATCH_MAX_ITEMS", 100),
+        )
+    )
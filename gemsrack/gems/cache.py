@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from ..config import Shared, env_int
+
+# キーの形式を変えたら上げる（古いディスクキャッシュを読まないように）
+_KEY_VERSION = 1
+
+
+def result_cache_key(*, model: str, request: dict) -> str:
+    """
+    Gemini へ送る内容そのもの（システムプロンプト・出力形式の指示・前処理済み入力・生成設定）と
+    モデル名から決まるキー。Gem の定義や入力が 1 文字でも変われば別のキーになる。
+    """
+    raw = json.dumps(
+        {"v": _KEY_VERSION, "model": model, "request": request},
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    AI Gem の実行結果キャッシュ（成功した結果のみ）。
+
+    - メモリ: LRU（max_entries 件）
+    - ディスク（任意）: `{dir}/{key[:2]}/{key}.json`。プロセス再起動後もヒットする
+    どちらも ttl_seconds を過ぎたものは使わない。
+    """
+
+    def __init__(self, *, max_entries: int = 256, ttl_seconds: int = 86400, directory: str | None = None) -> None:
+        self.max_entries = max(0, int(max_entries))
+        self.ttl_seconds = max(1, int(ttl_seconds))
+        self.dir = Path(directory) if directory else None
+        if self.dir is not None:
+            self.dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._mem: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            hit = self._mem.get(key)
+            if hit is not None:
+                if now - hit[0] < self.ttl_seconds:
+                    self._mem.move_to_end(key)
+                    self.hits += 1
+                    return hit[1]
+                del self._mem[key]
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is not None and now - entry[0] < self.ttl_seconds:
+                self._put_mem_locked(key, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def put(self, key: str, message: str) -> None:
+        entry = (time.time(), message)
+        with self._lock:
+            self._put_mem_locked(key, entry)
+        self._write_disk(key, entry)
+
+    def _put_mem_locked(self, key: str, entry: tuple[float, str]) -> None:
+        if self.max_entries <= 0:
+            return
+        self._mem[key] = entry
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _path(self, key: str) -> Path:
+        assert self.dir is not None
+        return self.dir / key[:2] / f"{key}.json"
+
+    def _read_disk(self, key: str) -> tuple[float, str] | None:
+        if self.dir is None:
+            return None
+        p = self._path(key)
+        try:
+            d = json.loads(p.read_text(encoding="utf-8"))
+            created, message = float(d["created"]), str(d["message"])
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, OSError):
+            p.unlink(missing_ok=True)
+            return None
+        if time.time() - created >= self.ttl_seconds:
+            p.unlink(missing_ok=True)
+            return None
+        return created, message
+
+    def _write_disk(self, key: str, entry: tuple[float, str]) -> None:
+        if self.dir is None:
+            return
+        p = self._path(key)
+        try:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp = p.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps({"created": entry[0], "message": entry[1]}, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, p)
+        except OSError as e:
+            print(f"[gem] result cache write failed: {type(e).__name__} {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._mem),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "disk_dir": str(self.dir) if self.dir is not None else None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+_shared: Shared[ResultCache] = Shared()
+
+
+def shared_result_cache() -> ResultCache | None:
+    """
+    プロセス内で共有するキャッシュ（無効なら None）。
+    - `GEM_RESULT_CACHE`: `on`（既定）/ `off`
+    - `GEM_RESULT_CACHE_SIZE`: メモリに保持する件数（既定 256）
+    - `GEM_RESULT_CACHE_TTL_SECONDS`: 有効期間（既定 86400 = 1 日）
+    - `GEM_RESULT_CACHE_DIR`: 指定するとディスクにも保存する（任意）
+    """
+    if (os.environ.get("GEM_RESULT_CACHE") or "on").strip().lower() in ("off", "0", "false", "none"):
+        return None
+    return _shared.get(
+        lambda: ResultCache(
+            max_entries=env_int("GEM_RESULT_CACHE_SIZE", 256),
+            ttl_seconds=env_int("GEM_RESULT_CACHE_TTL_SECONDS", 86400),
+            directory=(os.environ.get("GEM_RESULT_CACHE_DIR") or "").strip() or None,
+        )
+    )
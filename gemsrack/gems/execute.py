@@ -1,9 +1,47 @@
 from __future__ import annotations
 
+import asyncio
+import functools
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
 
+from ..ai.aio import AsyncGeminiClient
+from ..ai.context_cache import ContextCacheRegistry
 from ..ai.gemini import GeminiClient
+from ..ai.ratelimit import RateLimitedError, RateLimiter
+from ..ai.routing import ModelRouter, RouteDecision
+from ..ai.tokens import TokenBudget, estimate_tokens, truncate_to_tokens
+from .cache import ResultCache, result_cache_key
 from .formats import label_for_input, label_for_output
+from .images import ImageCache, ImageProcessor
+from .models import GenerationConfig
+from .progress import RunProgress
+from .singleflight import SingleFlight
+
+# 途中経過を流しても意味のある出力形式（JSON は完成するまで解析できないので一括で返す）
+_STREAMABLE_OUTPUTS = ("", "plain_text", "free_text", "markdown", "marp_markdown")
+
+# Slack に返すテキストの上限（これを超える分は _truncate で捨てる）
+SLACK_TEXT_LIMIT = 3500
+
+
+@dataclass(frozen=True)
+class _TextRun:
+    """AI Gem（テキスト）1 回分の、Gemini に送る直前までの準備結果（同期/非同期の実行で共有）"""
+
+    gemini: GeminiClient
+    gen: GenerationConfig
+    sys: str
+    instruction: str
+    response_mime_type: str | None
+    max_output_tokens: int | None
+    input_tokens: int  # ルーティング用の入力トークン数（見積もり）
+    input_note: str
+    key: str | None  # 結果キャッシュ / single-flight のキー（使わないなら None）
+    owner: str
 
 
 def execute_ai_gem(
@@ -11,28 +49,292 @@ def execute_ai_gem(
     gem,
     user_input: str,
     gemini: GeminiClient | None,
+    progress: RunProgress | None = None,
+    cache: ResultCache | None = None,
+    context_cache: ContextCacheRegistry | None = None,
+    flights: SingleFlight | None = None,
+    budget: TokenBudget | None = None,
+    router: ModelRouter | None = None,
+    limiter: RateLimiter | None = None,
+    details: dict | None = None,
 ) -> tuple[bool, str]:
     """
     Returns (ok, message).
+
+    progress を渡すと、ストリーミング可能な出力形式では生成途中の全文を progress.partial に流す。
+    cache を渡すと（Gem 側で無効化されていなければ）同じリクエストの成功結果を再利用する。
+    context_cache を渡すと、長いシステムプロンプトを Gemini 側のキャッシュ（cachedContents）経由で送る。
+    flights を渡すと、同じチーム・同じリクエスト（Gem 定義 + 前処理済み入力）の実行中に来た呼び出しは先行の結果を待って共有する
+    （先行がレート制限で断られたときは共有せず、それぞれ自分で枠を取って実行する）。
+    budget を渡すと、送る前にトークン数を見積もって長すぎる入力を切り詰め、出力形式に応じて maxOutputTokens を付ける。
+    router を渡すと、モデルの健全性・Gem の SLO・入力の大きさから primary / fallback のモデルを選ぶ（失敗時は他方で 1 回やり直す）。
+    limiter を渡すと、Gemini を呼ぶ前にレート制限の枠を確保する（空くまで順番待ちし、待っている間は順番を progress に出す）。
+    details には実行の付帯情報（`cache`、`context_cache`、`route`、トークン数、`ttft_ms` など）を書き込む（計測用）。
+    """
+    run, done = _prepare_text_run(
+        gem=gem,
+        user_input=user_input,
+        gemini=gemini,
+        cache=cache,
+        flights=flights,
+        budget=budget,
+        details=details,
+    )
+    if run is None:
+        return done  # type: ignore[return-value]
+
+    if progress is not None:
+        try:
+            progress.started(gem_name=gem.name)
+        except Exception as e:
+            print(f"[gem] progress start failed: {type(e).__name__} {e}")
+
+    def _run() -> tuple[bool, str]:
+        usage: dict = {}
+
+        def _attempt(model: str) -> str:
+            client = run.gemini.with_overrides(model=model)
+            usage.clear()
+            cached_content = None
+            # cachedContents はモデルごとに作られるので、fallback 先では使わない（primary 用を作り直させない）
+            if context_cache is not None and model == run.gemini.model:
+                cached_content, status = context_cache.resolve(client, owner=run.owner, system_instruction=run.sys)
+                if details is not None and status != "skipped":
+                    details["context_cache"] = status
+
+            def _generate(cached: str | None) -> str:
+                kwargs = _generate_kwargs(run, cached, usage)
+                if progress is not None and (gem.output_format or "") in _STREAMABLE_OUTPUTS:
+                    return _stream_text(client, progress, details=details, **kwargs)
+                return client.generate_text(**kwargs)
+
+            try:
+                return _generate(cached_content)
+            except Exception as e:
+                if not _stale_cached_content(e, cached_content):
+                    raise
+                # 期限切れ/削除済みのキャッシュを参照した。作り直しは次回に回し、今回は通常どおり送る
+                context_cache.invalidate(run.owner, cached_content)  # type: ignore[union-attr]
+                if details is not None:
+                    details["context_cache"] = "invalidated"
+                return _generate(None)
+
+        used = run.gemini.model
+        reserved = _reserved_tokens(run)
+        if limiter is not None:
+            waited = limiter.acquire(
+                team_id=_team_of(gem), tokens=reserved, on_queued=_on_queued(gem, progress, details)
+            )
+            _record_wait(details, waited)
+        try:
+            if router is None:
+                out = _attempt(used)
+            else:
+                decision = _route(router, run, details)
+                out, used = router.call(decision, _attempt)
+        finally:
+            if limiter is not None:
+                limiter.settle(team_id=_team_of(gem), reserved=reserved, actual=_used_tokens(usage))
+        return _finish_text_run(gem, run, out, usage, used=used, cache=cache, details=details)
+
+    if run.key is None or flights is None:
+        return _run()
+
+    def _lead() -> tuple[tuple[bool, str] | None, RateLimitedError | None]:
+        # レート制限で断られたことは待っていた呼び出しには渡さない（それぞれ自分の枠で実行し直す）
+        try:
+            return _run(), None
+        except RateLimitedError as e:
+            return None, e
+
+    (out, limited), shared = flights.do(_flight_key(gem, run.key), _lead)
+    if limited is not None:
+        if not shared:
+            raise limited
+        return _run()
+    ok, formatted = out
+    if shared and details is not None:
+        # 先行の実行結果を受け取っただけ（Gemini は呼んでいないのでトークン数は記録しない）
+        details["coalesced"] = True
+    return ok, formatted
+
+
+async def execute_ai_gem_async(
+    *,
+    gem,
+    user_input: str,
+    gemini: AsyncGeminiClient | None,
+    progress: RunProgress | None = None,
+    cache: ResultCache | None = None,
+    context_cache: ContextCacheRegistry | None = None,
+    flights: SingleFlight | None = None,
+    budget: TokenBudget | None = None,
+    router: ModelRouter | None = None,
+    limiter: RateLimiter | None = None,
+    details: dict | None = None,
+) -> tuple[bool, str]:
+    """
+    execute_ai_gem のイベントループ版（引数と戻り値は同じ。gemini は AsyncGeminiClient）。
+    Gemini の応答を待つ間はスレッドを占有しない。
+    progress の更新・cachedContents の作成・countTokens での実測は同期 API なので、その間だけ別スレッドで行う。
     """
+    sync_gemini = gemini.config if gemini is not None else None
+    prepare = functools.partial(
+        _prepare_text_run,
+        gem=gem,
+        user_input=user_input,
+        gemini=sync_gemini,
+        cache=cache,
+        flights=flights,
+        budget=budget,
+        details=details,
+    )
+    # countTokens で実測する設定のときだけ HTTP を伴う（初回のみ）
+    run, done = await asyncio.to_thread(prepare) if budget is not None and budget.verify else prepare()
+    if run is None:
+        return done  # type: ignore[return-value]
+    assert gemini is not None
+
+    if progress is not None:
+        try:
+            await asyncio.to_thread(progress.started, gem_name=gem.name)
+        except Exception as e:
+            print(f"[gem] progress start failed: {type(e).__name__} {e}")
+
+    async def _run() -> tuple[bool, str]:
+        usage: dict = {}
+
+        async def _attempt(model: str) -> str:
+            client = gemini.with_overrides(model=model)
+            usage.clear()
+            cached_content = None
+            if context_cache is not None and model == run.gemini.model:
+                cached_content, status = await asyncio.to_thread(
+                    context_cache.resolve, client.config, owner=run.owner, system_instruction=run.sys
+                )
+                if details is not None and status != "skipped":
+                    details["context_cache"] = status
+
+            async def _generate(cached: str | None) -> str:
+                kwargs = _generate_kwargs(run, cached, usage)
+                if progress is not None and (gem.output_format or "") in _STREAMABLE_OUTPUTS:
+                    return await _stream_text_async(client, progress, details=details, **kwargs)
+                return await client.generate_text(**kwargs)
+
+            try:
+                return await _generate(cached_content)
+            except Exception as e:
+                if not _stale_cached_content(e, cached_content):
+                    raise
+                context_cache.invalidate(run.owner, cached_content)  # type: ignore[union-attr]
+                if details is not None:
+                    details["context_cache"] = "invalidated"
+                return await _generate(None)
+
+        used = run.gemini.model
+        reserved = _reserved_tokens(run)
+        if limiter is not None:
+            waited = await limiter.acquire_async(
+                team_id=_team_of(gem), tokens=reserved, on_queued=_on_queued(gem, progress, details)
+            )
+            _record_wait(details, waited)
+        try:
+            if router is None:
+                out = await _attempt(used)
+            else:
+                decision = _route(router, run, details)
+                out, used = await router.call_async(decision, _attempt)
+        finally:
+            if limiter is not None:
+                limiter.settle(team_id=_team_of(gem), reserved=reserved, actual=_used_tokens(usage))
+        return _finish_text_run(gem, run, out, usage, used=used, cache=cache, details=details)
+
+    if run.key is None or flights is None:
+        return await _run()
+
+    async def _lead() -> tuple[tuple[bool, str] | None, RateLimitedError | None]:
+        try:
+            return await _run(), None
+        except RateLimitedError as e:
+            return None, e
+
+    (out, limited), shared = await flights.do_async(_flight_key(gem, run.key), _lead)
+    if limited is not None:
+        if not shared:
+            raise limited
+        return await _run()
+    ok, formatted = out
+    if shared and details is not None:
+        details["coalesced"] = True
+    return ok, formatted
+
+
+def _prepare_text_run(
+    *,
+    gem,
+    user_input: str,
+    gemini: GeminiClient | None,
+    cache: ResultCache | None,
+    flights: SingleFlight | None,
+    budget: TokenBudget | None,
+    details: dict | None,
+) -> tuple[_TextRun | None, tuple[bool, str] | None]:
+    """(準備結果, None) か、Gemini を呼ばずに返せる場合は (None, (ok, message))"""
     if gemini is None:
-        return False, "Gemini API が未設定です。Cloud Run の環境変数 `GEMINI_API_KEY` を設定してください。"
+        return None, (False, "Gemini API が未設定です。Cloud Run の環境変数 `GEMINI_API_KEY` を設定してください。")
 
     if gem.output_format == "image_url":
-        return False, "このGemは出力形式が画像ですが、画像生成はまだ未対応です（次対応: 画像生成モデル）。"
+        return None, (False, "このGemは出力形式が画像ですが、画像生成はまだ未対応です（次対応: 画像生成モデル）。")
+
+    # Gem ごとの生成設定（モデル / thinking は同じ接続プールのままクライアントを差し替える）
+    gen: GenerationConfig = getattr(gem, "generation", None) or GenerationConfig()
+    gemini = gemini.with_overrides(model=gen.model, thinking_budget=gen.thinking_budget)
+    if details is not None:
+        details["model"] = gemini.model
 
     # 入力の前処理（形式が指定されている場合のみ）
     prepared_input, err = _prepare_input(gem.input_format, user_input)
     if err:
-        return False, err
+        return None, (False, err)
 
     sys = (gem.system_prompt or "").strip() or "You are a helpful assistant."
-    instruction = _build_user_instruction(
-        summary=gem.summary or "",
-        input_format=gem.input_format or "free_text",
-        output_format=gem.output_format or "plain_text",
-        prepared_input=prepared_input,
-    )
+
+    def _instruction(text: str) -> str:
+        return _build_user_instruction(
+            summary=gem.summary or "",
+            input_format=gem.input_format or "free_text",
+            output_format=gem.output_format or "plain_text",
+            prepared_input=text,
+        )
+
+    input_note = ""
+    prompt_tokens_est: int | None = None
+    max_output_tokens = None
+    if gen.max_output_tokens is not None:
+        # Gem で明示した上限を優先する
+        max_output_tokens = gen.max_output_tokens
+    if budget is not None:
+        system_tokens, source = budget.system_tokens(gemini, sys)
+        overhead = estimate_tokens(_instruction(""))
+        input_tokens = estimate_tokens(prepared_input)
+        room = budget.max_input_tokens - system_tokens - overhead
+        if input_tokens > room > 0:
+            # 捨てられる出力のために待つより、送る前に削る（先頭を優先して残す）
+            prepared_input, _ = truncate_to_tokens(prepared_input, room)
+            input_note = f"\n\n_※ 入力が長いため、先頭の約 {room} トークン分だけを使いました_"
+            input_tokens = estimate_tokens(prepared_input)
+        if budget.cap_output and max_output_tokens is None:
+            max_output_tokens = _max_output_tokens(gem.output_format or "", gemini.thinking_budget)
+        prompt_tokens_est = system_tokens + overhead + input_tokens
+        if details is not None:
+            details["system_tokens"] = system_tokens
+            details["system_tokens_source"] = source
+            details["prompt_tokens_est"] = prompt_tokens_est
+            if input_note:
+                details["input_truncated"] = True
+            if max_output_tokens is not None:
+                details["max_output_tokens"] = max_output_tokens
+    instruction = _instruction(prepared_input)
 
     response_mime_type = None
     if gem.output_format == "json":
@@ -41,28 +343,211 @@ def execute_ai_gem(
         response_mime_type = "text/plain"
     # markdown/marp_markdown は text/plain でOK（Slack/Marpの都合上）
 
-    out = gemini.generate_text(
-        system_instruction=sys,
-        user_text=instruction,
+    # 結果キャッシュと single-flight で同じキーを使う（Gem 側でキャッシュ無効なら毎回生成するのでどちらも使わない）
+    key = None
+    if (cache is not None or flights is not None) and bool(getattr(gem, "cache_results", True)):
+        key = result_cache_key(
+            model=gemini.model,
+            request={
+                "system_instruction": sys,
+                "user_text": instruction,
+                "response_mime_type": response_mime_type,
+                "thinking_budget": gemini.thinking_budget,
+                "temperature": gen.temperature,
+                "max_output_tokens": max_output_tokens,
+            },
+        )
+    if key is not None and cache is not None:
+        hit = cache.get(key)
+        if details is not None:
+            details["cache"] = "hit" if hit is not None else "miss"
+        if hit is not None:
+            return None, (True, hit)
+
+    run = _TextRun(
+        gemini=gemini,
+        gen=gen,
+        sys=sys,
+        instruction=instruction,
         response_mime_type=response_mime_type,
+        max_output_tokens=max_output_tokens,
+        input_tokens=prompt_tokens_est
+        if prompt_tokens_est is not None
+        else estimate_tokens(sys) + estimate_tokens(instruction),
+        input_note=input_note,
+        key=key,
+        owner=f"{getattr(gem, 'team_id', '')}/{gem.name}",
+    )
+    return run, None
+
+
+def _generate_kwargs(run: _TextRun, cached_content: str | None, usage: dict) -> dict:
+    return {
+        "system_instruction": run.sys,
+        "user_text": run.instruction,
+        "response_mime_type": run.response_mime_type,
+        "temperature": run.gen.temperature,
+        "max_output_tokens": run.max_output_tokens,
+        "cached_content": cached_content,
+        "usage": usage,
+    }
+
+
+def _team_of(gem) -> str:  # noqa: ANN001
+    return str(getattr(gem, "team_id", "") or "")
+
+
+def _flight_key(gem, key: str) -> str:  # noqa: ANN001
+    # レート制限はチーム単位なので、相乗りも同じチームの実行どうしに限る（結果キャッシュのキーはチームをまたいで共有）
+    return f"{_team_of(gem)}:{key}"
+
+
+def _reserved_tokens(run: _TextRun) -> int:
+    # 出力は上限まで使う前提で確保し、実行後に実際の使用量で精算する
+    return run.input_tokens + (run.max_output_tokens or 0)
+
+
+def _used_tokens(usage: dict) -> int:
+    return (
+        int(usage.get("promptTokenCount") or 0)
+        + int(usage.get("candidatesTokenCount") or 0)
+        + int(usage.get("thoughtsTokenCount") or 0)
+    )
+
+
+def _on_queued(gem, progress: RunProgress | None, details: dict | None) -> Callable[[int], None] | None:  # noqa: ANN001
+    if progress is None and details is None:
+        return None
+
+    def _notify(position: int) -> None:
+        if details is not None:
+            details.setdefault("queue_position", position)
+        if progress is not None:
+            progress.partial(f"⏳ Gem `{gem.name}` は混み合っているため順番待ちです（{position} 番目）")
+
+    return _notify
+
+
+def _record_wait(details: dict | None, waited: float) -> None:
+    if details is not None and waited >= 0.001:
+        details["rate_limit_wait_ms"] = round(waited * 1000.0, 1)
+
+
+def _stale_cached_content(e: Exception, cached_content: str | None) -> bool:
+    status_code = getattr(getattr(e, "response", None), "status_code", None)
+    return cached_content is not None and status_code in (400, 403, 404)
+
+
+def _route(router: ModelRouter, run: _TextRun, details: dict | None) -> RouteDecision:
+    decision = router.choose(
+        primary=run.gemini.model,
+        fallback=router.fallback_model,
+        input_tokens=run.input_tokens,
+        slo_ms=run.gen.latency_slo_ms,
     )
+    if details is not None:
+        details["route"] = decision.reason
+    return decision
+
+
+def _finish_text_run(
+    gem,
+    run: _TextRun,
+    out: str,
+    usage: dict,
+    *,
+    used: str,
+    cache: ResultCache | None,
+    details: dict | None,
+) -> tuple[bool, str]:  # noqa: ANN001
+    if details is not None and used != run.gemini.model:
+        details["model"] = used
+        details["fallback_from"] = run.gemini.model
+
+    if details is not None and usage:
+        details["prompt_tokens"] = int(usage.get("promptTokenCount") or 0)
+        details["output_tokens"] = int(usage.get("candidatesTokenCount") or 0)
+        if usage.get("cachedContentTokenCount"):
+            details["cached_tokens"] = int(usage["cachedContentTokenCount"])
 
     ok, formatted = _postprocess_output(gem.output_format, out)
+    if ok and run.max_output_tokens is not None and _hit_output_cap(usage, run.max_output_tokens):
+        if details is not None:
+            details["output_capped"] = True
+        if not formatted.endswith("...(truncated)"):
+            formatted += "\n\n...(truncated)"
+    if ok:
+        formatted += run.input_note
+    # fallback の結果は primary のキーで使い回さない（品質が違う）
+    if ok and run.key is not None and cache is not None and used == run.gemini.model:
+        cache.put(run.key, formatted)
     return ok, formatted
 
 
+def _stream_text(gemini: GeminiClient, progress: RunProgress, *, details: dict | None, **kwargs) -> str:  # noqa: ANN003
+    chunks: list[str] = []
+    started = time.perf_counter()
+    for piece in gemini.stream_text(**kwargs):
+        if not chunks and details is not None:
+            # 利用者が待たされる時間（最初の断片が表示されるまで）
+            details["ttft_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+        chunks.append(piece)
+        try:
+            progress.partial(_truncate("".join(chunks).strip()))
+        except Exception as e:
+            # 途中経過の表示に失敗しても生成は続ける
+            print(f"[gem] progress update failed: {type(e).__name__} {e}")
+    return "".join(chunks)
+
+
+async def _stream_text_async(
+    gemini: AsyncGeminiClient, progress: RunProgress, *, details: dict | None, **kwargs
+) -> str:  # noqa: ANN003
+    chunks: list[str] = []
+    started = time.perf_counter()
+    async for piece in gemini.stream_text(**kwargs):
+        if not chunks and details is not None:
+            details["ttft_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+        chunks.append(piece)
+        try:
+            # Slack への反映は同期 API（progress 側で間引かれる）
+            await asyncio.to_thread(progress.partial, _truncate("".join(chunks).strip()))
+        except Exception as e:
+            print(f"[gem] progress update failed: {type(e).__name__} {e}")
+    return "".join(chunks)
+
+
 def execute_ai_image_gem(
     *,
     gem,
     user_input: str,
     gemini: GeminiClient | None,
+    flights: SingleFlight | None = None,
+    router: ModelRouter | None = None,
+    limiter: RateLimiter | None = None,
+    image_cache: ImageCache | None = None,
+    processor: ImageProcessor | None = None,
+    variant: int = 0,
+    details: dict | None = None,
 ) -> tuple[bool, bytes | None, str, str]:
     """
     Generate an image for the Gem. Returns (ok, image_bytes|None, mime, message_if_error_or_alt).
+
+    flights を渡すと、同じプロンプトの生成中に来た呼び出しは先行の画像を共有する（Gem 側でキャッシュ無効なら共有しない）。
+    router を渡すと、画像モデルが使えない（廃止で 404 / 障害）ときに fallback の画像モデルで 1 回やり直す。
+    limiter を渡すと、生成の前にレート制限の枠（1 リクエスト + プロンプトの見積もりトークン数）を確保する。
+    image_cache を渡すと、同じプロンプトの画像を再利用する（Gem 側でキャッシュ無効なら使わない）。
+    processor を渡すと、生成した画像を WebP / JPEG に圧縮し直してから返す（キャッシュにも圧縮後を保存する）。
+    variant: 同じプロンプトで別の画像を作るときの番号（0 以外はキャッシュ / single-flight のキーが変わる）。
+    details には画像のサイズと、この実行で同時に持っていた画像データの最大バイト数（image_peak_bytes）が入る。
     """
     if gemini is None:
         return False, None, "", "Gemini API が未設定です。Cloud Run の環境変数 `GEMINI_API_KEY` を設定してください。"
 
+    # 画像 Gem では Gem のモデル指定を画像モデルの上書きとして扱う
+    gen: GenerationConfig = getattr(gem, "generation", None) or GenerationConfig()
+    gemini = gemini.with_overrides(image_model=gen.model)
+
     # 入力の前処理（形式が指定されている場合のみ）
     prepared_input, err = _prepare_input(gem.input_format, user_input)
     if err:
@@ -81,13 +566,115 @@ def execute_ai_image_gem(
     if not prompt:
         prompt = "Generate a high-quality image."
 
+    use_cache = bool(getattr(gem, "cache_results", True))
+    request: dict = {"image_prompt": prompt}
+    if processor is not None:
+        request["output"] = processor.signature
+    if variant:
+        request["variant"] = int(variant)
+    key = result_cache_key(model=gemini.image_model, request=request)
+    if image_cache is not None and use_cache:
+        hit = image_cache.get(key)
+        if details is not None:
+            details["image_cache"] = "hit" if hit is not None else "miss"
+        if hit is not None:
+            if details is not None:
+                details["image_bytes"] = len(hit[0])
+            return True, hit[0], hit[1], ""
+
+    def _generate() -> tuple[bytes, str]:
+        if limiter is not None:
+            # 画像の使用トークン数は返ってこないので、プロンプトの見積もりだけ確保する（精算しない）
+            waited = limiter.acquire(
+                team_id=_team_of(gem), tokens=estimate_tokens(prompt), on_queued=_on_queued(gem, None, details)
+            )
+            _record_wait(details, waited)
+        stats: dict = {}
+        if router is None:
+            image = gemini.generate_image(prompt=prompt, stats=stats)
+            used = primary = gemini.image_model
+        else:
+            decision = router.choose(
+                primary=gemini.image_model, fallback=router.image_fallback_model, slo_ms=gen.latency_slo_ms
+            )
+            image, used = router.call(
+                decision, lambda m: gemini.with_overrides(image_model=m).generate_image(prompt=prompt, stats=stats)
+            )
+            primary = decision.primary
+            if details is not None:
+                details["route"] = decision.reason
+                details["model"] = used
+                if used != primary:
+                    details["fallback_from"] = primary
+        if details is not None:
+            details["image_response_bytes"] = stats.get("response_bytes")
+            details["image_peak_bytes"] = stats.get("peak_bytes")
+            details["image_generated_bytes"] = len(image[0])
+        if processor is not None:
+            image = processor.process(image[0], image[1], details)
+        # fallback モデルの画像は保存しない（テキストの結果キャッシュと同じ）
+        if image_cache is not None and use_cache and used == primary:
+            image_cache.put(key, image[0], image[1])
+        return image
+
+    def _lead() -> tuple[tuple[bytes, str] | None, RateLimitedError | None]:
+        # レート制限で断られたことは待っていた呼び出しには渡さない（テキストと同じ）
+        try:
+            return _generate(), None
+        except RateLimitedError as e:
+            return None, e
+
     try:
-        img_bytes, mime = gemini.generate_image(prompt=prompt)
+        if flights is None or not use_cache:
+            img_bytes, mime = _generate()
+        else:
+            (image, limited), shared = flights.do(_flight_key(gem, key), _lead)
+            if limited is not None:
+                if not shared:
+                    raise limited
+                image, shared = _generate(), False
+            img_bytes, mime = image
+            if shared and details is not None:
+                details["coalesced"] = True
+        if details is not None:
+            details["image_bytes"] = len(img_bytes)
         return True, img_bytes, mime, ""
+    except RateLimitedError as e:
+        return False, None, "", f"混み合っているため画像を生成できませんでした。約 {max(1, int(e.retry_in))} 秒後に再実行してください。"
     except Exception as e:
         return False, None, "", f"画像生成に失敗しました: `{str(e) or type(e).__name__}`"
 
 
+def execute_ai_image_variants(
+    *,
+    variants: int,
+    details: dict | None = None,
+    **kwargs,  # noqa: ANN003
+) -> list[tuple[bool, bytes | None, str, str]]:
+    """
+    execute_ai_image_gem を variants 回同時に実行し、variant の番号順に結果を返す（1 枚ずつ別の画像）。
+    レート制限・ルーティング・キャッシュは 1 枚ごとに効く。一部が失敗しても残りの結果は返す。
+    details には枚数と、1 枚ごとの details（variant_details）、合計の image_bytes / image_peak_bytes が入る。
+    """
+    n = max(1, int(variants))
+    per: list[dict] = [{} for _ in range(n)]
+    with ThreadPoolExecutor(max_workers=n, thread_name_prefix="gem-image") as ex:
+        futures = [ex.submit(execute_ai_image_gem, variant=i, details=per[i], **kwargs) for i in range(n)]
+        results = [f.result() for f in futures]
+    if details is not None:
+        for (ok, _, _, msg), d in zip(results, per):
+            d["ok"] = ok
+            if not ok:
+                d["error"] = msg[:200]
+        details["variants"] = n
+        details["variants_ok"] = sum(1 for r in results if r[0])
+        details["variant_details"] = per
+        # 同時に生成しているので、各回の最大値の合計がこの実行の最大になる
+        details["image_bytes"] = sum(d.get("image_bytes") or 0 for d in per)
+        details["image_peak_bytes"] = sum(d.get("image_peak_bytes") or 0 for d in per)
+    return results
+
+
 def _build_user_instruction(*, summary: str, input_format: str, output_format: str, prepared_input: str) -> str:
     lines: list[str] = []
     if summary:
@@ -159,7 +746,28 @@ def _postprocess_output(output_format: str, out: str) -> tuple[bool, str]:
     return True, _truncate(text)
 
 
-def _truncate(text: str, limit: int = 3500) -> str:
+def _max_output_tokens(output_format: str, thinking_budget: int | None) -> int | None:
+    """
+    Slack に載る長さ（SLACK_TEXT_LIMIT 文字）から決める maxOutputTokens。
+    出力の言語は分からないので 1 文字 ≒ 1 トークン（日本語）で見積もる（英文なら 4 倍ほど余裕がある）。
+    Gemini 2.5 は thinking も maxOutputTokens に含まれるため、その分を足す。
+    """
+    if thinking_budget is None or thinking_budget < 0:
+        # 動的 thinking は思考に使う量が読めないので上限を付けない
+        return None
+    cap = SLACK_TEXT_LIMIT
+    if output_format == "json":
+        # 途中で切れた JSON は解析できないので余裕を持たせる（表示用に整形し直すと長くなる分も見込む）
+        cap *= 2
+    return cap + int(thinking_budget)
+
+
+def _hit_output_cap(usage: dict, max_output_tokens: int) -> bool:
+    used = int(usage.get("candidatesTokenCount") or 0) + int(usage.get("thoughtsTokenCount") or 0)
+    return used >= max_output_tokens
+
+
+def _truncate(text: str, limit: int = SLACK_TEXT_LIMIT) -> str:
     if len(text) <= limit:
         return text
     return text[:limit] + "\n\n...(truncated)"
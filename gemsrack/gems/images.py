@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import importlib.util
+import io
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from ..config import Shared, env_int
+
+# mimeType -> 拡張子（Slack へのアップロード名とディスクキャッシュのファイル名に使う）
+IMAGE_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+
+
+# Slack の 1 回のアップロード（files_upload_v2 の file_uploads）に載せる枚数の上限
+MAX_UPLOAD_FILES = 10
+
+
+def image_extension(mime: str) -> str:
+    return IMAGE_EXTENSIONS.get((mime or "").lower(), "png")
+
+
+def max_image_variants() -> int:
+    """`GEM_IMAGE_MAX_VARIANTS`: `--variants` で 1 回に生成できる枚数（既定 4。最大 10）"""
+    return max(1, min(MAX_UPLOAD_FILES, env_int("GEM_IMAGE_MAX_VARIANTS", 4)))
+
+
+class ImageCache:
+    """
+    生成した画像のキャッシュ（プロンプト + 画像モデル + 後処理の設定のハッシュがキー）。
+
+    - メモリ: 合計 max_bytes までの LRU（画像は大きいので件数ではなくバイト数で抑える）
+    - ディスク（任意）: `{dir}/{key[:2]}/{key}.{拡張子}`。プロセス再起動後もヒットする
+    どちらも ttl_seconds を過ぎたものは使わない。同じ bytes を全員に返す（コピーしない）。
+    """
+
+    def __init__(self, *, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: int = 86400, directory: str | None = None) -> None:
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl_seconds = max(1, int(ttl_seconds))
+        self.dir = Path(directory) if directory else None
+        if self.dir is not None:
+            self.dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._mem: OrderedDict[str, tuple[float, bytes, str]] = OrderedDict()
+        self._mem_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> tuple[bytes, str] | None:
+        now = time.time()
+        with self._lock:
+            hit = self._mem.get(key)
+            if hit is not None:
+                if now - hit[0] < self.ttl_seconds:
+                    self._mem.move_to_end(key)
+                    self.hits += 1
+                    return hit[1], hit[2]
+                self._drop_locked(key)
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is not None and now - entry[0] < self.ttl_seconds:
+                self._put_mem_locked(key, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+        return None
+
+    def put(self, key: str, data: bytes, mime: str) -> None:
+        entry = (time.time(), data, mime)
+        with self._lock:
+            self._put_mem_locked(key, entry)
+        self._write_disk(key, entry)
+
+    def _drop_locked(self, key: str) -> None:
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= len(old[1])
+
+    def _put_mem_locked(self, key: str, entry: tuple[float, bytes, str]) -> None:
+        self._drop_locked(key)
+        # 1 枚で上限を超える画像はメモリに載せない（ほかを全部追い出してしまうので）
+        if len(entry[1]) > self.max_bytes:
+            return
+        self._mem[key] = entry
+        self._mem_bytes += len(entry[1])
+        while self._mem_bytes > self.max_bytes:
+            _, (_, data, _) = self._mem.popitem(last=False)
+            self._mem_bytes -= len(data)
+
+    def _read_disk(self, key: str) -> tuple[float, bytes, str] | None:
+        if self.dir is None:
+            return None
+        for mime, ext in IMAGE_EXTENSIONS.items():
+            p = self.dir / key[:2] / f"{key}.{ext}"
+            try:
+                created = p.stat().st_mtime
+                if time.time() - created >= self.ttl_seconds:
+                    p.unlink(missing_ok=True)
+                    return None
+                return created, p.read_bytes(), mime
+            except FileNotFoundError:
+                continue
+            except OSError:
+                p.unlink(missing_ok=True)
+                return None
+        return None
+
+    def _write_disk(self, key: str, entry: tuple[float, bytes, str]) -> None:
+        if self.dir is None:
+            return
+        p = self.dir / key[:2] / f"{key}.{image_extension(entry[2])}"
+        try:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp = p.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp.write_bytes(entry[1])
+            os.replace(tmp, p)
+        except OSError as e:
+            print(f"[gem] image cache write failed: {type(e).__name__} {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._mem),
+                "bytes": self._mem_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "disk_dir": str(self.dir) if self.dir is not None else None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+def _recompress(data: bytes, fmt: str, quality: int, max_side: int) -> tuple[bytes, str]:
+    """（別プロセスで実行）画像を fmt（webp / jpeg）で圧縮し直す。max_side を超える辺は縮小する"""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        if max_side and max(img.size) > max_side:
+            # JPEG は縮小したサイズで読み込める（全画素を展開しない）
+            img.draft("RGB", (max_side, max_side))
+            img.thumbnail((max_side, max_side))
+        if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        if fmt == "webp":
+            img.save(out, format="WEBP", quality=quality, method=4)
+        else:
+            img.save(out, format="JPEG", quality=quality, optimize=True)
+    return out.getvalue(), f"image/{fmt}"
+
+
+class ImageProcessor:
+    """
+    生成した画像を WebP / JPEG に圧縮し直す（任意で長辺を max_side に縮小）。
+
+    Gemini の画像は PNG で数 MB になることがあり、Slack へのアップロード時間とメモリを食うため小さくしてから渡す。
+    エンコードは CPU を使うので別プロセス（workers 個）で行い、gunicorn のワーカースレッド（GIL）を止めない。
+    圧縮し直しても小さくならなければ元の画像を使う。失敗しても元の画像で続ける。
+    Pillow が入っていなければ何もしない。
+    """
+
+    def __init__(self, *, fmt: str = "webp", quality: int = 85, max_side: int = 0, workers: int = 1, timeout: float = 30.0) -> None:
+        self.fmt = "jpeg" if fmt in ("jpg", "jpeg") else "webp"
+        self.quality = max(1, min(100, int(quality)))
+        self.max_side = max(0, int(max_side))
+        self.workers = max(1, int(workers))
+        self.timeout = float(timeout)
+        self._lock = threading.Lock()
+        self._executor: ProcessPoolExecutor | None = None
+        # 入っていないのに毎回プロセスへ投げないよう、先に確かめておく
+        self.available = importlib.util.find_spec("PIL") is not None
+        if not self.available:
+            print("[gem] image recompression disabled: Pillow is not installed")
+        self.runs = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def signature(self) -> str:
+        """キャッシュのキーに含める設定（設定を変えたら別の画像として扱う）"""
+        return f"{self.fmt}:q{self.quality}:s{self.max_side}"
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # gunicorn のスレッドが動いている中で fork しないよう spawn で起こす
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def process(self, data: bytes, mime: str, details: dict | None = None) -> tuple[bytes, str]:
+        if not self.available or ((mime or "").lower() == f"image/{self.fmt}" and not self.max_side):
+            return data, mime
+        started = time.perf_counter()
+        try:
+            out, out_mime = self._pool().submit(_recompress, data, self.fmt, self.quality, self.max_side).result(
+                timeout=self.timeout
+            )
+        except ImportError:
+            print("[gem] image recompression disabled: Pillow is not installed")
+            self.available = False
+            return data, mime
+        except Exception as e:
+            print(f"[gem] image recompression failed: {type(e).__name__} {e}")
+            with self._lock:
+                self.failures += 1
+                if isinstance(e, BrokenProcessPool):
+                    self._executor = None
+            return data, mime
+        if details is not None:
+            details["recompress_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+            # 別プロセスへ渡す分と受け取る分が親プロセスに同時にある
+            details["image_peak_bytes"] = max(details.get("image_peak_bytes") or 0, len(data) + len(out))
+        if len(out) >= len(data) and not self.max_side:
+            out, out_mime = data, mime
+        with self._lock:
+            self.runs += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(out)
+        return out, out_mime
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "format": self.fmt,
+                "quality": self.quality,
+                "max_side": self.max_side,
+                "workers": self.workers,
+                "available": self.available,
+                "runs": self.runs,
+                "failures": self.failures,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "saved_ratio": round(1.0 - self.bytes_out / self.bytes_in, 4) if self.bytes_in else 0.0,
+            }
+
+
+_shared_cache: Shared[ImageCache] = Shared()
+_shared_processor: Shared[ImageProcessor] = Shared()
+
+
+def shared_image_cache() -> ImageCache | None:
+    """
+    プロセス内で共有する画像キャッシュ（無効なら None）。
+    - `GEM_IMAGE_CACHE`: `on`（既定）/ `off`
+    - `GEM_IMAGE_CACHE_MB`: メモリに保持する合計サイズ（既定 64）
+    - `GEM_IMAGE_CACHE_TTL_SECONDS`: 有効期間（既定 86400 = 1 日）
+    - `GEM_IMAGE_CACHE_DIR`: 指定するとディスクにも保存する（任意）
+    """
+    if (os.environ.get("GEM_IMAGE_CACHE") or "on").strip().lower() in ("off", "0", "false", "none"):
+        return None
+    return _shared_cache.get(
+        lambda: ImageCache(
+            max_bytes=env_int("GEM_IMAGE_CACHE_MB", 64) * 1024 * 1024,
+            ttl_seconds=env_int("GEM_IMAGE_CACHE_TTL_SECONDS", 86400),
+            directory=(os.environ.get("GEM_IMAGE_CACHE_DIR") or "").strip() or None,
+        )
+    )
+
+
+def shared_image_processor() -> ImageProcessor | None:
+    """
+    プロセス内で共有する画像の圧縮し直し（無効なら None）。
+    - `GEM_IMAGE_FORMAT`: `off`（既定）/ `webp` / `jpeg`
+    - `GEM_IMAGE_QUALITY`: 圧縮品質（既定 85）
+    - `GEM_IMAGE_MAX_SIDE`: 長辺の上限ピクセル（既定 0 = 縮小しない）
+    - `GEM_IMAGE_WORKERS`: 圧縮に使うプロセス数（既定 1）
+    """
+    fmt = (os.environ.get("GEM_IMAGE_FORMAT") or "off").strip().lower()
+    if fmt not in ("webp", "jpeg", "jpg"):
+        return None
+    return _shared_processor.get(
+        lambda: ImageProcessor(
+            fmt=fmt,
+            quality=env_int("GEM_IMAGE_QUALITY", 85),
+            max_side=env_int("GEM_IMAGE_MAX_SIDE", 0),
+            workers=env_int("GEM_IMAGE_WORKERS", 1),
+        )
+    )
@@ -0,0 +1,459 @@
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# queued: 実行待ち / leased: どこかのワーカーが実行中（visible_at まで）/ done: 返答済み / failed: 諦めた
+JOB_STATUSES = ("queued", "leased", "done", "failed")
+
+
+@dataclass
+class GemJob:
+    """
+    永続化された Gem 実行 1 件。
+
+    payload は実行に必要なもの（team_id / user_id / channel_id / text / public / response_url など）。
+    result は実行が終わった時点で保存する（返答前に落ちても、次のワーカーは実行し直さずに返答だけ行う）。
+    """
+
+    id: str
+    payload: dict
+    status: str = "queued"
+    attempts: int = 0
+    lease_owner: str | None = None
+    visible_at: float = 0.0
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    result: dict | None = None
+    error: str | None = None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "payload": self.payload,
+            "status": self.status,
+            "attempts": self.attempts,
+            "lease_owner": self.lease_owner,
+            "visible_at": self.visible_at,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "result": self.result,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "GemJob":
+        return cls(
+            id=str(d.get("id") or ""),
+            payload=dict(d.get("payload") or {}),
+            status=str(d.get("status") or "queued"),
+            attempts=int(d.get("attempts") or 0),
+            lease_owner=d.get("lease_owner"),
+            visible_at=float(d.get("visible_at") or 0.0),
+            created_at=float(d.get("created_at") or 0.0),
+            updated_at=float(d.get("updated_at") or 0.0),
+            result=d.get("result") or None,
+            error=d.get("error"),
+        )
+
+
+class JobQueue(ABC):
+    """
+    Gem 実行の永続キュー（リース方式）。
+
+    - lease で queued（または期限切れの leased）を取り、lease_seconds の間ほかのワーカーから見えなくする
+    - 実行中は extend で期限を延ばす。インスタンスが落ちて延長が止まれば、期限後に別のワーカーが取り直す
+    - complete / finish / fail / release はリースを持つワーカー（owner）からのみ受け付ける（取り直された後の書き込みは無視）
+    """
+
+    @abstractmethod
+    def enqueue(self, payload: dict, *, job_id: str | None = None) -> GemJob:
+        raise NotImplementedError
+
+    @abstractmethod
+    def lease(self, owner: str, *, lease_seconds: float, limit: int = 1) -> list[GemJob]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def extend(self, job_id: str, owner: str, *, lease_seconds: float) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def complete(self, job_id: str, owner: str, result: dict) -> bool:
+        """実行結果を保存する（リースは持ったまま。返答できたら finish）"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def finish(self, job_id: str, owner: str) -> bool:
+        """返答まで済んだ"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def fail(self, job_id: str, owner: str, error: str, *, retry_in: float | None = None) -> bool:
+        """retry_in 秒後にやり直す（None なら failed にして諦める）"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def release(self, job_id: str, owner: str) -> bool:
+        """実行せずに返す（試行回数に数えない。停止時など）"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, job_id: str) -> GemJob | None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        return None
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex
+
+
+class SqliteJobQueue(JobQueue):
+    """
+    ローカル用: SQLite の 1 テーブル（`gem_jobs`）。同じファイルを使う複数プロセスで共有できる。
+    lease は BEGIN IMMEDIATE で書き込みロックを取ってから選ぶので、同じジョブを 2 つのワーカーが取らない。
+    done / failed は retention_seconds を過ぎたら lease のついでに消す。
+    """
+
+    def __init__(self, path: str, *, retention_seconds: int = 86400) -> None:
+        self.path = path
+        self.retention_seconds = max(60, int(retention_seconds))
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS gem_jobs ("
+            " id TEXT PRIMARY KEY, payload TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL,"
+            " lease_owner TEXT, visible_at REAL NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL,"
+            " result TEXT, error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS gem_jobs_visible ON gem_jobs (status, visible_at)")
+        self._last_purge = 0.0
+
+    @staticmethod
+    def _row(row: tuple) -> GemJob:
+        return GemJob(
+            id=row[0],
+            payload=json.loads(row[1]),
+            status=row[2],
+            attempts=int(row[3]),
+            lease_owner=row[4],
+            visible_at=float(row[5]),
+            created_at=float(row[6]),
+            updated_at=float(row[7]),
+            result=json.loads(row[8]) if row[8] else None,
+            error=row[9],
+        )
+
+    _COLUMNS = "id, payload, status, attempts, lease_owner, visible_at, created_at, updated_at, result, error"
+
+    def enqueue(self, payload: dict, *, job_id: str | None = None) -> GemJob:
+        now = time.time()
+        job = GemJob(id=job_id or new_job_id(), payload=payload, visible_at=now, created_at=now, updated_at=now)
+        with self._lock:
+            # 同じ job_id の二重投入は無視する（最初のものを返す）
+            self._conn.execute(
+                f"INSERT OR IGNORE INTO gem_jobs ({self._COLUMNS}) VALUES (?, ?, 'queued', 0, NULL, ?, ?, ?, NULL, NULL)",
+                (job.id, json.dumps(payload, ensure_ascii=False), now, now, now),
+            )
+        return self.get(job.id) or job
+
+    def lease(self, owner: str, *, lease_seconds: float, limit: int = 1) -> list[GemJob]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    f"SELECT {self._COLUMNS} FROM gem_jobs WHERE status IN ('queued', 'leased') AND visible_at <= ?"
+                    " ORDER BY visible_at LIMIT ?",
+                    (now, max(1, int(limit))),
+                ).fetchall()
+                jobs = []
+                for row in rows:
+                    job = self._row(row)
+                    job.status, job.lease_owner = "leased", owner
+                    job.attempts += 1
+                    job.visible_at, job.updated_at = now + lease_seconds, now
+                    self._conn.execute(
+                        "UPDATE gem_jobs SET status = 'leased', lease_owner = ?, attempts = ?, visible_at = ?, updated_at = ?"
+                        " WHERE id = ?",
+                        (owner, job.attempts, job.visible_at, now, job.id),
+                    )
+                    jobs.append(job)
+                if now - self._last_purge > 60:
+                    self._last_purge = now
+                    self._conn.execute(
+                        "DELETE FROM gem_jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                        (now - self.retention_seconds,),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return jobs
+
+    def _update_owned(self, job_id: str, owner: str, sets: str, args: tuple) -> bool:
+        with self._lock:
+            cur = self._conn.execute(
+                f"UPDATE gem_jobs SET {sets}, updated_at = ? WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+                (*args, time.time(), job_id, owner),
+            )
+            return cur.rowcount > 0
+
+    def extend(self, job_id: str, owner: str, *, lease_seconds: float) -> bool:
+        return self._update_owned(job_id, owner, "visible_at = ?", (time.time() + lease_seconds,))
+
+    def complete(self, job_id: str, owner: str, result: dict) -> bool:
+        return self._update_owned(job_id, owner, "result = ?", (json.dumps(result, ensure_ascii=False),))
+
+    # 終わったジョブには返答先（response_url。30 分はそれだけで投稿できる）を残さない
+    _DROP_RESPONSE_URL = "payload = json_remove(payload, '$.response_url')"
+
+    def finish(self, job_id: str, owner: str) -> bool:
+        return self._update_owned(job_id, owner, f"status = 'done', lease_owner = NULL, {self._DROP_RESPONSE_URL}", ())
+
+    def fail(self, job_id: str, owner: str, error: str, *, retry_in: float | None = None) -> bool:
+        if retry_in is None:
+            return self._update_owned(
+                job_id, owner, f"status = 'failed', lease_owner = NULL, error = ?, {self._DROP_RESPONSE_URL}", (error,)
+            )
+        return self._update_owned(
+            job_id, owner, "status = 'queued', lease_owner = NULL, error = ?, visible_at = ?", (error, time.time() + retry_in)
+        )
+
+    def release(self, job_id: str, owner: str) -> bool:
+        return self._update_owned(
+            job_id, owner, "status = 'queued', lease_owner = NULL, attempts = MAX(0, attempts - 1), visible_at = ?", (time.time(),)
+        )
+
+    def get(self, job_id: str) -> GemJob | None:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {self._COLUMNS} FROM gem_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM gem_jobs GROUP BY status").fetchall())
+            oldest = self._conn.execute("SELECT MIN(created_at) FROM gem_jobs WHERE status = 'queued'").fetchone()[0]
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "counts": {s: int(counts.get(s) or 0) for s in JOB_STATUSES},
+            "oldest_queued_seconds": round(now - oldest, 1) if oldest else None,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class FirestoreJobQueue(JobQueue):
+    """
+    Cloud Run 用: Firestore の `gem_jobs` コレクション（インスタンス間で共有）。
+    lease はクエリで候補を選んでから、1 件ずつトランザクションで状態を確かめて取る（先に取られていたら飛ばす）。
+    ※ `status` + `visible_at` の複合インデックスが必要。done / failed は `expires_at` の TTL ポリシーで消す。
+    """
+
+    def __init__(self, *, project_id: str | None = None, retention_days: int = 7) -> None:
+        project_id = (
+            project_id
+            or os.environ.get("GOOGLE_CLOUD_PROJECT")
+            or os.environ.get("GCP_PROJECT")
+            or os.environ.get("GCLOUD_PROJECT")
+        )
+        from google.cloud import firestore  # type: ignore
+
+        self._firestore = firestore
+        self._client = firestore.Client(project=project_id) if project_id else firestore.Client()
+        self._retention = timedelta(days=max(1, int(retention_days)))
+
+    def _col(self):
+        return self._client.collection("gem_jobs")
+
+    def enqueue(self, payload: dict, *, job_id: str | None = None) -> GemJob:
+        now = time.time()
+        job = GemJob(id=job_id or new_job_id(), payload=payload, visible_at=now, created_at=now, updated_at=now)
+        from google.api_core.exceptions import Conflict  # type: ignore
+
+        try:
+            self._col().document(job.id).create(job.to_dict())
+        except Conflict:
+            # 同じ job_id の二重投入は最初のものを返す
+            return self.get(job.id) or job
+        return job
+
+    def _transition(self, job_id: str, check, update) -> GemJob | None:  # noqa: ANN001
+        """トランザクション内で check(job) が真なら update(job) を書き込み、更新後の job を返す"""
+        ref = self._col().document(job_id)
+        firestore = self._firestore
+
+        @firestore.transactional  # type: ignore[attr-defined]
+        def _tx(tx) -> GemJob | None:  # noqa: ANN001
+            snap = ref.get(transaction=tx)
+            if not snap.exists:
+                return None
+            job = GemJob.from_dict(snap.to_dict() or {})
+            if not check(job):
+                return None
+            update(job)
+            job.updated_at = time.time()
+            d = job.to_dict()
+            if job.status in ("done", "failed"):
+                d["expires_at"] = datetime.now(timezone.utc) + self._retention
+            tx.set(ref, d)
+            return job
+
+        return _tx(self._client.transaction())
+
+    def lease(self, owner: str, *, lease_seconds: float, limit: int = 1) -> list[GemJob]:
+        now = time.time()
+        q = (
+            self._col()
+            .where("status", "in", ["queued", "leased"])
+            .where("visible_at", "<=", now)
+            .order_by("visible_at")
+            .limit(max(1, int(limit)) * 3)
+        )
+        jobs: list[GemJob] = []
+        for snap in q.stream():
+            if len(jobs) >= limit:
+                break
+
+            def _check(job: GemJob) -> bool:
+                return job.status in ("queued", "leased") and job.visible_at <= time.time()
+
+            def _take(job: GemJob) -> None:
+                job.status, job.lease_owner = "leased", owner
+                job.attempts += 1
+                job.visible_at = time.time() + lease_seconds
+
+            job = self._transition(snap.id, _check, _take)
+            if job is not None:
+                jobs.append(job)
+        return jobs
+
+    def _owned(self, job_id: str, owner: str, update) -> bool:  # noqa: ANN001
+        return (
+            self._transition(job_id, lambda j: j.status == "leased" and j.lease_owner == owner, update) is not None
+        )
+
+    def extend(self, job_id: str, owner: str, *, lease_seconds: float) -> bool:
+        def _u(j: GemJob) -> None:
+            j.visible_at = time.time() + lease_seconds
+
+        return self._owned(job_id, owner, _u)
+
+    def complete(self, job_id: str, owner: str, result: dict) -> bool:
+        def _u(j: GemJob) -> None:
+            j.result = result
+
+        return self._owned(job_id, owner, _u)
+
+    def finish(self, job_id: str, owner: str) -> bool:
+        def _u(j: GemJob) -> None:
+            j.status, j.lease_owner = "done", None
+            # 終わったジョブには返答先（response_url）を残さない
+            j.payload.pop("response_url", None)
+
+        return self._owned(job_id, owner, _u)
+
+    def fail(self, job_id: str, owner: str, error: str, *, retry_in: float | None = None) -> bool:
+        def _u(j: GemJob) -> None:
+            j.lease_owner, j.error = None, error
+            if retry_in is None:
+                j.status = "failed"
+                j.payload.pop("response_url", None)
+            else:
+                j.status, j.visible_at = "queued", time.time() + retry_in
+
+        return self._owned(job_id, owner, _u)
+
+    def release(self, job_id: str, owner: str) -> bool:
+        def _u(j: GemJob) -> None:
+            j.status, j.lease_owner = "queued", None
+            j.attempts = max(0, j.attempts - 1)
+            j.visible_at = time.time()
+
+        return self._owned(job_id, owner, _u)
+
+    def get(self, job_id: str) -> GemJob | None:
+        snap = self._col().document(job_id).get()
+        return GemJob.from_dict(snap.to_dict() or {}) if snap.exists else None
+
+    def stats(self) -> dict:
+        counts: dict[str, int] = {}
+        for s in JOB_STATUSES:
+            try:
+                res = self._col().where("status", "==", s).count().get()
+                counts[s] = int(res[0][0].value)
+            except Exception:
+                counts[s] = -1
+        return {"backend": "firestore", "collection": "gem_jobs", "counts": counts}
+
+
+_shared: JobQueue | None = None
+_shared_error: str | None = None
+_shared_lock = threading.Lock()
+
+
+def build_job_queue() -> JobQueue | None:
+    """
+    `GEM_JOB_QUEUE_BACKEND` で Gem 実行の永続キューを選ぶ:
+    - `firestore`: Firestore（`gem_jobs`。インスタンス間で共有）
+    - `sqlite`: ローカルの SQLite（`GEM_JOB_QUEUE_PATH`、既定 `/tmp/gemsrack-jobs.sqlite3`）
+    - `none`: 使わない（従来どおりプロセス内で実行）
+    - `auto`(既定): Cloud Run では Firestore、それ以外は使わない（SQLite はローカルで試すときに明示して選ぶ）
+    """
+    backend = (os.environ.get("GEM_JOB_QUEUE_BACKEND") or "auto").strip().lower()
+    if backend in ("none", "noop", "off", "false"):
+        return None
+    path = os.environ.get("GEM_JOB_QUEUE_PATH") or "/tmp/gemsrack-jobs.sqlite3"
+    if backend == "sqlite":
+        return SqliteJobQueue(path)
+    if backend == "firestore":
+        return FirestoreJobQueue()
+    if backend != "auto":
+        raise RuntimeError("GEM_JOB_QUEUE_BACKEND は `auto` / `firestore` / `sqlite` / `none` のいずれかにしてください")
+    if os.environ.get("K_SERVICE"):
+        # インスタンスのローカルファイルでは、落ちたインスタンスのジョブを別のインスタンスが拾えない
+        return FirestoreJobQueue()
+    # Cloud Run 以外では勝手にファイルを作らない
+    return None
+
+
+def shared_job_queue() -> JobQueue | None:
+    """プロセス内で共有する永続キュー（無効、または初期化に失敗したら None）"""
+    global _shared, _shared_error
+    with _shared_lock:
+        if _shared is None and _shared_error is None:
+            try:
+                _shared = build_job_queue()
+                if _shared is None:
+                    _shared_error = "disabled"
+            except Exception as e:
+                _shared_error = f"{type(e).__name__}: {str(e) or type(e).__name__}"
+                print(f"[gem] job queue init failed; running in-process: {_shared_error}")
+        return _shared
+
+
+def job_queue_error() -> str | None:
+    with _shared_lock:
+        return _shared_error
@@ -4,6 +4,48 @@ from dataclasses import dataclass
 from datetime import datetime
 
 
+@dataclass(frozen=True)
+class GenerationConfig:
+    """Gem ごとの生成設定（空 / None の項目は環境変数の既定を使う）"""
+
+    model: str = ""
+    thinking_budget: int | None = None  # 0 で thinking 無効、-1 で動的
+    temperature: float | None = None
+    max_output_tokens: int | None = None
+    # 目標応答時間（ミリ秒）。primary モデルが遅いときは fallback モデルに回す
+    latency_slo_ms: int | None = None
+
+    def is_default(self) -> bool:
+        return self == GenerationConfig()
+
+    def to_dict(self) -> dict:
+        # Firestore の merge で消し忘れないよう、未指定の項目も None で持つ
+        return {
+            "model": self.model,
+            "thinking_budget": self.thinking_budget,
+            "temperature": self.temperature,
+            "max_output_tokens": self.max_output_tokens,
+            "latency_slo_ms": self.latency_slo_ms,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict | None) -> "GenerationConfig":
+        d = d or {}
+        tb, temp, mot, slo = (
+            d.get("thinking_budget"),
+            d.get("temperature"),
+            d.get("max_output_tokens"),
+            d.get("latency_slo_ms"),
+        )
+        return cls(
+            model=str(d.get("model") or ""),
+            thinking_budget=int(tb) if tb is not None else None,
+            temperature=float(temp) if temp is not None else None,
+            max_output_tokens=int(mot) if mot is not None else None,
+            latency_slo_ms=int(slo) if slo is not None else None,
+        )
+
+
 @dataclass(frozen=True)
 class Gem:
     team_id: str
@@ -23,4 +65,8 @@ class Gem:
     created_by: str | None
     created_at: datetime
     updated_at: datetime
+    # 同じ定義 × 同じ入力の AI 実行結果をキャッシュしてよいか（毎回違う出力が欲しい Gem は False）
+    cache_results: bool = True
+    # モデル / thinking / temperature / 出力トークン上限の上書き（既定は環境変数の設定）
+    generation: GenerationConfig = GenerationConfig()
 
@@ -0,0 +1,16 @@
+from __future__ import annotations
+
+
+class RunProgress:
+    """
+    Gem 実行の途中経過を受け取るフック（既定は何もしない）。
+    Slack 側でプレースホルダ投稿 → 逐次更新する実装に差し替える。
+    """
+
+    def started(self, *, gem_name: str) -> None:
+        """AI 呼び出しの直前に 1 回呼ばれる"""
+        return None
+
+    def partial(self, text: str) -> None:
+        """生成途中の全文（ここまでの累積）。断片が届くたびに呼ばれる"""
+        return None
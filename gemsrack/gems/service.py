@@ -1,12 +1,42 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+import asyncio
+import io
+import json
+import os
 import re
 import shlex
+import tempfile
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Coroutine, Iterator
 
 from .formats import label_for_input, label_for_output
-from .execute import execute_ai_gem, execute_ai_image_gem
-from .store import GemStore, validate_gem_name
+from ..ai.aio import AsyncGeminiClient, async_enabled, run_in_background, shared_background_loop
+from ..ai.context_cache import shared_context_cache
+from ..ai.ratelimit import RateLimitedError, shared_rate_limiter
+from ..ai.resilience import CircuitOpenError, DeadlineExceededError
+from ..ai.routing import shared_model_router
+from ..ai.tokens import shared_token_budget
+from .batch import BatchItemResult, BatchRunner, shared_batch_runner, split_batch_input
+from .cache import shared_result_cache
+from .execute import execute_ai_gem, execute_ai_gem_async, execute_ai_image_gem, execute_ai_image_variants
+from .images import image_extension, max_image_variants, shared_image_cache, shared_image_processor
+from .progress import RunProgress
+from .singleflight import shared_single_flight
+from .store import GemStore, parse_generation_config, validate_gem_name
+
+
+# `/gem create` の生成設定フラグ -> parse_generation_config の引数名
+_GENERATION_FLAGS = {
+    "--model": "model",
+    "--thinking": "thinking_budget",
+    "--thinking-budget": "thinking_budget",
+    "--temperature": "temperature",
+    "--max-tokens": "max_output_tokens",
+    "--slo": "latency_slo_ms",
+}
 
 
 @dataclass(frozen=True)
@@ -68,6 +98,19 @@ def _raw_input_for_default_run(raw: str, name: str) -> str:
     return _strip_leading_public_flags(rest)
 
 
+_NON_RUN_SUBCOMMANDS = {"help", "-h", "--help", "create", "set", "batch", "list", "show", "info", "delete", "del", "rm"}
+
+
+def run_command_gem_name(text: str) -> str | None:
+    """`/gem run <name> ...` / `/gem <name> ...` のように Gem を実行するコマンドなら、その Gem 名（検証前）。管理系・ヘルプ・バッチは None"""
+    tokens, _ = parse_public_flag((text or "").split())
+    if not tokens or tokens[0].lower() in _NON_RUN_SUBCOMMANDS:
+        return None
+    if tokens[0].lower() in ("run", "exec"):
+        return tokens[1] if len(tokens) > 1 else None
+    return tokens[0]
+
+
 def handle_gem_command(
     *,
     store: GemStore,
@@ -78,7 +121,9 @@ def handle_gem_command(
     slack_client=None,  # Slack WebClient（画像生成時のアップロードに使用。任意）
     channel_id: str | None = None,
     metrics_store=None,
-) -> GemCommandResult:  # noqa: ANN001
+    progress: RunProgress | None = None,  # AI Gem の生成途中を受け取る（任意）
+    defer: bool = False,  # True なら GEMINI_ASYNC の生成を待たずに Future を返す（start_gem_command を使う）
+) -> GemCommandResult | Future[GemCommandResult]:  # noqa: ANN001
     raw = (text or "").strip()
     if not raw:
         return GemCommandResult(
@@ -109,6 +154,8 @@ def handle_gem_command(
         system_prompt = ""
         input_format = ""
         output_format = ""
+        cache_results: bool | None = None
+        gen_args: dict[str, str] = {}
 
         rest = tokens[2:]
         if any(t.startswith("--") for t in rest):
@@ -128,6 +175,13 @@ def handle_gem_command(
                 elif t in ("--output", "--output-format"):
                     i += 1
                     output_format = rest[i] if i < len(rest) else ""
+                elif t == "--no-cache":
+                    cache_results = False
+                elif t == "--cache":
+                    cache_results = True
+                elif t in _GENERATION_FLAGS:
+                    i += 1
+                    gen_args[_GENERATION_FLAGS[t]] = rest[i] if i < len(rest) else ""
                 else:
                     body_parts.append(t)
                 i += 1
@@ -139,6 +193,8 @@ def handle_gem_command(
             body = " ".join(rest)
         try:
             n = validate_gem_name(name)
+            # 生成設定のフラグが無ければ保存済みの設定をそのまま残す
+            generation = parse_generation_config(**gen_args) if gen_args else None
         except ValueError as e:
             return GemCommandResult(ok=False, message=str(e))
 
@@ -150,6 +206,8 @@ def handle_gem_command(
             system_prompt=system_prompt,
             input_format=input_format,
             output_format=output_format,
+            cache_results=cache_results,
+            generation=generation,
             created_by=user_id,
         )
         if system_prompt or input_format or output_format or summary:
@@ -174,110 +232,45 @@ def handle_gem_command(
         gem = store.get(team_id=team_id, name=n)
         if not gem:
             return GemCommandResult(ok=False, message=f"Gem **{n}** が見つかりません。`/gem list` で確認できます。")
-        if not bool(getattr(gem, "enabled", True)):
-            try:
-                if metrics_store is not None:
-                    metrics_store.record_gem_run(team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=False)
-            except Exception:
-                pass
-            return GemCommandResult(ok=False, message=f"Gem **{n}** は現在無効化されています（管理者に確認してください）。")
-        if gem.body.strip():
-            try:
-                if metrics_store is not None:
-                    metrics_store.record_gem_run(team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=True)
-            except Exception:
-                pass
-            return GemCommandResult(ok=True, message=gem.body, public=public)
-        # 画像生成 Gem の特例ハンドリング
-        if (gem.output_format or "") == "image_url":
-            ok, img_bytes, mime, msg = execute_ai_image_gem(gem=gem, user_input=user_input, gemini=gemini)
-            if not ok or not img_bytes:
-                try:
-                    if metrics_store is not None:
-                        metrics_store.record_gem_run(
-                            team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=False
-                        )
-                except Exception:
-                    pass
-                return GemCommandResult(ok=False, message=msg or "画像生成に失敗しました。")
-
-            # Slack にアップロード（公開: チャンネル / 非公開: DM）
-            if slack_client is None:
-                try:
-                    if metrics_store is not None:
-                        metrics_store.record_gem_run(
-                            team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=True
-                        )
-                except Exception:
-                    pass
-                return GemCommandResult(ok=True, message="画像を生成しましたが、Slack へのアップロード権限がありません（管理者に `files:write` 追加を依頼してください）。")
-            try:
-                import io
-
-                filename = f"{n}.png" if (mime or "").endswith("png") else f"{n}.jpg"
-                target_channel = None
-                if public and channel_id:
-                    target_channel = channel_id
-                elif user_id:
-                    # DM チャンネルを開いて個別送信
-                    opened = slack_client.conversations_open(users=user_id)
-                    target_channel = (opened.get("channel") or {}).get("id")
-                if not target_channel:
-                    # 最後の手段として respond チャンネル（あれば）
-                    target_channel = channel_id
-
-                if hasattr(slack_client, "files_upload_v2"):
-                    slack_client.files_upload_v2(
-                        channel=target_channel,
-                        filename=filename,
-                        file=io.BytesIO(img_bytes),
-                        title=f"Gem: {n}",
-                    )
-                else:  # 旧API互換
-                    slack_client.files_upload(
-                        channels=target_channel,
-                        filename=filename,
-                        file=io.BytesIO(img_bytes),
-                        title=f"Gem: {n}",
-                    )
-                if public:
-                    try:
-                        if metrics_store is not None:
-                            metrics_store.record_gem_run(
-                                team_id=team_id, gem_name=n, user_id=user_id, public=True, ok=True
-                            )
-                    except Exception:
-                        pass
-                    return GemCommandResult(ok=True, message=f"Gem `{n}` の画像をチャンネルにアップロードしました。", public=True)
-                try:
-                    if metrics_store is not None:
-                        metrics_store.record_gem_run(
-                            team_id=team_id, gem_name=n, user_id=user_id, public=False, ok=True
-                        )
-                except Exception:
-                    pass
-                return GemCommandResult(ok=True, message=f"Gem `{n}` の画像をDMに送信しました。", public=False)
-            except Exception as e:
-                hint = ""
-                err = type(e).__name__
-                if "missing_scope" in str(e) or "not_allowed_token_type" in str(e):
-                    hint = "\n必要スコープ: `files:write`（DM送信には `im:write`）。追加後、アプリを再インストール。"
-                try:
-                    if metrics_store is not None:
-                        metrics_store.record_gem_run(
-                            team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=False
-                        )
-                except Exception:
-                    pass
-                return GemCommandResult(ok=False, message=f"画像のアップロードに失敗しました: `{err}`{hint}")
+        return _run_gem(
+            gem=gem,
+            team_id=team_id,
+            user_id=user_id,
+            user_input=user_input,
+            public=public,
+            gemini=gemini,
+            slack_client=slack_client,
+            channel_id=channel_id,
+            metrics_store=metrics_store,
+            progress=progress,
+            defer=defer,
+        )
 
-        ok, msg = execute_ai_gem(gem=gem, user_input=user_input, gemini=gemini)
+    if sub == "batch":
+        if len(tokens) < 2:
+            return GemCommandResult(ok=False, message="使い方: `/gem batch <name> <入力（1 行 1 件 / JSON 配列 / NDJSON）>`\n\n" + _help())
+        name = tokens[1]
         try:
-            if metrics_store is not None:
-                metrics_store.record_gem_run(team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=bool(ok))
-        except Exception:
-            pass
-        return GemCommandResult(ok=ok, message=msg, public=public if ok else False)
+            n = validate_gem_name(name)
+        except ValueError as e:
+            return GemCommandResult(ok=False, message=str(e))
+        gem = store.get(team_id=team_id, name=n)
+        if not gem:
+            return GemCommandResult(ok=False, message=f"Gem **{n}** が見つかりません。`/gem list` で確認できます。")
+        # 1 行 1 件なので改行を保持したまま取り出す
+        m = re.match(r"^batch\s+[a-z0-9][a-z0-9_-]{0,31}([\s\S]*)$", raw, flags=re.I)
+        return _run_batch(
+            gem=gem,
+            team_id=team_id,
+            user_id=user_id,
+            raw_input=_strip_leading_public_flags(m.group(1) if m else ""),
+            public=public,
+            gemini=gemini,
+            slack_client=slack_client,
+            channel_id=channel_id,
+            metrics_store=metrics_store,
+            progress=progress,
+        )
 
     if sub == "list":
         gems = store.list(team_id=team_id, limit=50)
@@ -322,100 +315,506 @@ def handle_gem_command(
     gem = store.get(team_id=team_id, name=n)
     if not gem:
         return GemCommandResult(ok=False, message=f"Gem **{n}** が見つかりません。`/gem list` で確認できます。")
-    if not bool(getattr(gem, "enabled", True)):
-        try:
-            if metrics_store is not None:
-                metrics_store.record_gem_run(team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=False)
-        except Exception:
-            pass
-        return GemCommandResult(ok=False, message=f"Gem **{n}** は現在無効化されています（管理者に確認してください）。")
-    if gem.body.strip():
-        try:
-            if metrics_store is not None:
-                metrics_store.record_gem_run(team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=True)
-        except Exception:
-            pass
-        return GemCommandResult(ok=True, message=gem.body, public=public)
     # `/gem <name> ...` も、モーダル経由では改行を保持したいので raw から復元する
     user_input = _raw_input_for_default_run(raw, sub)
     if not user_input:
         user_input = " ".join(tokens[1:]).strip()
-    # 画像生成 Gem の特例ハンドリング（`/gem <name>` 形式）
+    return _run_gem(
+        gem=gem,
+        team_id=team_id,
+        user_id=user_id,
+        user_input=user_input,
+        public=public,
+        gemini=gemini,
+        slack_client=slack_client,
+        channel_id=channel_id,
+        metrics_store=metrics_store,
+        progress=progress,
+        defer=defer,
+    )
+
+
+def start_gem_command(**kwargs: Any) -> Future[GemCommandResult]:
+    """
+    handle_gem_command を呼び出し元のスレッドで生成を待たずに始める（引数は同じ）。
+    GEMINI_ASYNC=on の AI Gem（テキスト）は、生成を共有イベントループに任せてすぐ返し、終わったら Future が完了する。
+    それ以外（管理系・固定文言・画像など）はこのスレッドで実行して、完了済みの Future を返す。
+    """
+    out: Future[GemCommandResult]
+    try:
+        result = handle_gem_command(defer=True, **kwargs)
+    except Exception as e:
+        out = Future()
+        out.set_exception(e)
+        return out
+    if isinstance(result, Future):
+        return result
+    out = Future()
+    out.set_result(result)
+    return out
+
+
+async def _finish_in_thread(
+    coro: Coroutine[Any, Any, tuple[bool, str]],
+    finish: Callable[[tuple[bool, str] | None, Exception | None], GemCommandResult],
+) -> GemCommandResult:
+    # 生成はループで待ち、計測の書き込みと結果づくりは別スレッドで行う（計測先の I/O でループを塞がない）
+    try:
+        outcome = await coro
+    except Exception as e:
+        return await asyncio.to_thread(finish, None, e)
+    return await asyncio.to_thread(finish, outcome, None)
+
+
+def _record_run(
+    metrics_store,  # noqa: ANN001
+    *,
+    team_id: str,
+    gem_name: str,
+    user_id: str | None,
+    public: bool,
+    ok: bool,
+    started: float | None = None,
+    error_type: str | None = None,
+    details: dict | None = None,
+) -> None:
+    # 計測の失敗で Gem 実行を失敗させない
+    if metrics_store is None:
+        return
+    latency_ms = (time.perf_counter() - started) * 1000.0 if started is not None else None
+    try:
+        metrics_store.record_gem_run(
+            team_id=team_id,
+            gem_name=gem_name,
+            user_id=user_id,
+            public=public,
+            ok=ok,
+            latency_ms=latency_ms,
+            error_type=None if ok else (error_type or "failed"),
+            details=details or None,
+        )
+    except Exception:
+        pass
+
+
+def _run_gem(
+    *,
+    gem,
+    team_id: str,
+    user_id: str | None,
+    user_input: str,
+    public: bool,
+    gemini=None,
+    slack_client=None,
+    channel_id: str | None = None,
+    metrics_store=None,
+    progress: RunProgress | None = None,
+    defer: bool = False,
+) -> GemCommandResult | Future[GemCommandResult]:  # noqa: ANN001
+    """
+    `/gem run <name>` と `/gem <name>` 共通の実行本体（計測込み）。
+    defer=True かつ GEMINI_ASYNC=on の AI Gem（テキスト）は、共有イベントループでの生成を待たずに Future を返す。
+    """
+    n = gem.name
+    started = time.perf_counter()
+
+    def _record(
+        ok: bool, *, public: bool = public, error_type: str | None = None, details: dict | None = None
+    ) -> None:
+        _record_run(
+            metrics_store,
+            team_id=team_id,
+            gem_name=n,
+            user_id=user_id,
+            public=public,
+            ok=ok,
+            started=started,
+            error_type=error_type,
+            details=details,
+        )
+
+    if not bool(getattr(gem, "enabled", True)):
+        _record(False, error_type="disabled")
+        return GemCommandResult(ok=False, message=f"Gem **{n}** は現在無効化されています（管理者に確認してください）。")
+    if gem.body.strip():
+        _record(True)
+        return GemCommandResult(ok=True, message=gem.body, public=public)
+
+    # 画像生成 Gem の特例ハンドリング
     if (gem.output_format or "") == "image_url":
-        ok, img_bytes, mime, msg = execute_ai_image_gem(gem=gem, user_input=user_input, gemini=gemini)
+        user_input, variants, err = _pop_variants_flag(user_input)
+        if err:
+            return GemCommandResult(ok=False, message=err)
+        image_details: dict = {}
+        image_args = dict(
+            gem=gem,
+            user_input=user_input,
+            gemini=gemini,
+            flights=shared_single_flight(),
+            router=shared_model_router(),
+            limiter=shared_rate_limiter(),
+            image_cache=shared_image_cache(),
+            processor=shared_image_processor(),
+            details=image_details,
+        )
+        if variants > 1:
+            return _run_image_variants(
+                gem=gem,
+                variants=variants,
+                image_args=image_args,
+                public=public,
+                slack_client=slack_client,
+                channel_id=channel_id,
+                user_id=user_id,
+                record=_record,
+            )
+        ok, img_bytes, mime, msg = execute_ai_image_gem(**image_args)
         if not ok or not img_bytes:
-            try:
-                if metrics_store is not None:
-                    metrics_store.record_gem_run(team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=False)
-            except Exception:
-                pass
+            _record(False, error_type="image_generation_failed", details=image_details)
             return GemCommandResult(ok=False, message=msg or "画像生成に失敗しました。")
+
+        # Slack にアップロード（公開: チャンネル / 非公開: DM）
         if slack_client is None:
-            try:
-                if metrics_store is not None:
-                    metrics_store.record_gem_run(team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=True)
-            except Exception:
-                pass
-            return GemCommandResult(ok=True, message="画像を生成しましたが、Slack へのアップロード権限がありません（管理者に `files:write` 追加を依頼してください）。")
+            _record(True, details=image_details)
+            return GemCommandResult(ok=True, message=_NO_UPLOAD_SCOPE)
         try:
-            import io
-
-            filename = f"{n}.png" if (mime or "").endswith("png") else f"{n}.jpg"
-            target_channel = None
-            if public and channel_id:
-                target_channel = channel_id
-            elif user_id:
-                opened = slack_client.conversations_open(users=user_id)
-                target_channel = (opened.get("channel") or {}).get("id")
-            if not target_channel:
-                target_channel = channel_id
-
-            if hasattr(slack_client, "files_upload_v2"):
-                slack_client.files_upload_v2(
-                    channel=target_channel,
-                    filename=filename,
-                    file=io.BytesIO(img_bytes),
-                    title=f"Gem: {n}",
-                )
-            else:
-                slack_client.files_upload(
-                    channels=target_channel,
-                    filename=filename,
-                    file=io.BytesIO(img_bytes),
-                    title=f"Gem: {n}",
-                )
+            _upload_file(
+                slack_client,
+                public=public,
+                channel_id=channel_id,
+                user_id=user_id,
+                filename=f"{n}.{image_extension(mime)}",
+                file=io.BytesIO(img_bytes),
+                title=f"Gem: {n}",
+            )
             if public:
-                try:
-                    if metrics_store is not None:
-                        metrics_store.record_gem_run(team_id=team_id, gem_name=n, user_id=user_id, public=True, ok=True)
-                except Exception:
-                    pass
+                _record(True, public=True, details=image_details)
                 return GemCommandResult(ok=True, message=f"Gem `{n}` の画像をチャンネルにアップロードしました。", public=True)
-            try:
-                if metrics_store is not None:
-                    metrics_store.record_gem_run(team_id=team_id, gem_name=n, user_id=user_id, public=False, ok=True)
-            except Exception:
-                pass
+            _record(True, public=False, details=image_details)
             return GemCommandResult(ok=True, message=f"Gem `{n}` の画像をDMに送信しました。", public=False)
         except Exception as e:
-            hint = ""
             err = type(e).__name__
-            if "missing_scope" in str(e) or "not_allowed_token_type" in str(e):
-                hint = "\n必要スコープ: `files:write`（DM送信には `im:write`）。追加後、アプリを再インストール。"
-            try:
-                if metrics_store is not None:
-                    metrics_store.record_gem_run(team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=False)
-            except Exception:
-                pass
-            return GemCommandResult(ok=False, message=f"画像のアップロードに失敗しました: `{err}`{hint}")
-
-    ok, msg = execute_ai_gem(gem=gem, user_input=user_input, gemini=gemini)
+            _record(False, error_type=f"upload:{err}", details=image_details)
+            return GemCommandResult(ok=False, message=f"画像のアップロードに失敗しました: `{err}`{_upload_hint(e)}")
+
+    details: dict = {}
+    run_args = dict(
+        gem=gem,
+        user_input=user_input,
+        progress=progress,
+        cache=shared_result_cache(),
+        context_cache=shared_context_cache(),
+        flights=shared_single_flight(),
+        budget=shared_token_budget(),
+        router=shared_model_router(),
+        limiter=shared_rate_limiter(),
+        details=details,
+    )
+
+    def _text_result(outcome: tuple[bool, str] | None, error: Exception | None) -> GemCommandResult:
+        if isinstance(error, RateLimitedError):
+            # 順番待ちの上限を超えた（Gemini は呼んでいない）
+            _record(False, error_type=type(error).__name__, details=details)
+            return GemCommandResult(
+                ok=False,
+                message=f"混み合っているため実行できませんでした。約 {max(1, int(error.retry_in))} 秒後に再実行してください。",
+            )
+        if isinstance(error, (CircuitOpenError, DeadlineExceededError)):
+            # 障害中/期限切れは想定内の失敗として扱い、再実行を促す（スタックトレースは出さない）
+            _record(False, error_type=type(error).__name__, details=details)
+            if isinstance(error, CircuitOpenError):
+                wait = f"（約 {max(1, int(error.retry_in))} 秒後から再試行できます）"
+            else:
+                wait = ""
+            return GemCommandResult(
+                ok=False, message=f"Gemini が一時的に応答していません。しばらくしてから再実行してください{wait}"
+            )
+        if error is not None:
+            # 呼び出し元（Slack ハンドラ）でユーザーに通知されるので、ここでは計測だけして再送出する
+            _record(False, error_type=type(error).__name__, details=details)
+            raise error
+        ok, msg = outcome  # type: ignore[misc]
+        _record(bool(ok), error_type="gem_error", details=details)
+        return GemCommandResult(ok=ok, message=msg, public=public if ok else False)
+
+    if gemini is not None and async_enabled():
+        # Gemini の応答待ち（再試行・ヘッジ込み）は共有イベントループで行う
+        coro = execute_ai_gem_async(gemini=AsyncGeminiClient.from_client(gemini), **run_args)
+        if defer:
+            # 生成の間このスレッドを塞がない: 完了（計測込み）は返した Future で受け取る
+            return shared_background_loop().submit(_finish_in_thread(coro, _text_result))
+        # 同期の呼び出し元（バッチなど）は、このスレッドで完了を待つ
+        try:
+            outcome = run_in_background(coro)
+        except Exception as e:
+            return _text_result(None, e)
+        return _text_result(outcome, None)
     try:
-        if metrics_store is not None:
-            metrics_store.record_gem_run(team_id=team_id, gem_name=n, user_id=user_id, public=public, ok=bool(ok))
-    except Exception:
-        pass
-    return GemCommandResult(ok=ok, message=msg, public=public if ok else False)
+        outcome = execute_ai_gem(gemini=gemini, **run_args)
+    except Exception as e:
+        return _text_result(None, e)
+    return _text_result(outcome, None)
+
+
+def _upload_channel(slack_client, *, public: bool, channel_id: str | None, user_id: str | None) -> str | None:  # noqa: ANN001
+    """アップロード先（公開: チャンネル / 非公開: DM）"""
+    target_channel = None
+    if public and channel_id:
+        target_channel = channel_id
+    elif user_id:
+        # DM チャンネルを開いて個別送信
+        opened = slack_client.conversations_open(users=user_id)
+        target_channel = (opened.get("channel") or {}).get("id")
+    if not target_channel:
+        # 最後の手段として respond チャンネル（あれば）
+        target_channel = channel_id
+    return target_channel
+
+
+def _upload_file(
+    slack_client,  # noqa: ANN001
+    *,
+    public: bool,
+    channel_id: str | None,
+    user_id: str | None,
+    filename: str,
+    file,  # noqa: ANN001
+    title: str,
+    initial_comment: str | None = None,
+) -> None:
+    """Slack にファイルをアップロードする（公開: チャンネル / 非公開: DM）"""
+    target_channel = _upload_channel(slack_client, public=public, channel_id=channel_id, user_id=user_id)
+    extra = {"initial_comment": initial_comment} if initial_comment else {}
+    if hasattr(slack_client, "files_upload_v2"):
+        slack_client.files_upload_v2(channel=target_channel, filename=filename, file=file, title=title, **extra)
+    else:  # 旧API互換
+        slack_client.files_upload(channels=target_channel, filename=filename, file=file, title=title, **extra)
+
+
+def _upload_files(
+    slack_client,  # noqa: ANN001
+    *,
+    public: bool,
+    channel_id: str | None,
+    user_id: str | None,
+    files: list[dict],
+    initial_comment: str | None = None,
+) -> None:
+    """複数のファイルを 1 回のアップロードで送る（files は file / filename / title の dict。旧 API では 1 つずつ）"""
+    target_channel = _upload_channel(slack_client, public=public, channel_id=channel_id, user_id=user_id)
+    extra = {"initial_comment": initial_comment} if initial_comment else {}
+    if hasattr(slack_client, "files_upload_v2"):
+        slack_client.files_upload_v2(channel=target_channel, file_uploads=files, **extra)
+    else:  # 旧API互換
+        for i, f in enumerate(files):
+            slack_client.files_upload(channels=target_channel, **f, **(extra if i == 0 else {}))
+
+
+def _upload_hint(e: Exception) -> str:
+    if "missing_scope" in str(e) or "not_allowed_token_type" in str(e):
+        return "\n必要スコープ: `files:write`（DM送信には `im:write`）。追加後、アプリを再インストール。"
+    return ""
+
+
+_NO_UPLOAD_SCOPE = "画像を生成しましたが、Slack へのアップロード権限がありません（管理者に `files:write` 追加を依頼してください）。"
+
+# `--variants N` / `--variants=N`（画像 Gem の入力のどこにあってもよい）
+_VARIANTS_FLAG = re.compile(r"(?:^|\s)--variants(?:=|\s+)(\S+)")
+
+
+def _pop_variants_flag(user_input: str) -> tuple[str, int, str | None]:
+    """画像 Gem の入力から `--variants N` を取り除く。(残りの入力, 枚数, エラーメッセージ)"""
+    m = _VARIANTS_FLAG.search(user_input or "")
+    if not m:
+        return user_input, 1, None
+    rest = _strip_leading_public_flags(user_input[: m.start()] + " " + user_input[m.end() :])
+    limit = max_image_variants()
+    try:
+        variants = int(m.group(1))
+    except ValueError:
+        variants = 0
+    if not 1 <= variants <= limit:
+        return rest, 1, f"`--variants` には 1〜{limit} の数を指定してください。"
+    return rest, variants, None
+
+
+def _run_image_variants(
+    *,
+    gem,
+    variants: int,
+    image_args: dict,
+    public: bool,
+    slack_client,
+    channel_id: str | None,
+    user_id: str | None,
+    record,
+) -> GemCommandResult:  # noqa: ANN001
+    """`--variants N`: 画像を N 枚同時に生成し、できた分を 1 回のアップロードでまとめて送る"""
+    n = gem.name
+    details: dict = image_args["details"]
+    results = execute_ai_image_variants(variants=variants, **image_args)
+    images = [(i, b, mime) for i, (ok, b, mime, _) in enumerate(results) if ok and b]
+    failures = [(i, msg or "画像生成に失敗しました。") for i, (ok, b, _, msg) in enumerate(results) if not (ok and b)]
+    if not images:
+        record(False, error_type="image_generation_failed", details=details)
+        return GemCommandResult(ok=False, message=failures[0][1])
+
+    note = ""
+    if failures:
+        lines = [f"- #{i + 1}: {msg[:200]}" for i, msg in failures]
+        note = f"\n{len(failures)} 枚は生成できませんでした:\n" + "\n".join(lines)
+    if slack_client is None:
+        record(True, details=details)
+        return GemCommandResult(ok=True, message=_NO_UPLOAD_SCOPE + note)
+    try:
+        _upload_files(
+            slack_client,
+            public=public,
+            channel_id=channel_id,
+            user_id=user_id,
+            files=[
+                {"file": io.BytesIO(b), "filename": f"{n}-{i + 1}.{image_extension(mime)}", "title": f"Gem: {n}（{i + 1}/{variants}）"}
+                for i, b, mime in images
+            ],
+        )
+    except Exception as e:
+        err = type(e).__name__
+        record(False, error_type=f"upload:{err}", details=details)
+        return GemCommandResult(ok=False, message=f"画像のアップロードに失敗しました: `{err}`{_upload_hint(e)}{note}")
+    record(True, public=public, details=details)
+    where = "チャンネルにアップロードしました" if public else "DMに送信しました"
+    return GemCommandResult(ok=True, message=f"Gem `{n}` の画像 {len(images)}/{variants} 枚を{where}。{note}", public=public)
+
+
+def prepare_batch(gem, raw_input: str, *, max_items: int) -> tuple[list[str], str | None]:  # noqa: ANN001
+    """バッチ実行できる Gem か確認し、入力を 1 件ずつに分ける。(items, エラーメッセージ)"""
+    if (gem.output_format or "") == "image_url":
+        return [], "画像生成 Gem はバッチ実行に対応していません。"
+    items = split_batch_input(raw_input)
+    if not items:
+        return [], "入力が空です。1 行に 1 件、または JSON 配列 / NDJSON で渡してください。"
+    if len(items) > max_items:
+        return [], f"バッチの件数が多すぎます（{len(items)} 件）。1 回 {max_items} 件までにしてください。"
+    return items, None
+
+
+def iter_gem_batch(
+    *,
+    gem,
+    team_id: str,
+    user_id: str | None,
+    items: list[str],
+    gemini=None,
+    metrics_store=None,
+    runner: BatchRunner | None = None,
+) -> Iterator[BatchItemResult]:  # noqa: ANN001
+    """各入力で Gem を実行し、完了した順に結果を返す（1 件ずつ通常の実行として計測される）"""
+
+    def _one(item: str) -> tuple[bool, str]:
+        r = _run_gem(
+            gem=gem,
+            team_id=team_id,
+            user_id=user_id,
+            user_input=item,
+            public=False,
+            gemini=gemini,
+            metrics_store=metrics_store,
+        )
+        return r.ok, r.message
+
+    return (runner or shared_batch_runner()).run(team_id=team_id, items=items, fn=_one)
+
+
+def _run_batch(
+    *,
+    gem,
+    team_id: str,
+    user_id: str | None,
+    raw_input: str,
+    public: bool,
+    gemini=None,
+    slack_client=None,
+    channel_id: str | None = None,
+    metrics_store=None,
+    progress: RunProgress | None = None,
+) -> GemCommandResult:  # noqa: ANN001
+    """`/gem batch <name>`: 全件の結果を NDJSON ファイル 1 つにまとめて返す"""
+    n = gem.name
+    runner = shared_batch_runner()
+    items, err = prepare_batch(gem, raw_input, max_items=runner.max_items)
+    if err:
+        return GemCommandResult(ok=False, message=err)
+    if not bool(getattr(gem, "enabled", True)):
+        return GemCommandResult(ok=False, message=f"Gem **{n}** は現在無効化されています（管理者に確認してください）。")
+
+    total = len(items)
+    if progress is not None:
+        try:
+            progress.started(gem_name=n)
+        except Exception as e:
+            print(f"[gem] progress start failed: {type(e).__name__} {e}")
+
+    ok_count = 0
+    failures: list[BatchItemResult] = []
+    # 結果はメモリに溜めず、届いた順にファイルへ書き出す
+    fd, path = tempfile.mkstemp(prefix=f"gem-batch-{n}-", suffix=".ndjson")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for res in iter_gem_batch(
+                gem=gem,
+                team_id=team_id,
+                user_id=user_id,
+                items=items,
+                gemini=gemini,
+                metrics_store=metrics_store,
+                runner=runner,
+            ):
+                f.write(json.dumps(res.to_dict(), ensure_ascii=False) + "\n")
+                f.flush()
+                if res.ok:
+                    ok_count += 1
+                else:
+                    failures.append(res)
+                if progress is not None:
+                    try:
+                        progress.partial(
+                            f"⏳ Gem `{n}` をバッチ実行中: {ok_count + len(failures)}/{total}"
+                            f"（成功 {ok_count} / 失敗 {len(failures)}）"
+                        )
+                    except Exception as e:
+                        print(f"[gem] progress update failed: {type(e).__name__} {e}")
+
+        summary = f"Gem `{n}` のバッチ実行が完了しました: 成功 {ok_count} / 失敗 {len(failures)}（全 {total} 件）"
+        if failures:
+            failures.sort(key=lambda r: r.index)
+            lines = [f"- #{r.index + 1}: {r.output[:200]}" for r in failures[:3]]
+            if len(failures) > 3:
+                lines.append(f"- ほか {len(failures) - 3} 件")
+            summary += "\n失敗した入力:\n" + "\n".join(lines)
+        ok = ok_count > 0
+        if slack_client is None:
+            return GemCommandResult(ok=ok, message=summary, public=public if ok else False)
+        try:
+            _upload_file(
+                slack_client,
+                public=public and ok,
+                channel_id=channel_id,
+                user_id=user_id,
+                filename=f"{n}-batch.ndjson",
+                file=path,
+                title=f"Gem: {n}（バッチ {total} 件）",
+            )
+        except Exception as e:
+            return GemCommandResult(
+                ok=False, message=f"{summary}\n結果ファイルのアップロードに失敗しました: `{type(e).__name__}`{_upload_hint(e)}"
+            )
+        where = "チャンネル" if public and ok else "DM"
+        return GemCommandResult(ok=ok, message=f"{summary}\n結果（NDJSON）を{where}に送信しました。", public=public if ok else False)
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
 
 
 def _help() -> str:
@@ -426,10 +825,14 @@ def _help() -> str:
         "- `/gem create <name>`: モーダルで AI Gem定義を作成/更新\n"
         "- `/gem <name>` または `/gem run <name>`: Gem実行（静的Gemはbodyを返す）\n"
         "  - 入力が長い場合は `run <name>`（入力なし）でモーダルから複数行入力できます\n"
+        "- `/gem batch <name> <入力...>`: 1 行 1 件（または JSON 配列 / NDJSON）の入力それぞれで実行し、結果をファイルで返す\n"
         "- `/gem show <name>`: Gem定義の表示\n"
         "- `/gem list`: 一覧\n"
         "- `/gem delete <name>`: 削除\n"
         "- オプション: `--public`（実行結果をチャンネルに公開）\n"
+        "- 画像 Gem のオプション: `--variants <枚数>`（同じ入力で複数枚を同時に生成してまとめて送る）\n"
+        "- 作成時オプション: `--no-cache`（同じ入力でも毎回生成し直す）\n"
+        "- 生成設定: `--model <モデル名>` `--thinking <トークン数|0|-1>` `--temperature <0〜2>` `--max-tokens <数>` `--slo <ms>`（省略時は既定）\n"
         "\n"
         "例:\n"
         "- `/gem create hello おはようございます！`\n"
@@ -449,6 +852,22 @@ def _format_gem_definition(gem) -> str:  # noqa: ANN001
         parts.append(f"*入力形式*: {label_for_input(gem.input_format)}\n```{gem.input_format}```")
     if gem.output_format:
         parts.append(f"*出力形式*: {label_for_output(gem.output_format)}\n```{gem.output_format}```")
+    if not bool(getattr(gem, "cache_results", True)):
+        parts.append("*結果キャッシュ*: 無効（毎回生成）")
+    gen = getattr(gem, "generation", None)
+    if gen is not None and not gen.is_default():
+        items = []
+        if gen.model:
+            items.append(f"model=`{gen.model}`")
+        if gen.thinking_budget is not None:
+            items.append(f"thinking=`{gen.thinking_budget}`")
+        if gen.temperature is not None:
+            items.append(f"temperature=`{gen.temperature:g}`")
+        if gen.max_output_tokens is not None:
+            items.append(f"max_tokens=`{gen.max_output_tokens}`")
+        if gen.latency_slo_ms is not None:
+            items.append(f"slo=`{gen.latency_slo_ms}ms`")
+        parts.append("*生成設定*: " + " ".join(items))
     if gem.body:
         parts.append("*（互換）静的テキスト*:\n```" + gem.body + "```")
     parts.append("\n実行ロジック（AI API 呼び出し）はこれから追加できます。")
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Awaitable, Callable, TypeVar
+
+from ..config import Shared
+
+T = TypeVar("T")
+
+
+class _Flight:
+    __slots__ = ("future", "followers")
+
+    def __init__(self) -> None:
+        # スレッドからもイベントループからも待てるよう concurrent.futures.Future で結果を渡す
+        self.future: Future = Future()
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    同じキーの実行が同時に走っている間は、後から来た呼び出しを先行の結果待ちにする（single-flight）。
+
+    - 最初の呼び出し（leader）だけが fn を実行し、結果または例外を待っていた全員（follower）に渡す
+    - 完了したキーはすぐ忘れる（結果の再利用は ResultCache の役目）
+    ※ プロセス内のみ
+    """
+
+    def __init__(self, *, wait_timeout: float = 300.0) -> None:
+        self.wait_timeout = max(1.0, float(wait_timeout))
+        self._lock = threading.Lock()
+        self._flights: dict[str, _Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def _join(self, key: str) -> tuple[_Flight, bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+                return flight, True
+            flight.followers += 1
+            self.followers += 1
+            return flight, False
+
+    def _settle(self, key: str, flight: _Flight, result: object = None, error: BaseException | None = None) -> None:
+        with self._lock:
+            self._flights.pop(key, None)
+        if error is not None:
+            flight.future.set_exception(error)
+        else:
+            flight.future.set_result(result)
+
+    def do(self, key: str, fn: Callable[[], T]) -> tuple[T, bool]:
+        """(結果, 先行の実行を共有したか) を返す。先行が例外で終わった場合は同じ例外を送出する"""
+        flight, leader = self._join(key)
+        if not leader:
+            try:
+                return flight.future.result(timeout=self.wait_timeout), True
+            except FutureTimeoutError:
+                raise TimeoutError(f"coalesced run did not finish within {self.wait_timeout:.0f}s") from None
+
+        try:
+            result = fn()
+        except BaseException as e:
+            self._settle(key, flight, error=e)
+            raise
+        self._settle(key, flight, result)
+        return result, False
+
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[T]]) -> tuple[T, bool]:
+        """do のイベントループ版。同じキーならスレッド側の実行とも相乗りする"""
+        flight, leader = self._join(key)
+        if not leader:
+            try:
+                # shield: 待つ側が取り消されても先行の実行（他の待ち手の分）は取り消さない
+                fut = asyncio.shield(asyncio.wrap_future(flight.future))
+                return await asyncio.wait_for(fut, self.wait_timeout), True
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"coalesced run did not finish within {self.wait_timeout:.0f}s") from None
+
+        try:
+            result = await fn()
+        except BaseException as e:
+            self._settle(key, flight, error=e)
+            raise
+        self._settle(key, flight, result)
+        return result, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.leaders + self.followers
+            return {
+                "in_flight": len(self._flights),
+                "upstream_calls": self.leaders,
+                "coalesced": self.followers,
+                "coalesce_rate": round(self.followers / total, 4) if total else 0.0,
+            }
+
+
+_shared: Shared[SingleFlight] = Shared()
+
+
+def shared_single_flight() -> SingleFlight | None:
+    """
+    プロセス内で共有する single-flight（無効なら None）。
+    - `GEM_SINGLE_FLIGHT`: `on`（既定）/ `off`
+    """
+    if (os.environ.get("GEM_SINGLE_FLIGHT") or "on").strip().lower() in ("off", "0", "false", "none"):
+        return None
+    return _shared.get(SingleFlight)
@@ -3,11 +3,13 @@ from __future__ import annotations
 import os
 import re
 from abc import ABC, abstractmethod
+from dataclasses import replace
 from datetime import datetime, timezone
 
-from .models import Gem
+from .models import Gem, GenerationConfig
 
 _NAME_RE = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
+_MODEL_RE = re.compile(r"^[a-z0-9][a-z0-9._-]{0,63}$")
 
 
 def validate_gem_name(name: str) -> str:
@@ -17,6 +19,49 @@ def validate_gem_name(name: str) -> str:
     return n
 
 
+def parse_generation_config(
+    *,
+    model: str = "",
+    thinking_budget: str = "",
+    temperature: str = "",
+    max_output_tokens: str = "",
+    latency_slo_ms: str = "",
+) -> GenerationConfig:
+    """Slack の入力（文字列）から生成設定を作る。空欄は既定のまま"""
+    m = model.strip().lower()
+    if m.startswith("models/"):
+        m = m[len("models/") :]
+    if m and not _MODEL_RE.match(m):
+        raise ValueError("モデル名は `gemini-2.5-flash` のように指定してください")
+
+    def _int(raw: str, label: str, lo: int, hi: int) -> int | None:
+        if not raw.strip():
+            return None
+        try:
+            v = int(raw.strip())
+        except ValueError:
+            raise ValueError(f"{label}は整数で指定してください") from None
+        if not lo <= v <= hi:
+            raise ValueError(f"{label}は {lo}〜{hi} で指定してください")
+        return v
+
+    temp: float | None = None
+    if temperature.strip():
+        try:
+            temp = float(temperature.strip())
+        except ValueError:
+            raise ValueError("temperature は数値で指定してください（例: 0.7）") from None
+        if not 0.0 <= temp <= 2.0:
+            raise ValueError("temperature は 0〜2 で指定してください")
+    return GenerationConfig(
+        model=m,
+        thinking_budget=_int(thinking_budget, "thinking budget", -1, 32768),
+        temperature=temp,
+        max_output_tokens=_int(max_output_tokens, "最大出力トークン数", 1, 65536),
+        latency_slo_ms=_int(latency_slo_ms, "目標応答時間（ms）", 100, 600000),
+    )
+
+
 class GemStore(ABC):
     @abstractmethod
     def upsert(
@@ -30,6 +75,8 @@ class GemStore(ABC):
         input_format: str = "",
         output_format: str = "",
         enabled: bool | None = None,
+        cache_results: bool | None = None,
+        generation: GenerationConfig | None = None,
         created_by: str | None,
     ) -> Gem:
         raise NotImplementedError
@@ -57,6 +104,17 @@ class GemStore(ABC):
     ) -> Gem | None:
         raise NotImplementedError
 
+    @abstractmethod
+    def set_cache_results(
+        self,
+        *,
+        team_id: str,
+        name: str,
+        cache_results: bool,
+        updated_by: str | None,
+    ) -> Gem | None:
+        raise NotImplementedError
+
 
 class InMemoryGemStore(GemStore):
     def __init__(self) -> None:
@@ -73,12 +131,16 @@ class InMemoryGemStore(GemStore):
         input_format: str = "",
         output_format: str = "",
         enabled: bool | None = None,
+        cache_results: bool | None = None,
+        generation: GenerationConfig | None = None,
         created_by: str | None,
     ) -> Gem:
         n = validate_gem_name(name)
         now = datetime.now(timezone.utc)
         existing = self._data.get((team_id, n))
         eff_enabled = enabled if enabled is not None else (existing.enabled if existing else True)
+        eff_cache = cache_results if cache_results is not None else (existing.cache_results if existing else True)
+        eff_generation = generation if generation is not None else (existing.generation if existing else GenerationConfig())
         gem = Gem(
             team_id=team_id,
             name=n,
@@ -91,6 +153,8 @@ class InMemoryGemStore(GemStore):
             created_by=created_by,
             created_at=now,
             updated_at=now,
+            cache_results=eff_cache,
+            generation=eff_generation,
         )
         self._data[(team_id, n)] = gem
         return gem
@@ -133,10 +197,28 @@ class InMemoryGemStore(GemStore):
             created_by=g.created_by,
             created_at=g.created_at,
             updated_at=now,
+            cache_results=g.cache_results,
+            generation=g.generation,
         )
         self._data[(team_id, n)] = ng
         return ng
 
+    def set_cache_results(
+        self,
+        *,
+        team_id: str,
+        name: str,
+        cache_results: bool,
+        updated_by: str | None,
+    ) -> Gem | None:
+        n = validate_gem_name(name)
+        g = self._data.get((team_id, n))
+        if not g:
+            return None
+        ng = replace(g, cache_results=bool(cache_results), updated_at=datetime.now(timezone.utc))
+        self._data[(team_id, n)] = ng
+        return ng
+
 
 class FirestoreGemStore(GemStore):
     def __init__(self, *, project_id: str | None = None) -> None:
@@ -178,6 +260,8 @@ class FirestoreGemStore(GemStore):
         input_format: str = "",
         output_format: str = "",
         enabled: bool | None = None,
+        cache_results: bool | None = None,
+        generation: GenerationConfig | None = None,
         created_by: str | None,
     ) -> Gem:
         ref = self._doc_ref(team_id=team_id, name=name)
@@ -197,6 +281,10 @@ class FirestoreGemStore(GemStore):
         }
         if enabled is not None:
             payload["enabled"] = bool(enabled)
+        if cache_results is not None:
+            payload["cache_results"] = bool(cache_results)
+        if generation is not None:
+            payload["generation"] = generation.to_dict()
         ref.set(payload, merge=True)
         return Gem(
             team_id=team_id,
@@ -210,6 +298,9 @@ class FirestoreGemStore(GemStore):
             created_by=created_by,
             created_at=now,
             updated_at=now,
+            cache_results=bool(payload.get("cache_results", True)),
+            # 未指定なら保存済みの値が残る（正確な値は get で読み直す）
+            generation=generation or GenerationConfig(),
         )
 
     def get(self, *, team_id: str, name: str) -> Gem | None:
@@ -236,6 +327,8 @@ class FirestoreGemStore(GemStore):
             created_by=d.get("created_by"),
             created_at=created_at,
             updated_at=updated_at,
+            cache_results=bool(d.get("cache_results", True)),
+            generation=GenerationConfig.from_dict(d.get("generation")),
         )
 
     def delete(self, *, team_id: str, name: str) -> bool:
@@ -272,6 +365,8 @@ class FirestoreGemStore(GemStore):
                     created_by=d.get("created_by"),
                     created_at=created_at,
                     updated_at=updated_at,
+                    cache_results=bool(d.get("cache_results", True)),
+                    generation=GenerationConfig.from_dict(d.get("generation")),
                 )
             )
         return out
@@ -296,6 +391,24 @@ class FirestoreGemStore(GemStore):
         # 返り値は最新を読み直す（正確性優先）
         return self.get(team_id=team_id, name=name)
 
+    def set_cache_results(
+        self,
+        *,
+        team_id: str,
+        name: str,
+        cache_results: bool,
+        updated_by: str | None,
+    ) -> Gem | None:
+        ref = self._doc_ref(team_id=team_id, name=name)
+        snap = ref.get()
+        if not snap.exists:
+            return None
+        payload = {"cache_results": bool(cache_results), "updated_at": datetime.now(timezone.utc)}
+        if updated_by:
+            payload["updated_by"] = str(updated_by)
+        ref.set(payload, merge=True)
+        return self.get(team_id=team_id, name=name)
+
 
 def build_store() -> GemStore:
     """
@@ -1,16 +1,36 @@
 from .store import (  # noqa: F401
+    DelegatingMetricsStore,
+    GemUsageReport,
     GemUsageSummary,
     InMemoryMetricsStore,
     MetricsStore,
     NoopMetricsStore,
     build_metrics_store,
 )
+from .live import LiveFeedMetricsStore, LiveUsageRing, build_live_usage_ring  # noqa: F401
+from .runlog import RunEvent, RunEventLog, RunLogMetricsStore, build_run_event_log  # noqa: F401
+from .spool import MetricsSpool, SpooledMetricsStore  # noqa: F401
+from .retention import CompactionResult, RetentionPolicy, load_retention_policy  # noqa: F401
 
 __all__ = [
+    "CompactionResult",
+    "DelegatingMetricsStore",
+    "GemUsageReport",
     "GemUsageSummary",
     "InMemoryMetricsStore",
+    "LiveFeedMetricsStore",
+    "LiveUsageRing",
+    "MetricsSpool",
     "MetricsStore",
     "NoopMetricsStore",
+    "RetentionPolicy",
+    "RunEvent",
+    "RunEventLog",
+    "RunLogMetricsStore",
+    "SpooledMetricsStore",
+    "build_live_usage_ring",
     "build_metrics_store",
+    "build_run_event_log",
+    "load_retention_policy",
 ]
 
@@ -0,0 +1,51 @@
+"""
+メトリクスの運用タスク（Cloud Run Jobs / Cloud Scheduler からの定期実行を想定）。
+
+例:
+    python -m gemsrack.metrics compact --team-id T0123456789 --older-than-days 400
+    python -m gemsrack.metrics compact --dry-run
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+
+from .store import build_metrics_store
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m gemsrack.metrics")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_compact = sub.add_parser("compact", help="古い日次行を月次ロールアップに畳んで削除する")
+    p_compact.add_argument(
+        "--team-id",
+        action="append",
+        help="対象の team_id（複数指定可）。未指定なら GEMSRACK_TEAM_ID",
+    )
+    p_compact.add_argument("--older-than-days", type=int, default=None)
+    p_compact.add_argument("--dry-run", action="store_true")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "compact":
+        team_ids = args.team_id or [
+            (os.environ.get("GEMSRACK_TEAM_ID") or os.environ.get("GEMSRACK_DEFAULT_TEAM_ID") or "local")
+        ]
+        store = build_metrics_store()
+        total_docs = total_bytes = 0
+        for team_id in team_ids:
+            result = store.compact(team_id=team_id, older_than_days=args.older_than_days, dry_run=args.dry_run)
+            total_docs += result.documents_deleted
+            total_bytes += result.bytes_reclaimed
+            print(json.dumps(result.to_dict(), ensure_ascii=False))
+        print(f"[metrics] compact done: documents_deleted={total_docs} bytes_reclaimed~={total_bytes}")
+        return 0
+
+    return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import heapq
+
+# (team, day) あたりに保持するユーザー数の上限（Firestore の 1 ドキュメントに収まる大きさに抑える）
+TEAM_USERS_CAPACITY = 200
+GEM_USERS_CAPACITY = 32
+
+
+class HeavyHitters:
+    """
+    Space-Saving による上限付きカウンタ（ユーザー別の実行回数用）。
+
+    容量を超えて新しいキーが来たら最小カウントのキーを追い出し、
+    新しいキーは「追い出したカウント + 加算分」から始める。
+    そのためカウントは過大評価になり得るが、誤差は `floor`（追い出した最大カウント）以下に収まる。
+    """
+
+    __slots__ = ("capacity", "counts", "floor")
+
+    def __init__(self, capacity: int, counts: dict[str, int] | None = None, floor: int = 0) -> None:
+        self.capacity = max(1, int(capacity))
+        self.counts: dict[str, int] = dict(counts or {})
+        self.floor = int(floor)
+        while len(self.counts) > self.capacity:
+            self._evict_min()
+
+    def add(self, key: str, n: int = 1) -> None:
+        if key in self.counts:
+            self.counts[key] += n
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[key] = n
+            return
+        m = self._evict_min()
+        self.counts[key] = m + n
+
+    def merge(self, other: "HeavyHitters | dict[str, int]") -> None:
+        items = other.counts if isinstance(other, HeavyHitters) else other
+        for k, v in sorted(items.items(), key=lambda kv: kv[1], reverse=True):
+            self.add(k, int(v))
+        if isinstance(other, HeavyHitters):
+            self.floor = max(self.floor, other.floor)
+
+    def top(self, n: int) -> list[tuple[str, int]]:
+        return heapq.nlargest(max(0, n), self.counts.items(), key=lambda kv: kv[1])
+
+    def _evict_min(self) -> int:
+        k, m = min(self.counts.items(), key=lambda kv: kv[1])
+        del self.counts[k]
+        self.floor = max(self.floor, m)
+        return m
+
+
+def merge_top_users(maps: list[tuple[dict[str, int], int]], limit: int) -> dict:
+    """
+    日別のマップ [(counts, floor), ...] を合算して上位 limit 件を返す。
+    範囲全体の誤差上限は各日の floor の合計。
+    """
+    total: dict[str, int] = {}
+    error_bound = 0
+    for counts, floor in maps:
+        error_bound += int(floor or 0)
+        for k, v in counts.items():
+            total[k] = total.get(k, 0) + int(v)
+    top = heapq.nlargest(max(1, limit), total.items(), key=lambda kv: kv[1])
+    return {
+        "users": [{"user_id": k, "count": v} for k, v in top],
+        "distinct_users_tracked": len(total),
+        "approximate": error_bound > 0,
+        "error_bound": error_bound,
+    }
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from .store import DelegatingMetricsStore, MetricsStore
+
+
+class _Bucket:
+    __slots__ = ("start", "count", "public_count", "ok_count", "error_count", "gems", "version")
+
+    def __init__(self, start: int) -> None:
+        self.start = start
+        self.count = 0
+        self.public_count = 0
+        self.ok_count = 0
+        self.error_count = 0
+        self.gems: dict[str, int] = {}
+        self.version = 0
+
+    def to_dict(self, bucket_seconds: int) -> dict:
+        return {
+            "start": datetime.fromtimestamp(self.start * bucket_seconds, tz=timezone.utc).isoformat(),
+            "count": self.count,
+            "public_count": self.public_count,
+            "ok_count": self.ok_count,
+            "error_count": self.error_count,
+            "gems": dict(self.gems),
+        }
+
+
+class LiveUsageRing:
+    """
+    チーム別の固定長リングバッファ（既定: 1 分バケット × 180 = 直近 3 時間）。
+
+    record_gem_run から加算され、更新のたびに全体の version が進む。
+    SSE の各接続は「前回見た version より新しいバケット」だけを読むので、
+    タブがいくつ開いていても集計はこの 1 つを共有する。
+    ※ プロセス内のみ（Cloud Run で複数インスタンスの場合はインスタンスごと）。
+    """
+
+    def __init__(self, *, bucket_seconds: int = 60, size: int = 180, max_gems_per_bucket: int = 50) -> None:
+        self.bucket_seconds = max(1, int(bucket_seconds))
+        self.size = max(1, int(size))
+        self._max_gems = max(1, int(max_gems_per_bucket))
+        self._rings: dict[str, list[_Bucket | None]] = {}
+        self._version = 0
+        self._cond = threading.Condition()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def record(self, *, team_id: str, gem_name: str, public: bool, ok: bool, occurred_at: datetime | None = None) -> None:
+        ts = (occurred_at or datetime.now(timezone.utc)).timestamp()
+        idx = int(ts // self.bucket_seconds)
+        with self._cond:
+            ring = self._rings.get(team_id)
+            if ring is None:
+                ring = [None] * self.size
+                self._rings[team_id] = ring
+            slot = idx % self.size
+            b = ring[slot]
+            if b is None or b.start != idx:
+                if b is not None and b.start > idx:
+                    # リングより古いイベント（遅延記録など）は捨てる
+                    return
+                b = _Bucket(idx)
+                ring[slot] = b
+            b.count += 1
+            b.public_count += 1 if public else 0
+            b.ok_count += 1 if ok else 0
+            b.error_count += 0 if ok else 1
+            if gem_name in b.gems or len(b.gems) < self._max_gems:
+                b.gems[gem_name] = b.gems.get(gem_name, 0) + 1
+            else:
+                b.gems["(other)"] = b.gems.get("(other)", 0) + 1
+            self._version += 1
+            b.version = self._version
+            self._cond.notify_all()
+
+    def snapshot(self, *, team_id: str, since_version: int = 0) -> tuple[int, list[dict]]:
+        """since_version より後に更新されたバケット（リング内のみ、古い順）と現在の version を返す"""
+        now_idx = int(time.time() // self.bucket_seconds)
+        with self._cond:
+            ring = self._rings.get(team_id) or []
+            buckets = [
+                b
+                for b in ring
+                if b is not None and b.version > since_version and now_idx - b.start < self.size
+            ]
+            buckets.sort(key=lambda b: b.start)
+            return self._version, [b.to_dict(self.bucket_seconds) for b in buckets]
+
+    def wait_for_change(self, *, since_version: int, timeout: float) -> int:
+        with self._cond:
+            if self._version == since_version:
+                self._cond.wait(timeout=timeout)
+            return self._version
+
+
+def build_live_usage_ring() -> LiveUsageRing:
+    """
+    - `GEM_METRICS_LIVE_BUCKET_SECONDS`: バケット幅（既定 60 = 分。3600 で時間単位）
+    - `GEM_METRICS_LIVE_BUCKETS`: バケット数（既定 180）
+    """
+
+    def _int(name: str, default: int) -> int:
+        try:
+            return int((os.environ.get(name) or "").strip() or default)
+        except ValueError:
+            return default
+
+    return LiveUsageRing(
+        bucket_seconds=_int("GEM_METRICS_LIVE_BUCKET_SECONDS", 60),
+        size=_int("GEM_METRICS_LIVE_BUCKETS", 180),
+    )
+
+
+class LiveFeedMetricsStore(DelegatingMetricsStore):
+    """record_gem_run を LiveUsageRing にも流す薄いラッパー（それ以外は内側のストアに委譲）"""
+
+    def __init__(self, inner: MetricsStore, live: LiveUsageRing) -> None:
+        super().__init__(inner)
+        self.live = live
+
+    def record_gem_run(
+        self,
+        *,
+        team_id: str,
+        gem_name: str,
+        user_id: str | None,
+        public: bool,
+        ok: bool,
+        occurred_at: datetime | None = None,
+        latency_ms: float | None = None,
+        error_type: str | None = None,
+        details: dict | None = None,
+    ) -> None:
+        # ライブ表示は永続化の成否に依存させない（先に加算）
+        try:
+            self.live.record(team_id=team_id, gem_name=gem_name, public=public, ok=ok, occurred_at=occurred_at)
+        except Exception as e:
+            print(f"[metrics] live record failed: {type(e).__name__} {e}")
+        super().record_gem_run(
+            team_id=team_id,
+            gem_name=gem_name,
+            user_id=user_id,
+            public=public,
+            ok=ok,
+            occurred_at=occurred_at,
+            latency_ms=latency_ms,
+            error_type=error_type,
+            details=details,
+        )
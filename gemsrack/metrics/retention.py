@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import sys
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+
+from ..config import env_int
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    # これより古い日次行は月次ロールアップ（YYYY-MM）に畳んで削除する。
+    # Admin の集計範囲（最大 365 日）を削らないよう、既定は 400 日。
+    daily_retention_days: int = 400
+    # Firestore の 1 バッチで処理する日次ドキュメント数（ロールアップ書き込み + 削除で最大 2 倍の操作数）
+    batch_size: int = 200
+    # InMemory の日次行の上限（超えたら最古日から月次に畳む）
+    max_memory_rows: int = 100_000
+
+
+@dataclass(frozen=True)
+class CompactionResult:
+    team_id: str
+    cutoff_date: str  # YYYY-MM-DD（この日付より前が対象）
+    dry_run: bool
+    rows_compacted: int
+    months_touched: int
+    documents_written: int
+    documents_deleted: int
+    bytes_reclaimed: int  # 推定値
+
+    def to_dict(self) -> dict:
+        return {
+            "team_id": self.team_id,
+            "cutoff_date": self.cutoff_date,
+            "dry_run": self.dry_run,
+            "rows_compacted": self.rows_compacted,
+            "months_touched": self.months_touched,
+            "documents_written": self.documents_written,
+            "documents_deleted": self.documents_deleted,
+            "bytes_reclaimed": self.bytes_reclaimed,
+        }
+
+
+def load_retention_policy() -> RetentionPolicy:
+    """
+    環境変数で上書きできる:
+    - `GEM_METRICS_DAILY_RETENTION_DAYS`
+    - `GEM_METRICS_COMPACT_BATCH_SIZE`
+    - `GEM_METRICS_MEMORY_MAX_ROWS`
+    """
+    d = RetentionPolicy()
+    return RetentionPolicy(
+        daily_retention_days=max(1, env_int("GEM_METRICS_DAILY_RETENTION_DAYS", d.daily_retention_days)),
+        batch_size=max(1, min(env_int("GEM_METRICS_COMPACT_BATCH_SIZE", d.batch_size), 250)),
+        max_memory_rows=max(1, env_int("GEM_METRICS_MEMORY_MAX_ROWS", d.max_memory_rows)),
+    )
+
+
+def compaction_cutoff(older_than_days: int, *, today: date | None = None) -> date:
+    # 当日分は常に残す（最低 1 日）
+    today = today or date.today()
+    return today - timedelta(days=max(1, int(older_than_days)))
+
+
+def month_of(d: str) -> str:
+    return d[:7]
+
+
+def estimate_firestore_doc_bytes(path: list[str], data: dict) -> int:
+    """
+    Firestore のストレージサイズ計算規則に沿った概算。
+    ドキュメント名（各セグメント長+1 と 16） + フィールド（名前長+1 と値） + 32。
+    """
+    size = 16 + sum(len(p.encode("utf-8")) + 1 for p in path)
+    for k, v in data.items():
+        size += len(str(k).encode("utf-8")) + 1 + _firestore_value_bytes(v)
+    return size + 32
+
+
+def estimate_python_bytes(*objs: object) -> int:
+    """InMemory 側の概算（コンテナとその直下の要素のみ）"""
+    total = 0
+    for o in objs:
+        total += sys.getsizeof(o)
+        if isinstance(o, tuple):
+            total += sum(sys.getsizeof(x) for x in o)
+        elif isinstance(o, dict):
+            total += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in o.items())
+        elif hasattr(o, "__dataclass_fields__"):
+            total += sum(sys.getsizeof(getattr(o, f)) for f in o.__dataclass_fields__)  # type: ignore[attr-defined]
+    return total
+
+
+def _firestore_value_bytes(v: object) -> int:
+    if v is None or isinstance(v, bool):
+        return 1
+    if isinstance(v, (int, float, datetime)):
+        return 8
+    if isinstance(v, str):
+        return len(v.encode("utf-8")) + 1
+    return 8
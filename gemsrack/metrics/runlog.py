@@ -0,0 +1,472 @@
+from __future__ import annotations
+
+import atexit
+import bisect
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from .store import DelegatingMetricsStore, MetricsStore
+
+
+@dataclass(frozen=True)
+class RunEvent:
+    ts: datetime
+    team_id: str
+    gem_name: str
+    user_id: str | None
+    public: bool
+    ok: bool
+    latency_ms: float | None
+    error_type: str | None
+    details: dict | None = None
+
+    def to_dict(self) -> dict:
+        out = {
+            "ts": self.ts.isoformat(),
+            "team_id": self.team_id,
+            "gem_name": self.gem_name,
+            "user_id": self.user_id,
+            "public": self.public,
+            "ok": self.ok,
+            "latency_ms": self.latency_ms,
+            "error_type": self.error_type,
+        }
+        if self.details:
+            out["details"] = self.details
+        return out
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "RunEvent":
+        ts = d.get("ts")
+        if not isinstance(ts, datetime):
+            ts = datetime.fromisoformat(str(ts))
+        latency = d.get("latency_ms")
+        return cls(
+            ts=ts,
+            team_id=str(d.get("team_id") or ""),
+            gem_name=str(d.get("gem_name") or ""),
+            user_id=d.get("user_id"),
+            public=bool(d.get("public")),
+            ok=bool(d.get("ok")),
+            latency_ms=float(latency) if latency is not None else None,
+            error_type=d.get("error_type"),
+            details=d.get("details") or None,
+        )
+
+
+class RunEventLog(ABC):
+    """Gem 実行 1 回ごとの追記ログ（日次集計では答えられない「直近 1 時間で何が落ちたか」用）"""
+
+    @abstractmethod
+    def append(self, event: RunEvent) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def query(
+        self,
+        *,
+        team_id: str,
+        since: datetime,
+        until: datetime,
+        gem_name: str | None = None,
+        ok: bool | None = None,
+        limit: int = 200,
+    ) -> list[RunEvent]:
+        """[since, until] のイベントを新しい順に最大 limit 件返す"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        return
+
+
+class NoopRunEventLog(RunEventLog):
+    def append(self, event: RunEvent) -> None:
+        return
+
+    def query(
+        self,
+        *,
+        team_id: str,
+        since: datetime,
+        until: datetime,
+        gem_name: str | None = None,
+        ok: bool | None = None,
+        limit: int = 200,
+    ) -> list[RunEvent]:
+        return []
+
+
+@dataclass
+class _Segment:
+    seq: int
+    # 疎な時刻インデックス: [(ts_ms, byte_offset)]。先頭レコードは必ず含む
+    index: list[tuple[int, int]]
+
+    @property
+    def first_ts(self) -> int | None:
+        return self.index[0][0] if self.index else None
+
+
+class SegmentRunEventLog(RunEventLog):
+    """
+    サイズでローテーションする NDJSON セグメント + 疎な時刻インデックス（`.idx`）。
+
+    - 追記は時刻順（同時刻の逆転は直前の時刻に丸める）
+    - 検索は、時間範囲に重なるセグメントだけを開き、インデックスで開始位置まで seek して前方に走査する
+    - セグメント数が max_segments を超えたら古いものから削除する
+    """
+
+    def __init__(
+        self,
+        directory: str | os.PathLike,
+        *,
+        max_segment_bytes: int = 8 * 1024 * 1024,
+        index_every: int = 64,
+        max_segments: int = 32,
+    ) -> None:
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._max_segment_bytes = max(1024, int(max_segment_bytes))
+        self._index_every = max(1, int(index_every))
+        self._max_segments = max(1, int(max_segments))
+        self._lock = threading.Lock()
+
+        self._segments: list[_Segment] = []
+        self._next_seq = 0
+        for p in sorted(self.dir.glob("runs-*.ndjson")):
+            try:
+                seq = int(p.stem.split("-", 1)[1])
+            except ValueError:
+                continue
+            self._next_seq = max(self._next_seq, seq + 1)
+            seg = _Segment(seq=seq, index=self._load_index(seq))
+            if seg.index:
+                self._segments.append(seg)
+            else:
+                # 1 件も書かれなかった（書き始めに落ちた）セグメントは消す。番号は再利用しない
+                self._path(seq, "ndjson").unlink(missing_ok=True)
+                self._path(seq, "idx").unlink(missing_ok=True)
+        self._last_ts = self._segments[-1].index[-1][0] if self._segments else 0
+        self._count = 0
+        self._open_new_segment()
+
+    def _path(self, seq: int, ext: str) -> Path:
+        return self.dir / f"runs-{seq:08d}.{ext}"
+
+    def _load_index(self, seq: int) -> list[tuple[int, int]]:
+        out: list[tuple[int, int]] = []
+        try:
+            with open(self._path(seq, "idx")) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        out.append((int(parts[0]), int(parts[1])))
+        except FileNotFoundError:
+            pass
+        return out
+
+    def _open_new_segment(self) -> None:
+        seq = self._next_seq
+        self._next_seq += 1
+        self._active = _Segment(seq=seq, index=[])
+        self._segments.append(self._active)
+        self._fh = open(self._path(seq, "ndjson"), "ab")
+        self._idx_fh = open(self._path(seq, "idx"), "a")
+        self._count = 0
+        while len(self._segments) > self._max_segments:
+            old = self._segments.pop(0)
+            self._path(old.seq, "ndjson").unlink(missing_ok=True)
+            self._path(old.seq, "idx").unlink(missing_ok=True)
+
+    def append(self, event: RunEvent) -> None:
+        line = (json.dumps(event.to_dict(), ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            if self._fh.tell() >= self._max_segment_bytes:
+                self._fh.close()
+                self._idx_fh.close()
+                self._open_new_segment()
+            ts_ms = max(int(event.ts.timestamp() * 1000), self._last_ts)
+            self._last_ts = ts_ms
+            if self._count % self._index_every == 0:
+                entry = (ts_ms, self._fh.tell())
+                self._active.index.append(entry)
+                self._idx_fh.write(f"{entry[0]} {entry[1]}\n")
+                self._idx_fh.flush()
+            self._fh.write(line)
+            self._fh.flush()
+            self._count += 1
+
+    def query(
+        self,
+        *,
+        team_id: str,
+        since: datetime,
+        until: datetime,
+        gem_name: str | None = None,
+        ok: bool | None = None,
+        limit: int = 200,
+    ) -> list[RunEvent]:
+        since_ms = int(since.timestamp() * 1000)
+        until_ms = int(until.timestamp() * 1000)
+        with self._lock:
+            segs = [_Segment(seq=s.seq, index=list(s.index)) for s in self._segments if s.index]
+
+        out: list[RunEvent] = []
+        # 新しいセグメントから見る（結果は新しい順で limit 件）
+        for i in range(len(segs) - 1, -1, -1):
+            seg = segs[i]
+            next_first = segs[i + 1].first_ts if i + 1 < len(segs) else None
+            if seg.first_ts is not None and seg.first_ts > until_ms:
+                continue
+            if next_first is not None and next_first < since_ms:
+                break
+            matched = self._scan_segment(seg, since_ms, until_ms, team_id, gem_name, ok)
+            out.extend(reversed(matched))
+            if len(out) >= limit:
+                break
+        return out[:limit]
+
+    def _scan_segment(
+        self,
+        seg: _Segment,
+        since_ms: int,
+        until_ms: int,
+        team_id: str,
+        gem_name: str | None,
+        ok: bool | None,
+    ) -> list[RunEvent]:
+        # since 以前で最も後ろのインデックス位置から読む
+        keys = [ts for ts, _ in seg.index]
+        pos = bisect.bisect_right(keys, since_ms) - 1
+        offset = seg.index[pos][1] if pos >= 0 else 0
+        # インデックスと同じく、追記時に丸めた（単調増加の）時刻で打ち切る。記録時刻の逆転で検索が途中で止まらないように
+        clamped = seg.index[pos][0] if pos >= 0 else 0
+        out: list[RunEvent] = []
+        try:
+            f = open(self._path(seg.seq, "ndjson"), "rb")
+        except FileNotFoundError:
+            return out
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    d = json.loads(line)
+                    ev = RunEvent.from_dict(d)
+                except (ValueError, TypeError):
+                    continue
+                ts_ms = int(ev.ts.timestamp() * 1000)
+                clamped = max(clamped, ts_ms)
+                if clamped > until_ms:
+                    break
+                if ts_ms < since_ms or ev.team_id != team_id:
+                    continue
+                if gem_name and ev.gem_name != gem_name:
+                    continue
+                if ok is not None and ev.ok != ok:
+                    continue
+                out.append(ev)
+        return out
+
+    def close(self) -> None:
+        with self._lock:
+            self._fh.close()
+            self._idx_fh.close()
+
+
+class FirestoreRunEventLog(RunEventLog):
+    """
+    `workspaces/{team_id}/gem_runs/{auto_id}` に書く。
+    追記はメモリにためて flush_interval 秒ごと（または batch_size 件ごと）に WriteBatch でまとめて書く。
+    書き込みが失敗し続けてもメモリを使い切らないよう、たまった分は max_buffer 件までにして古いものから捨てる（終了時に残りを書く）。
+    gem_name + ts の検索には複合インデックスが必要（初回クエリのエラーメッセージのリンクから作成できる）。
+    """
+
+    def __init__(
+        self,
+        *,
+        project_id: str | None = None,
+        batch_size: int = 200,
+        flush_interval: float = 1.0,
+        ttl_days: int = 30,
+        max_buffer: int = 10_000,
+    ) -> None:
+        project_id = (
+            project_id
+            or os.environ.get("GOOGLE_CLOUD_PROJECT")
+            or os.environ.get("GCP_PROJECT")
+            or os.environ.get("GCLOUD_PROJECT")
+        )
+        from google.cloud import firestore  # type: ignore
+
+        self._client = firestore.Client(project=project_id) if project_id else firestore.Client()
+        self._batch_size = max(1, min(int(batch_size), 500))
+        self._flush_interval = max(0.05, float(flush_interval))
+        self._ttl = timedelta(days=max(1, int(ttl_days)))
+        self._max_buffer = max(self._batch_size, int(max_buffer))
+        self._buf: list[RunEvent] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.dropped = 0
+        self._flusher = threading.Thread(target=self._flush_loop, name="run-log-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _col(self, team_id: str):
+        return self._client.collection("workspaces").document(team_id).collection("gem_runs")
+
+    def append(self, event: RunEvent) -> None:
+        with self._lock:
+            self._buf.append(event)
+            self._trim_locked()
+            n = len(self._buf)
+        if n >= self._batch_size:
+            self._wake.set()
+
+    def flush(self) -> int:
+        with self._lock:
+            pending, self._buf = self._buf[: self._batch_size], self._buf[self._batch_size :]
+        if not pending:
+            return 0
+        try:
+            batch = self._client.batch()
+            for ev in pending:
+                d = ev.to_dict()
+                d["ts"] = ev.ts
+                d["expires_at"] = ev.ts + self._ttl
+                batch.set(self._col(ev.team_id).document(), d)
+            batch.commit()
+        except Exception:
+            # 次回に回す（順序は保たれる）
+            with self._lock:
+                self._buf[:0] = pending
+                self._trim_locked()
+            raise
+        return len(pending)
+
+    def _trim_locked(self) -> None:
+        over = len(self._buf) - self._max_buffer
+        if over > 0:
+            del self._buf[:over]
+            self.dropped += over
+            if self.dropped == over or self.dropped % 1000 < over:
+                print(f"[runlog] buffer full; dropped {self.dropped} event(s) so far")
+
+    def _flush_loop(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self._flush_interval)
+            self._wake.clear()
+            try:
+                while self.flush() >= self._batch_size:
+                    pass
+            except Exception as e:
+                print(f"[runlog] flush failed: {type(e).__name__} {e}")
+                self._stop.wait(min(30.0, self._flush_interval * 5))
+
+    def query(
+        self,
+        *,
+        team_id: str,
+        since: datetime,
+        until: datetime,
+        gem_name: str | None = None,
+        ok: bool | None = None,
+        limit: int = 200,
+    ) -> list[RunEvent]:
+        q = self._col(team_id).where("ts", ">=", since).where("ts", "<=", until)
+        if gem_name:
+            q = q.where("gem_name", "==", gem_name)
+        if ok is not None:
+            q = q.where("ok", "==", bool(ok))
+        q = q.order_by("ts", direction="DESCENDING").limit(max(1, min(limit, 1000)))
+        return [RunEvent.from_dict(s.to_dict() or {}) for s in q.stream()]
+
+    def close(self) -> None:
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        try:
+            while self.flush():
+                pass
+        except Exception as e:
+            print(f"[runlog] final flush failed: {type(e).__name__} {e}")
+
+
+class RunLogMetricsStore(DelegatingMetricsStore):
+    """record_gem_run を RunEventLog にも書くラッパー"""
+
+    def __init__(self, inner: MetricsStore, log: RunEventLog) -> None:
+        super().__init__(inner)
+        self.log = log
+
+    def record_gem_run(
+        self,
+        *,
+        team_id: str,
+        gem_name: str,
+        user_id: str | None,
+        public: bool,
+        ok: bool,
+        occurred_at: datetime | None = None,
+        latency_ms: float | None = None,
+        error_type: str | None = None,
+        details: dict | None = None,
+    ) -> None:
+        try:
+            self.log.append(
+                RunEvent(
+                    ts=occurred_at or datetime.now(timezone.utc),
+                    team_id=team_id,
+                    gem_name=gem_name,
+                    user_id=user_id,
+                    public=bool(public),
+                    ok=bool(ok),
+                    latency_ms=round(latency_ms, 1) if latency_ms is not None else None,
+                    error_type=error_type,
+                    details=details or None,
+                )
+            )
+        except Exception as e:
+            print(f"[runlog] append failed: {type(e).__name__} {e}")
+        super().record_gem_run(
+            team_id=team_id,
+            gem_name=gem_name,
+            user_id=user_id,
+            public=public,
+            ok=ok,
+            occurred_at=occurred_at,
+            latency_ms=latency_ms,
+            error_type=error_type,
+            details=details,
+        )
+
+
+def build_run_event_log() -> RunEventLog:
+    """
+    `GEM_RUN_LOG_BACKEND` で保存先を選ぶ:
+    - `firestore`: Firestore（`workspaces/{team_id}/gem_runs`）
+    - `file`: ローカルのセグメントファイル（`GEM_RUN_LOG_DIR`、既定 `/tmp/gemsrack-runs`）
+    - `none`: 無効化
+    - `auto`(既定): Firestore を試し、失敗時は file にフォールバック
+    """
+    backend = (os.environ.get("GEM_RUN_LOG_BACKEND") or "auto").strip().lower()
+    if backend in ("none", "noop", "off", "false"):
+        return NoopRunEventLog()
+    if backend == "file":
+        return SegmentRunEventLog(os.environ.get("GEM_RUN_LOG_DIR") or "/tmp/gemsrack-runs")
+    if backend == "firestore":
+        return FirestoreRunEventLog()
+    if backend != "auto":
+        raise RuntimeError("GEM_RUN_LOG_BACKEND は `auto` / `firestore` / `file` / `none` のいずれかにしてください")
+    try:
+        return FirestoreRunEventLog()
+    except Exception as e:
+        print(f"[runlog] Firestore unavailable; falling back to file log: {type(e).__name__} {e}")
+        return SegmentRunEventLog(os.environ.get("GEM_RUN_LOG_DIR") or "/tmp/gemsrack-runs")
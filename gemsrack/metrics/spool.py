@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+from .store import DelegatingMetricsStore, MetricsStore
+
+
+class MetricsSpool:
+    """
+    メトリクスイベントのローカル追記ログ（JSON Lines）。
+
+    - `spool-{gen:08d}.log` をセグメントとして追記し、`max_segment_bytes` を超えたら次の gen に切り替える
+    - fsync は `group_size` 件ごと、または `fsync_interval` 秒ごとにまとめて行う（group commit）
+    - 読み出し位置は `checkpoint.json`（gen, offset）に原子的に保存する
+    - 起動時は常に新しいセグメントに書き始める（前回プロセスが途中で落ちた行の後ろに追記しない）
+    """
+
+    def __init__(
+        self,
+        directory: str | os.PathLike,
+        *,
+        group_size: int = 32,
+        fsync_interval: float = 0.05,
+        max_segment_bytes: int = 4 * 1024 * 1024,
+    ) -> None:
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._group_size = max(1, int(group_size))
+        self._fsync_interval = max(0.0, float(fsync_interval))
+        self._max_segment_bytes = max(1024, int(max_segment_bytes))
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._appended = threading.Event()
+
+        self.spool_id = self._load_or_create_id()
+        self.checkpoint = self._load_checkpoint()
+        # チェックポイントより前のセグメントは消化済み（チェックポイント保存後・削除前に落ちた場合の掃除）
+        for g in self.segments():
+            if g < self.checkpoint[0]:
+                self._segment_path(g).unlink(missing_ok=True)
+        self._gen = max([self.checkpoint[0], *self.segments()]) + 1
+        self._fh = open(self._segment_path(self._gen), "ab")
+
+        self._closed = False
+        self._syncer = threading.Thread(target=self._sync_loop, name="metrics-spool-fsync", daemon=True)
+        self._syncer.start()
+
+    # ---- writer ----
+
+    def append(self, event: dict) -> None:
+        line = (json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            if self._fh.tell() >= self._max_segment_bytes:
+                self._rotate_locked()
+            self._fh.write(line)
+            self._fh.flush()
+            self._unsynced += 1
+            if self._unsynced >= self._group_size:
+                self._fsync_locked()
+        self._appended.set()
+
+    def _rotate_locked(self) -> None:
+        self._fsync_locked()
+        self._fh.close()
+        self._gen += 1
+        self._fh = open(self._segment_path(self._gen), "ab")
+
+    def _fsync_locked(self) -> None:
+        if self._unsynced:
+            os.fsync(self._fh.fileno())
+            self._unsynced = 0
+
+    def _sync_loop(self) -> None:
+        while not self._closed:
+            time.sleep(self._fsync_interval or 0.05)
+            with self._lock:
+                if not self._closed:
+                    self._fsync_locked()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._fsync_locked()
+            self._fh.close()
+
+    # ---- reader ----
+
+    def read_batch(self, max_events: int) -> tuple[list[dict], tuple[int, int], tuple[int, int]]:
+        """
+        チェックポイントから最大 max_events 件を読む。
+        戻り値: (events, start=(gen, offset), end=(gen, offset))。end をチェックポイントにすれば消化済みになる。
+        書き手が次のセグメントに移っていれば、現在のセグメントの残り（途中で切れた行を含む）は読み飛ばす。
+        """
+        gen, offset = self.checkpoint
+        while True:
+            events, end = self._read_segment(gen, offset, max_events)
+            if events or end != offset:
+                return events, (gen, offset), (gen, end)
+            with self._lock:
+                writer_gen = self._gen
+            if gen >= writer_gen:
+                return [], (gen, offset), (gen, offset)
+            # 書き手は先に進んでいる → このセグメントは完結済み。ただし読んだ後・切り替え前に追記された行があり得るので、
+            # 切り替えを見てからもう一度読み、それでも空のときだけ次のセグメントへ進む
+            events, end = self._read_segment(gen, offset, max_events)
+            if events or end != offset:
+                return events, (gen, offset), (gen, end)
+            gen, offset = gen + 1, 0
+            self.commit((gen, 0))
+
+    def _read_segment(self, gen: int, offset: int, max_events: int) -> tuple[list[dict], int]:
+        """gen の offset から完結した行を最大 max_events 件読む。戻り値: (events, 読み終えた位置)"""
+        path = self._segment_path(gen)
+        events: list[dict] = []
+        end = offset
+        if not path.exists():
+            return events, end
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while len(events) < max_events:
+                line = f.readline()
+                if not line or not line.endswith(b"\n"):
+                    break
+                end += len(line)
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    print(f"[metrics] spool: skipped corrupt line at {path.name}:{end - len(line)}")
+        return events, end
+
+    def commit(self, position: tuple[int, int]) -> None:
+        prev_gen = self.checkpoint[0]
+        tmp = self.dir / "checkpoint.json.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"gen": position[0], "offset": position[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.dir / "checkpoint.json")
+        self.checkpoint = position
+        for g in range(prev_gen, position[0]):
+            self._segment_path(g).unlink(missing_ok=True)
+
+    def wait_for_append(self, timeout: float) -> None:
+        self._appended.wait(timeout)
+        self._appended.clear()
+
+    def segments(self) -> list[int]:
+        out = []
+        for p in self.dir.glob("spool-*.log"):
+            try:
+                out.append(int(p.stem.split("-", 1)[1]))
+            except ValueError:
+                continue
+        return sorted(out)
+
+    def pending_bytes(self) -> int:
+        gen, offset = self.checkpoint
+        total = 0
+        for g in self.segments():
+            if g < gen:
+                continue
+            try:
+                total += self._segment_path(g).stat().st_size
+            except FileNotFoundError:
+                continue
+        return max(0, total - offset)
+
+    def _segment_path(self, gen: int) -> Path:
+        return self.dir / f"spool-{gen:08d}.log"
+
+    def _load_or_create_id(self) -> str:
+        p = self.dir / "spool_id"
+        if p.exists():
+            v = p.read_text().strip()
+            if v:
+                return v
+        v = uuid.uuid4().hex
+        p.write_text(v)
+        return v
+
+    def _load_checkpoint(self) -> tuple[int, int]:
+        p = self.dir / "checkpoint.json"
+        try:
+            d = json.loads(p.read_text())
+            return int(d.get("gen") or 0), int(d.get("offset") or 0)
+        except (FileNotFoundError, ValueError):
+            return 0, 0
+
+
+class SpooledMetricsStore(DelegatingMetricsStore):
+    """
+    record_gem_run をローカルの MetricsSpool に書くだけで即 return し、
+    バックグラウンドの drainer が内側のストア（Firestore）へまとめて反映する。
+
+    inner が `apply_spooled_events(batch_id=..., events=..., end=...)` を持つ場合は、
+    batch_id（spool_id/gen/offset）単位で冪等に適用されるので、
+    反映後・チェックポイント保存前に落ちても二重計上しない。
+    読み出し系は inner に委譲する（drain の遅延分だけ遅れて見える）。
+    """
+
+    def __init__(
+        self,
+        inner: MetricsStore,
+        spool: MetricsSpool,
+        *,
+        batch_size: int = 200,
+        max_backoff: float = 60.0,
+    ) -> None:
+        super().__init__(inner)
+        self.spool = spool
+        self._batch_size = max(1, int(batch_size))
+        self._max_backoff = max(1.0, float(max_backoff))
+        self._stop = threading.Event()
+        # drain は同時に 1 つだけ（close の最終 drain と、join が間に合わなかった drainer が重ならないように）
+        self._drain_lock = threading.Lock()
+        self.drained_events = 0
+        self.failed_attempts = 0
+        self.last_error: str | None = None
+        self._drainer = threading.Thread(target=self._drain_loop, name="metrics-spool-drainer", daemon=True)
+        self._drainer.start()
+        atexit.register(self.close)
+
+    def record_gem_run(
+        self,
+        *,
+        team_id: str,
+        gem_name: str,
+        user_id: str | None,
+        public: bool,
+        ok: bool,
+        occurred_at: datetime | None = None,
+        latency_ms: float | None = None,
+        error_type: str | None = None,
+        details: dict | None = None,
+    ) -> None:
+        dt = occurred_at or datetime.now(timezone.utc)
+        self.spool.append(
+            {
+                "team_id": team_id,
+                "gem_name": gem_name,
+                "user_id": user_id,
+                "public": bool(public),
+                "ok": bool(ok),
+                "occurred_at": dt.isoformat(),
+            }
+        )
+
+    def drain_once(self) -> int:
+        """1 バッチ分を反映して件数を返す（失敗時は例外）"""
+        with self._drain_lock:
+            return self._drain_once_locked()
+
+    def _drain_once_locked(self) -> int:
+        events, start, end = self.spool.read_batch(self._batch_size)
+        if events:
+            apply = getattr(self.inner, "apply_spooled_events", None)
+            if callable(apply):
+                batch_id = f"{self.spool.spool_id}__{start[0]:08d}__{start[1]}"
+                applied_end = apply(batch_id=batch_id, events=events, end=end)
+                if applied_end is not None:
+                    # 前回プロセスが反映済み（チェックポイント保存前に停止）。反映済みの範囲だけ進め、残りは次のバッチで
+                    self.spool.commit(tuple(applied_end))  # type: ignore[arg-type]
+                    return 0
+            else:
+                for ev in events:
+                    self.inner.record_gem_run(
+                        team_id=ev["team_id"],
+                        gem_name=ev["gem_name"],
+                        user_id=ev.get("user_id"),
+                        public=bool(ev.get("public")),
+                        ok=bool(ev.get("ok")),
+                        occurred_at=datetime.fromisoformat(ev["occurred_at"]),
+                    )
+        if end != start:
+            self.spool.commit(end)
+        self.drained_events += len(events)
+        return len(events)
+
+    def _drain_loop(self) -> None:
+        backoff = 0.5
+        while not self._stop.is_set():
+            try:
+                before = self.spool.checkpoint
+                self.drain_once()
+                backoff = 0.5
+                self.last_error = None
+                if self.spool.checkpoint == before:
+                    # 追いついた。次の追記まで待つ
+                    self.spool.wait_for_append(timeout=1.0)
+            except Exception as e:
+                self.failed_attempts += 1
+                self.last_error = f"{type(e).__name__}: {str(e) or type(e).__name__}"
+                delay = min(self._max_backoff, backoff) * random.uniform(0.5, 1.0)
+                print(f"[metrics] spool drain failed (retry in {delay:.1f}s): {self.last_error}")
+                self._stop.wait(delay)
+                backoff = min(self._max_backoff, backoff * 2)
+
+    def close(self, *, drain_timeout: float = 5.0) -> None:
+        # 終了時は短い猶予で可能な限り反映し、残りは spool に残して次回起動時に再開する
+        deadline = time.monotonic() + drain_timeout
+        self._stop.set()
+        self._drainer.join(timeout=max(0.0, deadline - time.monotonic()))
+        if self._drain_lock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            try:
+                while time.monotonic() < deadline and self._drain_once_locked():
+                    pass
+            except Exception as e:
+                print(f"[metrics] spool final drain failed: {type(e).__name__} {e}")
+            finally:
+                self._drain_lock.release()
+        else:
+            print("[metrics] spool final drain skipped: drainer is still applying a batch")
+        self.spool.close()
+
+    def stats(self) -> dict:
+        return {
+            "spool_dir": str(self.spool.dir),
+            "pending_bytes": self.spool.pending_bytes(),
+            "drained_events": self.drained_events,
+            "failed_attempts": self.failed_attempts,
+            "last_error": self.last_error,
+        }
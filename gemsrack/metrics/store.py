@@ -1,9 +1,27 @@
 from __future__ import annotations
 
+import atexit
 import os
+import threading
+import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from datetime import date, datetime, timedelta, timezone
+from typing import Iterator
+
+from .heavy import GEM_USERS_CAPACITY, TEAM_USERS_CAPACITY, HeavyHitters, merge_top_users
+from .retention import (
+    CompactionResult,
+    RetentionPolicy,
+    compaction_cutoff,
+    estimate_firestore_doc_bytes,
+    estimate_python_bytes,
+    load_retention_policy,
+    month_of,
+)
+
+# compaction 中に元ドキュメントが更新されてページを読み直す回数の上限（超えたら例外にして次回の compact に回す）
+_COMPACTION_MAX_CONFLICTS = 5
 
 
 @dataclass(frozen=True)
@@ -30,6 +48,78 @@ class GemUsageSummary:
     top_gems: list[dict]
 
 
+@dataclass(frozen=True)
+class GemUsageReport:
+    """Summary と日別×Gem の明細を 1 回の走査でまとめて返す（Admin 向け）"""
+
+    summary: GemUsageSummary
+    by_gem_day: list[GemUsageRow]
+
+
+def _usage_range(days: int) -> tuple[int, date, date]:
+    days = max(1, min(days, 365))
+    today = date.today()
+    start = today - timedelta(days=days - 1)
+    return days, start, today
+
+
+def _build_usage_report(
+    *,
+    team_id: str,
+    days: int,
+    start: date,
+    today: date,
+    rows: list[GemUsageRow],
+    limit: int,
+) -> GemUsageReport:
+    """
+    日別×Gem の行（範囲内）から、合計/日別合計/上位Gem を 1 パスで集計する。
+    日別合計は gem_usage_daily の合算と一致する（record_gem_run が両方を同時に加算するため）。
+    """
+    limit = max(1, min(limit, 100))
+    by_day_map: dict[str, dict] = {}
+    for i in range(days):
+        d = (start + timedelta(days=i)).isoformat()
+        by_day_map[d] = {"date": d, "total_count": 0, "public_count": 0, "ok_count": 0, "error_count": 0}
+
+    agg: dict[str, dict] = {}
+    total_count = public_count = ok_count = error_count = 0
+    for r in rows:
+        tot = by_day_map.get(r.date)
+        if tot is None:
+            continue
+        tot["total_count"] += r.count
+        tot["public_count"] += r.public_count
+        tot["ok_count"] += r.ok_count
+        tot["error_count"] += r.error_count
+        total_count += r.count
+        public_count += r.public_count
+        ok_count += r.ok_count
+        error_count += r.error_count
+
+        a = agg.get(r.gem_name) or {"gem_name": r.gem_name, "count": 0, "public_count": 0, "ok_count": 0, "error_count": 0}
+        a["count"] += r.count
+        a["public_count"] += r.public_count
+        a["ok_count"] += r.ok_count
+        a["error_count"] += r.error_count
+        agg[r.gem_name] = a
+
+    top = sorted(agg.values(), key=lambda x: int(x["count"]), reverse=True)[:limit]
+    summary = GemUsageSummary(
+        team_id=team_id,
+        days=days,
+        from_date=start.isoformat(),
+        to_date=today.isoformat(),
+        total_count=total_count,
+        public_count=public_count,
+        ok_count=ok_count,
+        error_count=error_count,
+        by_day=list(by_day_map.values()),
+        top_gems=top,
+    )
+    return GemUsageReport(summary=summary, by_gem_day=sorted(rows, key=lambda r: (r.date, r.gem_name)))
+
+
 class MetricsStore(ABC):
     @abstractmethod
     def record_gem_run(
@@ -41,7 +131,15 @@ class MetricsStore(ABC):
         public: bool,
         ok: bool,
         occurred_at: datetime | None = None,
+        latency_ms: float | None = None,
+        error_type: str | None = None,
+        details: dict | None = None,
     ) -> None:
+        """
+        Gem 実行 1 回分を加算する。
+        latency_ms / error_type / details は実行単位のログ（run event log）向けで、日次集計では使わない。
+        details はキャッシュ命中などの付帯情報（JSON にできる値のみ）。
+        """
         raise NotImplementedError
 
     @abstractmethod
@@ -52,6 +150,94 @@ class MetricsStore(ABC):
     def list_gem_usage_daily(self, *, team_id: str, days: int = 30) -> list[GemUsageRow]:
         raise NotImplementedError
 
+    @abstractmethod
+    def get_usage_report(self, *, team_id: str, days: int = 30, limit: int = 20) -> GemUsageReport:
+        """summary + by_gem_day を 1 回の走査で返す（get_gem_usage_summary + list_gem_usage_daily の合成）"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_gem_usage_rows(self, *, team_id: str, from_date: date, to_date: date) -> Iterator[GemUsageRow]:
+        """
+        [from_date, to_date] の日別×Gem 行を (date, gem_name) 順に逐次返す（エクスポート用）。
+        範囲の上限は設けず、呼び出し側が 1 行ずつ書き出せるよう全件をメモリに載せない。
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_top_users(self, *, team_id: str, days: int = 30, gem_name: str | None = None, limit: int = 20) -> dict:
+        """
+        範囲内の実行回数が多いユーザー（チーム全体、または gem_name 指定で Gem 別）。
+        日別の上限付きマップ（heavy hitters）を合算するため、件数が多いと近似値になる。
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def compact(self, *, team_id: str, older_than_days: int | None = None, dry_run: bool = False) -> CompactionResult:
+        """
+        `older_than_days` より古い日次行を月次ロールアップ（YYYY-MM）に畳み、元の日次行を削除する。
+        未指定なら RetentionPolicy.daily_retention_days を使う。
+        """
+        raise NotImplementedError
+
+
+class DelegatingMetricsStore(MetricsStore):
+    """内側のストアに全メソッドを委譲する基底クラス（記録経路に処理を挟むラッパー用）"""
+
+    def __init__(self, inner: MetricsStore) -> None:
+        self.inner = inner
+
+    def record_gem_run(
+        self,
+        *,
+        team_id: str,
+        gem_name: str,
+        user_id: str | None,
+        public: bool,
+        ok: bool,
+        occurred_at: datetime | None = None,
+        latency_ms: float | None = None,
+        error_type: str | None = None,
+        details: dict | None = None,
+    ) -> None:
+        self.inner.record_gem_run(
+            team_id=team_id,
+            gem_name=gem_name,
+            user_id=user_id,
+            public=public,
+            ok=ok,
+            occurred_at=occurred_at,
+            latency_ms=latency_ms,
+            error_type=error_type,
+            details=details,
+        )
+
+    def get_gem_usage_summary(self, *, team_id: str, days: int = 30, limit: int = 20) -> GemUsageSummary:
+        return self.inner.get_gem_usage_summary(team_id=team_id, days=days, limit=limit)
+
+    def list_gem_usage_daily(self, *, team_id: str, days: int = 30) -> list[GemUsageRow]:
+        return self.inner.list_gem_usage_daily(team_id=team_id, days=days)
+
+    def get_usage_report(self, *, team_id: str, days: int = 30, limit: int = 20) -> GemUsageReport:
+        return self.inner.get_usage_report(team_id=team_id, days=days, limit=limit)
+
+    def iter_gem_usage_rows(self, *, team_id: str, from_date: date, to_date: date) -> Iterator[GemUsageRow]:
+        return self.inner.iter_gem_usage_rows(team_id=team_id, from_date=from_date, to_date=to_date)
+
+    def get_top_users(self, *, team_id: str, days: int = 30, gem_name: str | None = None, limit: int = 20) -> dict:
+        return self.inner.get_top_users(team_id=team_id, days=days, gem_name=gem_name, limit=limit)
+
+    def compact(self, *, team_id: str, older_than_days: int | None = None, dry_run: bool = False) -> CompactionResult:
+        return self.inner.compact(team_id=team_id, older_than_days=older_than_days, dry_run=dry_run)
+
+    def unwrap(self, kind: type) -> MetricsStore | None:
+        """ラッパーの連鎖から指定型のストアを探す（見つからなければ None）"""
+        cur: MetricsStore | None = self
+        while cur is not None:
+            if isinstance(cur, kind):
+                return cur
+            cur = getattr(cur, "inner", None)
+        return None
+
 
 class NoopMetricsStore(MetricsStore):
     def record_gem_run(  # noqa: D401
@@ -63,6 +249,9 @@ class NoopMetricsStore(MetricsStore):
         public: bool,
         ok: bool,
         occurred_at: datetime | None = None,
+        latency_ms: float | None = None,
+        error_type: str | None = None,
+        details: dict | None = None,
     ) -> None:
         return
 
@@ -84,26 +273,73 @@ class NoopMetricsStore(MetricsStore):
     def list_gem_usage_daily(self, *, team_id: str, days: int = 30) -> list[GemUsageRow]:
         return []
 
+    def get_usage_report(self, *, team_id: str, days: int = 30, limit: int = 20) -> GemUsageReport:
+        return GemUsageReport(summary=self.get_gem_usage_summary(team_id=team_id, days=days, limit=limit), by_gem_day=[])
+
+    def iter_gem_usage_rows(self, *, team_id: str, from_date: date, to_date: date) -> Iterator[GemUsageRow]:
+        return iter(())
+
+    def get_top_users(self, *, team_id: str, days: int = 30, gem_name: str | None = None, limit: int = 20) -> dict:
+        return merge_top_users([], limit)
+
+    def compact(self, *, team_id: str, older_than_days: int | None = None, dry_run: bool = False) -> CompactionResult:
+        cutoff = compaction_cutoff(
+            load_retention_policy().daily_retention_days if older_than_days is None else older_than_days
+        )
+        return CompactionResult(
+            team_id=team_id,
+            cutoff_date=cutoff.isoformat(),
+            dry_run=dry_run,
+            rows_compacted=0,
+            months_touched=0,
+            documents_written=0,
+            documents_deleted=0,
+            bytes_reclaimed=0,
+        )
+
 
 class InMemoryMetricsStore(MetricsStore):
-    def __init__(self) -> None:
+    def __init__(self, *, policy: RetentionPolicy | None = None) -> None:
+        self._policy = policy or load_retention_policy()
+        self._lock = threading.Lock()
         # key: (team_id, YYYY-MM-DD, gem_name)
         self._gem_daily: dict[tuple[str, str, str], GemUsageRow] = {}
         # key: (team_id, YYYY-MM-DD)
         self._total_daily: dict[tuple[str, str], dict] = {}
+        # 月次ロールアップ（compact 済みの日次行の畳み込み先）
+        # key: (team_id, YYYY-MM, gem_name) / (team_id, YYYY-MM)
+        self._gem_monthly: dict[tuple[str, str, str], GemUsageRow] = {}
+        self._total_monthly: dict[tuple[str, str], dict] = {}
+        # ユーザー別（上限付き）: key: (team_id, YYYY-MM-DD) -> (チーム全体, {gem_name: Gem別})
+        self._users_daily: dict[tuple[str, str], tuple[HeavyHitters, dict[str, HeavyHitters]]] = {}
 
     def record_gem_run(
         self,
         *,
         team_id: str,
         gem_name: str,
-        user_id: str | None,  # unused for now
+        user_id: str | None,
         public: bool,
         ok: bool,
         occurred_at: datetime | None = None,
+        latency_ms: float | None = None,
+        error_type: str | None = None,
+        details: dict | None = None,
     ) -> None:
         dt = occurred_at or datetime.now(timezone.utc)
         d = dt.date().isoformat()
+        with self._lock:
+            self._record_locked(team_id=team_id, d=d, gem_name=gem_name, user_id=user_id, public=public, ok=ok)
+            if len(self._gem_daily) > self._policy.max_memory_rows:
+                self._enforce_memory_cap_locked(today=datetime.now(timezone.utc).date().isoformat())
+
+    def _record_locked(self, *, team_id: str, d: str, gem_name: str, user_id: str | None, public: bool, ok: bool) -> None:
+        if user_id:
+            team_hh, gem_hh = self._users_daily.get((team_id, d)) or (HeavyHitters(TEAM_USERS_CAPACITY), {})
+            team_hh.add(str(user_id))
+            gem_hh.setdefault(gem_name, HeavyHitters(GEM_USERS_CAPACITY)).add(str(user_id))
+            self._users_daily[(team_id, d)] = (team_hh, gem_hh)
+
         k = (team_id, d, gem_name)
         row = self._gem_daily.get(k) or GemUsageRow(
             date=d,
@@ -137,17 +373,117 @@ class InMemoryMetricsStore(MetricsStore):
         tot["error_count"] += 0 if ok else 1
         self._total_daily[kt] = tot
 
+    def _enforce_memory_cap_locked(self, *, today: str) -> None:
+        # 上限を超えたら最古の日から月次に畳む（当日分は畳まない）
+        while len(self._gem_daily) > self._policy.max_memory_rows:
+            oldest = min(k[1] for k in self._gem_daily)
+            if oldest >= today:
+                return
+            cutoff = (date.fromisoformat(oldest) + timedelta(days=1)).isoformat()
+            self._compact_before_locked(team_id=None, cutoff=cutoff, dry_run=False)
+
+    def compact(self, *, team_id: str, older_than_days: int | None = None, dry_run: bool = False) -> CompactionResult:
+        cutoff = compaction_cutoff(
+            self._policy.daily_retention_days if older_than_days is None else older_than_days
+        )
+        with self._lock:
+            res = self._compact_before_locked(team_id=team_id, cutoff=cutoff.isoformat(), dry_run=dry_run)
+        return CompactionResult(team_id=team_id, cutoff_date=cutoff.isoformat(), dry_run=dry_run, **res)
+
+    def _compact_before_locked(self, *, team_id: str | None, cutoff: str, dry_run: bool) -> dict:
+        gem_keys = [k for k in self._gem_daily if (team_id is None or k[0] == team_id) and k[1] < cutoff]
+        tot_keys = [k for k in self._total_daily if (team_id is None or k[0] == team_id) and k[1] < cutoff]
+
+        months: set[tuple[str, str]] = set()
+        written: set[tuple] = set()
+        freed = 0
+        for k in gem_keys:
+            row = self._gem_daily[k]
+            mk = (k[0], month_of(k[1]), k[2])
+            months.add((k[0], mk[1]))
+            written.add(mk)
+            freed += estimate_python_bytes(k, row)
+            if dry_run:
+                continue
+            m = self._gem_monthly.get(mk)
+            self._gem_monthly[mk] = GemUsageRow(
+                date=mk[1],
+                gem_name=row.gem_name,
+                count=row.count + (m.count if m else 0),
+                public_count=row.public_count + (m.public_count if m else 0),
+                ok_count=row.ok_count + (m.ok_count if m else 0),
+                error_count=row.error_count + (m.error_count if m else 0),
+            )
+            del self._gem_daily[k]
+
+        for k in tot_keys:
+            tot = self._total_daily[k]
+            mk2 = (k[0], month_of(k[1]))
+            months.add(mk2)
+            written.add(mk2)
+            freed += estimate_python_bytes(k, tot)
+            if dry_run:
+                continue
+            m2 = self._total_monthly.get(mk2) or {
+                "month": mk2[1],
+                "total_count": 0,
+                "public_count": 0,
+                "ok_count": 0,
+                "error_count": 0,
+            }
+            for f in ("total_count", "public_count", "ok_count", "error_count"):
+                m2[f] += int(tot.get(f) or 0)
+            self._total_monthly[mk2] = m2
+            del self._total_daily[k]
+
+        # ユーザー別は月次には畳まず、日次行と一緒に捨てる
+        user_keys = [k for k in self._users_daily if (team_id is None or k[0] == team_id) and k[1] < cutoff]
+        for k in user_keys:
+            team_hh, gem_hh = self._users_daily[k]
+            freed += estimate_python_bytes(k, team_hh.counts) + sum(
+                estimate_python_bytes(h.counts) for h in gem_hh.values()
+            )
+            if not dry_run:
+                del self._users_daily[k]
+
+        return {
+            "rows_compacted": len(gem_keys),
+            "months_touched": len(months),
+            "documents_written": len(written),
+            "documents_deleted": len(gem_keys) + len(tot_keys),
+            "bytes_reclaimed": freed,
+        }
+
+    def get_top_users(self, *, team_id: str, days: int = 30, gem_name: str | None = None, limit: int = 20) -> dict:
+        days, start, today = _usage_range(days)
+        maps: list[tuple[dict[str, int], int]] = []
+        with self._lock:
+            for i in range(days):
+                entry = self._users_daily.get((team_id, (start + timedelta(days=i)).isoformat()))
+                if entry is None:
+                    continue
+                hh = entry[1].get(gem_name) if gem_name else entry[0]
+                if hh is not None:
+                    maps.append((dict(hh.counts), hh.floor))
+        return merge_top_users(maps, limit)
+
     def get_gem_usage_summary(self, *, team_id: str, days: int = 30, limit: int = 20) -> GemUsageSummary:
         days = max(1, min(days, 365))
         today = date.today()
         start = today - timedelta(days=days - 1)
 
+        # 書き込みと競合しないよう、ロック内で対象の行だけ写し取ってから集計する（日次合計の dict はその場で更新されるのでコピー）
+        s, e = start.isoformat(), today.isoformat()
+        with self._lock:
+            totals = {k[1]: dict(v) for k, v in self._total_daily.items() if k[0] == team_id and s <= k[1] <= e}
+            rows = [(gem, row) for (tid, d, gem), row in self._gem_daily.items() if tid == team_id and s <= d <= e]
+
         # totals by day
         by_day: list[dict] = []
         total_count = public_count = ok_count = error_count = 0
         for i in range(days):
             d = (start + timedelta(days=i)).isoformat()
-            tot = self._total_daily.get((team_id, d)) or {
+            tot = totals.get(d) or {
                 "date": d,
                 "total_count": 0,
                 "public_count": 0,
@@ -162,11 +498,7 @@ class InMemoryMetricsStore(MetricsStore):
 
         # top gems
         agg: dict[str, dict] = {}
-        for (tid, d, gem), row in self._gem_daily.items():
-            if tid != team_id:
-                continue
-            if d < start.isoformat() or d > today.isoformat():
-                continue
+        for gem, row in rows:
             a = agg.get(gem) or {"gem_name": gem, "count": 0, "public_count": 0, "ok_count": 0, "error_count": 0}
             a["count"] += row.count
             a["public_count"] += row.public_count
@@ -192,19 +524,32 @@ class InMemoryMetricsStore(MetricsStore):
         days = max(1, min(days, 365))
         today = date.today()
         start = today - timedelta(days=days - 1)
-        out: list[GemUsageRow] = []
-        for (tid, d, gem), row in self._gem_daily.items():
-            if tid != team_id:
-                continue
-            if d < start.isoformat() or d > today.isoformat():
-                continue
-            out.append(row)
+        s, e = start.isoformat(), today.isoformat()
+        with self._lock:
+            out = [row for (tid, d, _), row in self._gem_daily.items() if tid == team_id and s <= d <= e]
         out.sort(key=lambda r: (r.date, r.gem_name))
         return out
 
+    def get_usage_report(self, *, team_id: str, days: int = 30, limit: int = 20) -> GemUsageReport:
+        days, start, today = _usage_range(days)
+        s, e = start.isoformat(), today.isoformat()
+        with self._lock:
+            rows = [row for (tid, d, _), row in self._gem_daily.items() if tid == team_id and s <= d <= e]
+        return _build_usage_report(team_id=team_id, days=days, start=start, today=today, rows=rows, limit=limit)
+
+    def iter_gem_usage_rows(self, *, team_id: str, from_date: date, to_date: date) -> Iterator[GemUsageRow]:
+        s, e = from_date.isoformat(), to_date.isoformat()
+        # 行は書き込みのたびに差し替わる（その場では変わらない）ので、ロック内で参照だけ写し取ってから返す
+        with self._lock:
+            items = [(k[1], k[2], row) for k, row in self._gem_daily.items() if k[0] == team_id and s <= k[1] <= e]
+        items.sort(key=lambda x: (x[0], x[1]))
+        for _, _, row in items:
+            yield row
+
 
 class FirestoreMetricsStore(MetricsStore):
-    def __init__(self, *, project_id: str | None = None) -> None:
+    def __init__(self, *, project_id: str | None = None, policy: RetentionPolicy | None = None) -> None:
+        self._policy = policy or load_retention_policy()
         self._project_id = (
             project_id
             or os.environ.get("GOOGLE_CLOUD_PROJECT")
@@ -219,6 +564,12 @@ class FirestoreMetricsStore(MetricsStore):
         else:
             self._client = firestore.Client()
 
+        # ユーザー別マップは read-modify-write（トランザクション）になるため、
+        # 実行ごとには書かずプロセス内でためて定期的にまとめて反映する
+        self._user_buf: dict[tuple[str, str], dict[str, dict[str, int]]] = {}
+        self._user_lock = threading.Lock()
+        self._user_flusher: threading.Thread | None = None
+
     def _gem_daily_ref(self, *, team_id: str, d: str, gem_name: str):
         # workspaces/{team_id}/gem_usage_daily/{YYYY-MM-DD}__{gem_name}
         doc_id = f"{d}__{gem_name}"
@@ -238,6 +589,73 @@ class FirestoreMetricsStore(MetricsStore):
             .document(d)
         )
 
+    def _workspace_col(self, *, team_id: str, name: str):
+        return self._client.collection("workspaces").document(team_id).collection(name)
+
+    def _users_daily_ref(self, *, team_id: str, d: str):
+        # workspaces/{team_id}/gem_usage_users_daily/{YYYY-MM-DD}
+        return self._workspace_col(team_id=team_id, name="gem_usage_users_daily").document(d)
+
+    def _buffer_user_run(self, *, team_id: str, d: str, gem_name: str, user_id: str) -> None:
+        with self._user_lock:
+            by_gem = self._user_buf.setdefault((team_id, d), {})
+            users = by_gem.setdefault(gem_name, {})
+            users[user_id] = users.get(user_id, 0) + 1
+            if self._user_flusher is None:
+                self._user_flusher = threading.Thread(
+                    target=self._user_flush_loop, name="metrics-users-flusher", daemon=True
+                )
+                self._user_flusher.start()
+                atexit.register(self.flush_user_counts)
+
+    def _user_flush_loop(self) -> None:
+        while True:
+            time.sleep(5.0)
+            self.flush_user_counts()
+
+    def flush_user_counts(self) -> None:
+        with self._user_lock:
+            pending, self._user_buf = self._user_buf, {}
+        for (team_id, d), counts in pending.items():
+            try:
+                self._merge_user_counts(team_id=team_id, d=d, counts=counts)
+            except Exception as e:
+                print(f"[metrics] user counts flush failed: {type(e).__name__} {e}")
+
+    def _merge_user_counts(self, *, team_id: str, d: str, counts: dict[str, dict[str, int]]) -> None:
+        """(team, day) のユーザー別マップに counts（gem -> user -> 回数）を heavy hitters で合流させる"""
+        ref = self._users_daily_ref(team_id=team_id, d=d)
+        firestore = self._firestore
+
+        @firestore.transactional  # type: ignore[attr-defined]
+        def _tx(tx) -> None:  # noqa: ANN001
+            snap = ref.get(transaction=tx)
+            cur = (snap.to_dict() or {}) if snap.exists else {}
+            team_hh = HeavyHitters(TEAM_USERS_CAPACITY, cur.get("team") or {}, int(cur.get("team_floor") or 0))
+            gem_floors = cur.get("gem_floors") or {}
+            gem_hh = {
+                g: HeavyHitters(GEM_USERS_CAPACITY, m or {}, int(gem_floors.get(g) or 0))
+                for g, m in (cur.get("gems") or {}).items()
+            }
+            for gem_name, users in counts.items():
+                h = gem_hh.setdefault(gem_name, HeavyHitters(GEM_USERS_CAPACITY))
+                for uid, n in users.items():
+                    team_hh.add(uid, n)
+                    h.add(uid, n)
+            tx.set(
+                ref,
+                {
+                    "date": d,
+                    "team": team_hh.counts,
+                    "team_floor": team_hh.floor,
+                    "gems": {g: h.counts for g, h in gem_hh.items()},
+                    "gem_floors": {g: h.floor for g, h in gem_hh.items()},
+                    "updated_at": datetime.now(timezone.utc),
+                },
+            )
+
+        _tx(self._client.transaction())
+
     def record_gem_run(
         self,
         *,
@@ -247,6 +665,9 @@ class FirestoreMetricsStore(MetricsStore):
         public: bool,
         ok: bool,
         occurred_at: datetime | None = None,
+        latency_ms: float | None = None,
+        error_type: str | None = None,
+        details: dict | None = None,
     ) -> None:
         dt = occurred_at or datetime.now(timezone.utc)
         d = dt.date().isoformat()
@@ -267,6 +688,7 @@ class FirestoreMetricsStore(MetricsStore):
         if user_id:
             # 直近の実行者のヒント程度（PIIではないが、必要なら削れます）
             payload["last_user_id"] = str(user_id)
+            self._buffer_user_run(team_id=team_id, d=d, gem_name=gem_name, user_id=str(user_id))
         ref.set(payload, merge=True)
 
         # totals daily
@@ -283,6 +705,83 @@ class FirestoreMetricsStore(MetricsStore):
             merge=True,
         )
 
+    def apply_spooled_events(
+        self, *, batch_id: str, events: list[dict], end: tuple[int, int]
+    ) -> tuple[int, int] | None:
+        """
+        spool から読んだイベントをまとめて 1 つの WriteBatch で加算する。
+        同じ batch の中で `metrics_spool_batches/{batch_id}` を create するため、
+        同じ batch_id の再適用は AlreadyExists で丸ごと失敗し、二重計上にならない。
+        戻り値: 今回適用したら None / 適用済みだったら、そのとき消化した終端位置 end
+        （再起動後は同じ開始位置からより多く読めることがあるので、呼び出し側はそこまでだけ進める）
+        """
+        inc = self._firestore.Increment  # type: ignore[attr-defined]
+        now = datetime.now(timezone.utc)
+        gem_agg: dict[tuple[str, str, str], dict] = {}
+        tot_agg: dict[tuple[str, str], dict] = {}
+        user_agg: dict[tuple[str, str], dict[str, dict[str, int]]] = {}
+        for ev in events:
+            team_id = str(ev.get("team_id") or "unknown")
+            gem_name = str(ev.get("gem_name") or "")
+            d = datetime.fromisoformat(str(ev.get("occurred_at"))).date().isoformat()
+            public = bool(ev.get("public"))
+            ok = bool(ev.get("ok"))
+            g = gem_agg.setdefault(
+                (team_id, d, gem_name), {"count": 0, "public_count": 0, "ok_count": 0, "error_count": 0}
+            )
+            g["count"] += 1
+            g["public_count"] += 1 if public else 0
+            g["ok_count"] += 1 if ok else 0
+            g["error_count"] += 0 if ok else 1
+            if ev.get("user_id"):
+                uid = str(ev["user_id"])
+                g["last_user_id"] = uid
+                users = user_agg.setdefault((team_id, d), {}).setdefault(gem_name, {})
+                users[uid] = users.get(uid, 0) + 1
+            t = tot_agg.setdefault((team_id, d), {"total_count": 0, "public_count": 0, "ok_count": 0, "error_count": 0})
+            t["total_count"] += 1
+            t["public_count"] += 1 if public else 0
+            t["ok_count"] += 1 if ok else 0
+            t["error_count"] += 0 if ok else 1
+
+        marker = self._client.collection("metrics_spool_batches").document(batch_id)
+        batch = self._client.batch()
+        batch.create(
+            marker,
+            # Firestore の TTL ポリシーを expires_at に設定しておけば自動で掃除される
+            {
+                "events": len(events),
+                "end_gen": int(end[0]),
+                "end_offset": int(end[1]),
+                "created_at": now,
+                "expires_at": now + timedelta(days=30),
+            },
+        )
+        for (team_id, d, gem_name), g in gem_agg.items():
+            payload = {"date": d, "gem_name": gem_name, "updated_at": now}
+            payload.update({k: (v if k == "last_user_id" else inc(v)) for k, v in g.items()})
+            batch.set(self._gem_daily_ref(team_id=team_id, d=d, gem_name=gem_name), payload, merge=True)
+        for (team_id, d), t in tot_agg.items():
+            payload = {"date": d, "updated_at": now}
+            payload.update({k: inc(v) for k, v in t.items()})
+            batch.set(self._total_daily_ref(team_id=team_id, d=d), payload, merge=True)
+        try:
+            batch.commit()
+        except Exception as e:
+            if type(e).__name__ not in ("AlreadyExists", "Conflict"):
+                raise
+            d = marker.get().to_dict() or {}
+            return int(d.get("end_gen") or 0), int(d.get("end_offset") or 0)
+
+        # ユーザー別マップは近似値なので、日次カウントの反映後にベストエフォートで合流させる
+        # （ここで落ちた場合はそのバッチ分のユーザー内訳だけが欠ける。二重計上はしない）
+        for (team_id, d), counts in user_agg.items():
+            try:
+                self._merge_user_counts(team_id=team_id, d=d, counts=counts)
+            except Exception as e:
+                print(f"[metrics] user counts merge failed: {type(e).__name__} {e}")
+        return None
+
     def get_gem_usage_summary(self, *, team_id: str, days: int = 30, limit: int = 20) -> GemUsageSummary:
         days = max(1, min(days, 365))
         limit = max(1, min(limit, 100))
@@ -347,24 +846,61 @@ class FirestoreMetricsStore(MetricsStore):
             top_gems=top,
         )
 
-    def list_gem_usage_daily(self, *, team_id: str, days: int = 30) -> list[GemUsageRow]:
-        days = max(1, min(days, 365))
-        today = date.today()
-        start = today - timedelta(days=days - 1)
-
+    def _iter_gem_daily_rows(self, *, team_id: str, start: date, end: date):
         col = self._client.collection("workspaces").document(team_id).collection("gem_usage_daily")
+        # doc_id is `{date}__{gem_name}` so we can range by prefix
         start_id = f"{start.isoformat()}__"
-        end_id = f"{today.isoformat()}__\uf8ff"
+        end_id = f"{end.isoformat()}__\uf8ff"
         snaps = col.order_by("__name__").start_at({"__name__": start_id}).end_at({"__name__": end_id}).stream()
-        out: list[GemUsageRow] = []
         for s in snaps:
             d = s.to_dict() or {}
             gem = str(d.get("gem_name") or "")
             dtxt = str(d.get("date") or "")
             if not gem or not dtxt:
                 continue
-            out.append(
-                GemUsageRow(
+            yield GemUsageRow(
+                date=dtxt,
+                gem_name=gem,
+                count=int(d.get("count") or 0),
+                public_count=int(d.get("public_count") or 0),
+                ok_count=int(d.get("ok_count") or 0),
+                error_count=int(d.get("error_count") or 0),
+            )
+
+    def list_gem_usage_daily(self, *, team_id: str, days: int = 30) -> list[GemUsageRow]:
+        days, start, today = _usage_range(days)
+        out = list(self._iter_gem_daily_rows(team_id=team_id, start=start, end=today))
+        out.sort(key=lambda r: (r.date, r.gem_name))
+        return out
+
+    def get_usage_report(self, *, team_id: str, days: int = 30, limit: int = 20) -> GemUsageReport:
+        # gem_usage_daily の範囲クエリ 1 本だけで summary/by_day/top_gems/by_gem_day を作る
+        # （totals_daily の日数分 get と、同じ範囲の二重 stream を避ける）
+        days, start, today = _usage_range(days)
+        rows = list(self._iter_gem_daily_rows(team_id=team_id, start=start, end=today))
+        return _build_usage_report(team_id=team_id, days=days, start=start, today=today, rows=rows, limit=limit)
+
+    def iter_gem_usage_rows(self, *, team_id: str, from_date: date, to_date: date) -> Iterator[GemUsageRow]:
+        # 長期間のエクスポートでは 1 本の stream() が途中でタイムアウトし得るため、
+        # ページ単位（start_after）で読み進める。メモリはページサイズ分のみ。
+        col = self._client.collection("workspaces").document(team_id).collection("gem_usage_daily")
+        start_id = f"{from_date.isoformat()}__"
+        end_id = f"{to_date.isoformat()}__\uf8ff"
+        page_size = 500
+        last = None
+        while True:
+            q = col.order_by("__name__").end_at({"__name__": end_id}).limit(page_size)
+            q = q.start_after(last) if last is not None else q.start_at({"__name__": start_id})
+            n = 0
+            for s in q.stream():
+                n += 1
+                last = s
+                d = s.to_dict() or {}
+                gem = str(d.get("gem_name") or "")
+                dtxt = str(d.get("date") or "")
+                if not gem or not dtxt:
+                    continue
+                yield GemUsageRow(
                     date=dtxt,
                     gem_name=gem,
                     count=int(d.get("count") or 0),
@@ -372,9 +908,189 @@ class FirestoreMetricsStore(MetricsStore):
                     ok_count=int(d.get("ok_count") or 0),
                     error_count=int(d.get("error_count") or 0),
                 )
-            )
-        out.sort(key=lambda r: (r.date, r.gem_name))
-        return out
+            if n < page_size:
+                return
+
+    def get_top_users(self, *, team_id: str, days: int = 30, gem_name: str | None = None, limit: int = 20) -> dict:
+        days, start, today = _usage_range(days)
+        col = self._workspace_col(team_id=team_id, name="gem_usage_users_daily")
+        snaps = (
+            col.order_by("__name__")
+            .start_at({"__name__": start.isoformat()})
+            .end_at({"__name__": today.isoformat()})
+            .stream()
+        )
+        maps: list[tuple[dict[str, int], int]] = []
+        for s in snaps:
+            d = s.to_dict() or {}
+            if gem_name:
+                m = (d.get("gems") or {}).get(gem_name)
+                if m:
+                    maps.append((m, int((d.get("gem_floors") or {}).get(gem_name) or 0)))
+            else:
+                maps.append((d.get("team") or {}, int(d.get("team_floor") or 0)))
+        return merge_top_users(maps, limit)
+
+    def compact(self, *, team_id: str, older_than_days: int | None = None, dry_run: bool = False) -> CompactionResult:
+        cutoff = compaction_cutoff(
+            self._policy.daily_retention_days if older_than_days is None else older_than_days
+        )
+        users = self._delete_before(
+            team_id=team_id, name="gem_usage_users_daily", end_before_id=cutoff.isoformat(), dry_run=dry_run
+        )
+        gem = self._compact_collection(
+            team_id=team_id,
+            src="gem_usage_daily",
+            dst="gem_usage_monthly",
+            # workspaces/{team_id}/gem_usage_monthly/{YYYY-MM}__{gem_name}
+            dst_id=lambda d: f"{month_of(str(d.get('date') or ''))}__{d.get('gem_name') or ''}",
+            dst_fields=lambda d: {"month": month_of(str(d.get("date") or "")), "gem_name": str(d.get("gem_name") or "")},
+            count_fields=("count", "public_count", "ok_count", "error_count"),
+            end_before_id=f"{cutoff.isoformat()}__",
+            dry_run=dry_run,
+        )
+        tot = self._compact_collection(
+            team_id=team_id,
+            src="gem_usage_totals_daily",
+            dst="gem_usage_totals_monthly",
+            # workspaces/{team_id}/gem_usage_totals_monthly/{YYYY-MM}
+            dst_id=lambda d: month_of(str(d.get("date") or "")),
+            dst_fields=lambda d: {"month": month_of(str(d.get("date") or ""))},
+            count_fields=("total_count", "public_count", "ok_count", "error_count"),
+            end_before_id=cutoff.isoformat(),
+            dry_run=dry_run,
+        )
+        return CompactionResult(
+            team_id=team_id,
+            cutoff_date=cutoff.isoformat(),
+            dry_run=dry_run,
+            rows_compacted=gem["read"],
+            months_touched=len(gem["months"] | tot["months"]),
+            documents_written=gem["written"] + tot["written"],
+            documents_deleted=gem["deleted"] + tot["deleted"] + users["deleted"],
+            bytes_reclaimed=gem["bytes"] + tot["bytes"] + users["bytes"],
+        )
+
+    def _delete_before(self, *, team_id: str, name: str, end_before_id: str, dry_run: bool) -> dict:
+        # ロールアップ不要なコレクション（ユーザー別マップ）はそのまま削除する
+        col = self._workspace_col(team_id=team_id, name=name)
+        page_size = self._policy.batch_size
+        deleted = freed = conflicts = 0
+        last = None
+        while True:
+            q = col.order_by("__name__").end_before({"__name__": end_before_id}).limit(page_size)
+            if dry_run and last is not None:
+                q = q.start_after(last)
+            snaps = list(q.stream())
+            if not snaps:
+                break
+            page_bytes = 0
+            for s in snaps:
+                page_bytes += estimate_firestore_doc_bytes(["workspaces", team_id, name, s.id], s.to_dict() or {})
+            last = snaps[-1]
+            if not dry_run:
+                batch = self._client.batch()
+                for s in snaps:
+                    batch.delete(s.reference, option=self._unchanged_since_read(s))
+                if not self._commit_compaction(batch, conflicts):
+                    conflicts += 1
+                    continue
+            deleted += len(snaps)
+            freed += page_bytes
+            if len(snaps) < page_size:
+                break
+        return {"deleted": deleted, "bytes": freed}
+
+    def _unchanged_since_read(self, snap):  # noqa: ANN001, ANN202
+        # 読んだ後に record_gem_run などの更新が入っていたら消さない（その書き込みを失わないように）
+        return self._client.write_option(last_update_time=snap.update_time)
+
+    def _commit_compaction(self, batch, conflicts: int) -> bool:  # noqa: ANN001
+        """
+        前提条件付きの WriteBatch をコミットする。読んだ後に元ドキュメントが更新されていたら
+        バッチ全体が適用されない（ロールアップも削除も入らない）ので False を返し、呼び出し側がページを読み直す。
+        """
+        from google.api_core.exceptions import FailedPrecondition  # type: ignore
+
+        try:
+            batch.commit()
+            return True
+        except FailedPrecondition:
+            if conflicts >= _COMPACTION_MAX_CONFLICTS:
+                raise
+            return False
+
+    def _compact_collection(
+        self,
+        *,
+        team_id: str,
+        src: str,
+        dst: str,
+        dst_id,  # noqa: ANN001
+        dst_fields,  # noqa: ANN001
+        count_fields: tuple[str, ...],
+        end_before_id: str,
+        dry_run: bool,
+    ) -> dict:
+        """
+        src の `end_before_id` より前のドキュメントを batch_size ずつ読み、
+        月次ロールアップへの Increment と元ドキュメントの削除を同じ WriteBatch でコミットする。
+        （バッチ単位で原子的なので、途中で落ちても二重計上/取りこぼしにならない）
+        削除は「読んだときから更新されていない」ことを前提条件にする。読んだ後に record_gem_run の Increment が
+        入っていたらバッチごと適用されないので、そのページを読み直してやり直す。
+        """
+        inc = self._firestore.Increment  # type: ignore[attr-defined]
+        src_col = self._workspace_col(team_id=team_id, name=src)
+        dst_col = self._workspace_col(team_id=team_id, name=dst)
+        page_size = self._policy.batch_size
+
+        read = written = deleted = freed = conflicts = 0
+        months: set[str] = set()
+        last = None
+        while True:
+            q = src_col.order_by("__name__").end_before({"__name__": end_before_id}).limit(page_size)
+            if dry_run and last is not None:
+                # dry_run では削除しないので、読み進める位置を自前で持つ
+                q = q.start_after(last)
+            snaps = list(q.stream())
+            if not snaps:
+                break
+
+            rollups: dict[str, dict] = {}
+            page_bytes = 0
+            for s in snaps:
+                d = s.to_dict() or {}
+                page_bytes += estimate_firestore_doc_bytes(["workspaces", team_id, src, s.id], d)
+                key = dst_id(d)
+                r = rollups.get(key) or {**dst_fields(d), **{f: 0 for f in count_fields}}
+                for f in count_fields:
+                    r[f] += int(d.get(f) or 0)
+                rollups[key] = r
+            last = snaps[-1]
+
+            if not dry_run:
+                now = datetime.now(timezone.utc)
+                batch = self._client.batch()
+                for key, r in rollups.items():
+                    payload = {k: (inc(v) if k in count_fields else v) for k, v in r.items()}
+                    payload["updated_at"] = now
+                    batch.set(dst_col.document(key), payload, merge=True)
+                for s in snaps:
+                    batch.delete(s.reference, option=self._unchanged_since_read(s))
+                if not self._commit_compaction(batch, conflicts):
+                    conflicts += 1
+                    continue
+
+            read += len(snaps)
+            written += len(rollups)
+            deleted += len(snaps)
+            freed += page_bytes
+            months.update(key[:7] for key in rollups)
+
+            if len(snaps) < page_size:
+                break
+
+        return {"read": read, "written": written, "deleted": deleted, "bytes": freed, "months": months}
 
 
 def build_metrics_store() -> MetricsStore:
@@ -391,14 +1107,14 @@ def build_metrics_store() -> MetricsStore:
     if backend == "memory":
         return InMemoryMetricsStore()
     if backend == "firestore":
-        return FirestoreMetricsStore()
+        return _with_spool(FirestoreMetricsStore())
 
     if backend != "auto":
         raise RuntimeError("GEM_METRICS_BACKEND は `auto` / `firestore` / `memory` / `none` のいずれかにしてください")
 
     in_cloud_run = bool(os.environ.get("K_SERVICE"))
     try:
-        return FirestoreMetricsStore()
+        return _with_spool(FirestoreMetricsStore())
     except Exception as e:
         if in_cloud_run:
             detail = (str(e) or type(e).__name__).strip().replace("\n", " ")
@@ -411,3 +1127,15 @@ def build_metrics_store() -> MetricsStore:
         print(f"[metrics] Firestore unavailable; falling back to memory store: {type(e).__name__} {e}")
         return InMemoryMetricsStore()
 
+
+def _with_spool(store: MetricsStore) -> MetricsStore:
+    """
+    `GEM_METRICS_SPOOL_DIR` が設定されていれば、記録をローカル spool 経由（非同期・冪等）にする。
+    Firestore が遅い/落ちている間も record_gem_run は即 return し、復旧後に取りこぼしなく反映される。
+    """
+    spool_dir = (os.environ.get("GEM_METRICS_SPOOL_DIR") or "").strip()
+    if not spool_dir:
+        return store
+    from .spool import MetricsSpool, SpooledMetricsStore
+
+    return SpooledMetricsStore(store, MetricsSpool(spool_dir))
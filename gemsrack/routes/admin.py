@@ -1,12 +1,46 @@
 from __future__ import annotations
 
-from flask import Blueprint, Response, current_app, jsonify, request, session
+import csv
+import io
+import json
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
 
+from flask import Blueprint, Response, current_app, jsonify, request, session, stream_with_context
+
+from ..ai.aio import shared_background_loop
+from ..ai.context_cache import shared_context_cache
+from ..ai.gemini import build_gemini_client
+from ..ai.http import PooledSession
+from ..ai.ratelimit import shared_rate_limiter
+from ..ai.resilience import shared_resilience
+from ..ai.routing import shared_model_router
+from ..ai.tokens import shared_token_budget
+from ..gems.batch import shared_batch_runner
+from ..gems.cache import shared_result_cache
+from ..gems.images import shared_image_cache, shared_image_processor
+from ..gems.service import iter_gem_batch, prepare_batch
+from ..gems.singleflight import shared_single_flight
 from ..gems.store import GemStore, validate_gem_name
+from ..metrics.live import LiveUsageRing
+from ..metrics.runlog import RunEventLog
 from ..metrics.store import MetricsStore
+from ..slack.background import shared_background_executor
+from ..slack.jobs import current_job_worker
 
 admin_bp = Blueprint("admin", __name__, url_prefix="/api/admin")
 
+# SSE は接続中ずっとワーカースレッドを占有するため、同時接続数（プロセスごと）と 1 接続の寿命を制限する。
+# 集計（リング）は全接続で共有するが、接続ごとにスレッドを 1 本使う。寿命を短くして、通常のリクエストにスレッドを返す
+# （EventSource は切断後に Last-Event-ID 付きで自動再接続するので、差分は途切れない）
+_LIVE_MAX_STREAMS = max(1, int(os.environ.get("GEM_METRICS_LIVE_MAX_STREAMS") or 4))
+_LIVE_STREAM_SLOTS = threading.BoundedSemaphore(_LIVE_MAX_STREAMS)
+_LIVE_STREAM_SECONDS = 60.0
+_LIVE_HEARTBEAT_SECONDS = 15.0
+_LIVE_MIN_PUSH_INTERVAL = 1.0
+
 
 def _require_admin() -> Response | None:
     # セッションログイン必須（Admin UI と完全分離）
@@ -66,6 +100,8 @@ def admin_list_gems() -> Response:
                     "name": g.name,
                     "summary": g.summary,
                     "enabled": bool(getattr(g, "enabled", True)),
+                    "cache_results": bool(getattr(g, "cache_results", True)),
+                    "generation": g.generation.to_dict(),
                     "input_format": g.input_format,
                     "output_format": g.output_format,
                     "updated_at": g.updated_at.isoformat(),
@@ -87,15 +123,94 @@ def admin_patch_gem(name: str) -> Response:
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     body = request.get_json(silent=True) or {}
-    if "enabled" not in body:
-        return jsonify({"error": "enabled is required"}), 400
-    enabled = bool(body.get("enabled"))
+    if "enabled" not in body and "cache_results" not in body:
+        return jsonify({"error": "enabled or cache_results is required"}), 400
 
     store = _store()
-    updated = store.set_enabled(team_id=team_id, name=n, enabled=enabled, updated_by=None)
-    if not updated:
+    updated = None
+    if "enabled" in body:
+        updated = store.set_enabled(team_id=team_id, name=n, enabled=bool(body.get("enabled")), updated_by=None)
+        if not updated:
+            return jsonify({"error": "not_found"}), 404
+    if "cache_results" in body:
+        updated = store.set_cache_results(
+            team_id=team_id, name=n, cache_results=bool(body.get("cache_results")), updated_by=None
+        )
+        if not updated:
+            return jsonify({"error": "not_found"}), 404
+    assert updated is not None
+    return jsonify(
+        {
+            "team_id": team_id,
+            "gem": {"name": updated.name, "enabled": updated.enabled, "cache_results": updated.cache_results},
+        }
+    )
+
+
+@admin_bp.post("/gems/<name>/batch")
+def admin_batch_gem(name: str) -> Response:
+    """
+    1 つの Gem を複数の入力で実行し、完了した順に NDJSON で返す（最後の行は集計）。
+
+    body: `{"items": ["...", ...]}` または `{"input": "1 行 1 件 / JSON 配列 / NDJSON"}`
+    """
+    err = _require_admin()
+    if err is not None:
+        return err
+    team_id = _team_id()
+    try:
+        n = validate_gem_name(name)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    body = request.get_json(silent=True) or {}
+    raw = body.get("items")
+    if isinstance(raw, list):
+        raw = json.dumps(raw, ensure_ascii=False)
+    elif not isinstance(raw, str):
+        raw = body.get("input") if isinstance(body.get("input"), str) else ""
+
+    gem = _store().get(team_id=team_id, name=n)
+    if not gem:
         return jsonify({"error": "not_found"}), 404
-    return jsonify({"team_id": team_id, "gem": {"name": updated.name, "enabled": updated.enabled}})
+    if not bool(getattr(gem, "enabled", True)):
+        return jsonify({"error": "disabled"}), 409
+    runner = shared_batch_runner()
+    items, msg = prepare_batch(gem, raw, max_items=runner.max_items)
+    if msg:
+        return jsonify({"error": msg, "max_items": runner.max_items}), 400
+
+    gemini = build_gemini_client()
+    metrics_store = current_app.extensions.get("metrics_store")
+
+    def _ndjson():
+        started = time.perf_counter()
+        ok_count = 0
+        for r in iter_gem_batch(
+            gem=gem,
+            team_id=team_id,
+            user_id=None,
+            items=items,
+            gemini=gemini,
+            metrics_store=metrics_store,
+            runner=runner,
+        ):
+            ok_count += int(r.ok)
+            yield json.dumps(r.to_dict(), ensure_ascii=False) + "\n"
+        yield json.dumps(
+            {
+                "summary": True,
+                "gem_name": n,
+                "total": len(items),
+                "ok": ok_count,
+                "failed": len(items) - ok_count,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000.0, 1),
+            },
+            ensure_ascii=False,
+        ) + "\n"
+
+    resp = Response(stream_with_context(_ndjson()), mimetype="application/x-ndjson")
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
 
 
 @admin_bp.get("/usage")
@@ -112,9 +227,12 @@ def admin_usage() -> Response:
     days = max(1, min(days, 365))
 
     metrics = _metrics()
-    summary = metrics.get_gem_usage_summary(team_id=team_id, days=days, limit=50)
-    daily = metrics.list_gem_usage_daily(team_id=team_id, days=days)
-    return jsonify(
+    # summary と by_gem_day を 1 回の走査で作る（Firestore では範囲クエリ 1 本）
+    t0 = time.perf_counter()
+    report = metrics.get_usage_report(team_id=team_id, days=days, limit=50)
+    elapsed_ms = (time.perf_counter() - t0) * 1000.0
+    summary = report.summary
+    resp = jsonify(
         {
             "team_id": team_id,
             "days": days,
@@ -137,8 +255,317 @@ def admin_usage() -> Response:
                     "ok_count": r.ok_count,
                     "error_count": r.error_count,
                 }
-                for r in daily
+                for r in report.by_gem_day
             ],
+            "elapsed_ms": round(elapsed_ms, 1),
+        }
+    )
+    # 集計にかかった時間をブラウザの DevTools でも確認できるようにする
+    resp.headers["Server-Timing"] = f"usage;dur={elapsed_ms:.1f}"
+    return resp
+
+
+@admin_bp.get("/usage/users")
+def admin_usage_users() -> Response:
+    err = _require_admin()
+    if err is not None:
+        return err
+    team_id = _team_id()
+    try:
+        days = int((request.args.get("days") or "").strip() or 30)
+    except ValueError:
+        days = 30
+    days = max(1, min(days, 365))
+    try:
+        limit = int((request.args.get("limit") or "").strip() or 20)
+    except ValueError:
+        limit = 20
+    limit = max(1, min(limit, 100))
+    gem_name = (request.args.get("gem") or "").strip() or None
+
+    top = _metrics().get_top_users(team_id=team_id, days=days, gem_name=gem_name, limit=limit)
+    return jsonify({"team_id": team_id, "days": days, "gem_name": gem_name, **top})
+
+
+_EXPORT_COLUMNS = ["date", "gem_name", "count", "public_count", "ok_count", "error_count"]
+
+
+def _parse_date(v: str) -> date:
+    try:
+        return date.fromisoformat(v)
+    except ValueError:
+        raise ValueError(f"日付は YYYY-MM-DD 形式で指定してください: {v}") from None
+
+
+@admin_bp.get("/usage/export")
+def admin_usage_export() -> Response:
+    """
+    日別×Gem の利用明細をストリーミングで書き出す（表計算ソフト取り込み用）。
+
+    - `format`: `csv`(既定) / `ndjson`
+    - `from` / `to`: YYYY-MM-DD（範囲上限なし）。未指定なら `days`（既定 30）から算出
+    """
+    err = _require_admin()
+    if err is not None:
+        return err
+    team_id = _team_id()
+    fmt = (request.args.get("format") or "csv").strip().lower()
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"error": "format は `csv` / `ndjson` のいずれかにしてください"}), 400
+
+    today = date.today()
+    from_raw = (request.args.get("from") or "").strip()
+    to_raw = (request.args.get("to") or "").strip()
+    try:
+        to_date = _parse_date(to_raw) if to_raw else today
+        if from_raw:
+            from_date = _parse_date(from_raw)
+        else:
+            days_raw = (request.args.get("days") or "").strip()
+            days = int(days_raw) if days_raw else 30
+            from_date = to_date - timedelta(days=max(1, days) - 1)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if from_date > to_date:
+        return jsonify({"error": "from は to 以前の日付にしてください"}), 400
+
+    metrics = _metrics()
+    rows = metrics.iter_gem_usage_rows(team_id=team_id, from_date=from_date, to_date=to_date)
+
+    def _csv():
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(_EXPORT_COLUMNS)
+        for r in rows:
+            w.writerow([r.date, r.gem_name, r.count, r.public_count, r.ok_count, r.error_count])
+            # 1 行ずつ吐き出してバッファを空にする（メモリ使用量を範囲/件数に依存させない）
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+        yield buf.getvalue()
+
+    def _ndjson():
+        for r in rows:
+            yield json.dumps(
+                {
+                    "date": r.date,
+                    "gem_name": r.gem_name,
+                    "count": r.count,
+                    "public_count": r.public_count,
+                    "ok_count": r.ok_count,
+                    "error_count": r.error_count,
+                },
+                ensure_ascii=False,
+            ) + "\n"
+
+    if fmt == "csv":
+        body, mimetype, ext = _csv(), "text/csv", "csv"
+    else:
+        body, mimetype, ext = _ndjson(), "application/x-ndjson", "ndjson"
+
+    # Content-Length を付けないので chunked transfer encoding で返る
+    resp = Response(stream_with_context(body), mimetype=mimetype)
+    filename = f"gem-usage_{team_id}_{from_date.isoformat()}_{to_date.isoformat()}.{ext}"
+    resp.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@admin_bp.post("/metrics/compact")
+def admin_metrics_compact() -> Response:
+    """
+    古い日次行を月次ロールアップに畳んで削除する（保持期間ポリシーの手動実行）。
+    body: `{"older_than_days": 400, "dry_run": false}`（いずれも任意）
+    """
+    err = _require_admin()
+    if err is not None:
+        return err
+    team_id = _team_id()
+    body = request.get_json(silent=True) or {}
+    older_than_days = body.get("older_than_days")
+    if older_than_days is not None:
+        try:
+            older_than_days = max(1, int(older_than_days))
+        except Exception:
+            return jsonify({"error": "older_than_days は整数で指定してください"}), 400
+    dry_run = bool(body.get("dry_run"))
+
+    metrics = _metrics()
+    t0 = time.perf_counter()
+    result = metrics.compact(team_id=team_id, older_than_days=older_than_days, dry_run=dry_run)
+    elapsed_ms = (time.perf_counter() - t0) * 1000.0
+    return jsonify({**result.to_dict(), "elapsed_ms": round(elapsed_ms, 1)})
+
+
+def _sse(event: str, data: dict, *, event_id: int | None = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(data, ensure_ascii=False))
+    return "\n".join(lines) + "\n\n"
+
+
+@admin_bp.get("/usage/live")
+def admin_usage_live() -> Response:
+    """
+    直近の利用状況を Server-Sent Events で配信する。
+
+    - 初回: `event: snapshot`（リング内の全バケット）
+    - 以降: `event: delta`（前回以降に更新されたバケットのみ。最短 1 秒間隔にまとめる）
+    - `id:` はリングの version。再接続時の `Last-Event-ID` から差分を再開する
+    """
+    err = _require_admin()
+    if err is not None:
+        return err
+    live = current_app.extensions.get("metrics_live")
+    if not isinstance(live, LiveUsageRing):
+        return jsonify({"error": "metrics_unavailable", "message": "live metrics is not initialized"}), 503
+    if not _LIVE_STREAM_SLOTS.acquire(blocking=False):
+        resp = jsonify({"error": "too_many_streams", "max_streams": _LIVE_MAX_STREAMS})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = "10"
+        return resp
+
+    # 枠はレスポンスを閉じたときに返す（本文を読まずに終わる HEAD や、最初の送信前の切断でも close は呼ばれる）
+    released = threading.Lock()
+
+    def _release_slot() -> None:
+        if released.acquire(blocking=False):
+            _LIVE_STREAM_SLOTS.release()
+
+    team_id = _team_id()
+    last_id_raw = (request.headers.get("Last-Event-ID") or "").strip()
+    try:
+        last_id = int(last_id_raw) if last_id_raw else None
+    except ValueError:
+        last_id = None
+
+    def _events():
+        try:
+            meta = {"team_id": team_id, "bucket_seconds": live.bucket_seconds, "size": live.size}
+            if last_id is None or last_id > live.version:
+                version, buckets = live.snapshot(team_id=team_id)
+                yield "retry: 3000\n" + _sse("snapshot", {**meta, "buckets": buckets}, event_id=version)
+            else:
+                version, buckets = live.snapshot(team_id=team_id, since_version=last_id)
+                yield "retry: 3000\n" + _sse("delta", {**meta, "buckets": buckets}, event_id=version)
+
+            deadline = time.monotonic() + _LIVE_STREAM_SECONDS
+            while (remaining := deadline - time.monotonic()) > 0:
+                v = live.wait_for_change(since_version=version, timeout=min(_LIVE_HEARTBEAT_SECONDS, remaining))
+                if v == version:
+                    yield ": ping\n\n"
+                    continue
+                # 連続した記録は 1 回の delta にまとめる
+                time.sleep(_LIVE_MIN_PUSH_INTERVAL)
+                version, buckets = live.snapshot(team_id=team_id, since_version=version)
+                if buckets:
+                    yield _sse("delta", {**meta, "buckets": buckets}, event_id=version)
+        finally:
+            _release_slot()
+
+    try:
+        resp = Response(stream_with_context(_events()), mimetype="text/event-stream")
+    except BaseException:
+        _release_slot()
+        raise
+    resp.call_on_close(_release_slot)
+    resp.headers["Cache-Control"] = "no-store"
+    # Cloud Run 等の前段プロキシでバッファリングさせない
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+def _parse_datetime(v: str) -> datetime:
+    try:
+        dt = datetime.fromisoformat(v.replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"日時は ISO 8601 形式で指定してください: {v}") from None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+@admin_bp.get("/runs")
+def admin_runs() -> Response:
+    """
+    実行単位のログを検索する（新しい順）。
+
+    - `since` / `until`: ISO 8601。未指定なら直近 `minutes`（既定 60）
+    - `gem`: Gem名で絞り込み
+    - `status`: `ok` / `error`
+    - `limit`: 最大件数（既定 200、上限 1000）
+    """
+    err = _require_admin()
+    if err is not None:
+        return err
+    log = current_app.extensions.get("run_log")
+    if not isinstance(log, RunEventLog):
+        msg = current_app.extensions.get("run_log_error") or "run log is not initialized"
+        return jsonify({"error": "run_log_unavailable", "message": str(msg)}), 503
+    team_id = _team_id()
+
+    now = datetime.now(timezone.utc)
+    try:
+        until_raw = (request.args.get("until") or "").strip()
+        until = _parse_datetime(until_raw) if until_raw else now
+        since_raw = (request.args.get("since") or "").strip()
+        if since_raw:
+            since = _parse_datetime(since_raw)
+        else:
+            minutes = int((request.args.get("minutes") or "").strip() or 60)
+            since = until - timedelta(minutes=max(1, minutes))
+        limit = int((request.args.get("limit") or "").strip() or 200)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    limit = max(1, min(limit, 1000))
+
+    gem_name = (request.args.get("gem") or "").strip().lower() or None
+    status = (request.args.get("status") or "").strip().lower()
+    ok = True if status == "ok" else False if status == "error" else None
+
+    t0 = time.perf_counter()
+    events = log.query(team_id=team_id, since=since, until=until, gem_name=gem_name, ok=ok, limit=limit)
+    elapsed_ms = (time.perf_counter() - t0) * 1000.0
+    return jsonify(
+        {
+            "team_id": team_id,
+            "since": since.isoformat(),
+            "until": until.isoformat(),
+            "count": len(events),
+            "runs": [e.to_dict() for e in events],
+            "elapsed_ms": round(elapsed_ms, 1),
         }
     )
 
+
+@admin_bp.get("/gemini/stats")
+def admin_gemini_stats() -> Response:
+    err = _require_admin()
+    if err is not None:
+        return err
+    http: PooledSession | None = current_app.extensions.get("gemini_http")
+    cache = shared_result_cache()
+    context_cache = shared_context_cache()
+    flights = shared_single_flight()
+    limiter = shared_rate_limiter()
+    image_cache = shared_image_cache()
+    processor = shared_image_processor()
+    worker = current_job_worker()
+    return jsonify(
+        {
+            "http": http.stats() if http is not None else None,
+            "result_cache": cache.stats() if cache is not None else None,
+            "context_cache": context_cache.stats() if context_cache is not None else None,
+            "resilience": shared_resilience().stats(),
+            "single_flight": flights.stats() if flights is not None else None,
+            "token_budget": shared_token_budget().stats(),
+            "routing": shared_model_router().stats(),
+            "rate_limit": limiter.stats() if limiter is not None else None,
+            "batch": shared_batch_runner().stats(),
+            "async_loop": shared_background_loop().stats(),
+            "image_cache": image_cache.stats() if image_cache is not None else None,
+            "image_processor": processor.stats() if processor is not None else None,
+            "slack_background": shared_background_executor().stats(),
+            "jobs": worker.stats() if worker is not None else None,
+        }
+    )
@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import atexit
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from ..config import Shared, env_int
+
+
+class BackgroundQueueFullError(RuntimeError):
+    """待ち行列が一杯（または停止中）で、バックグラウンド処理を受け付けなかった"""
+
+
+@dataclass(eq=False)
+class _Task:
+    name: str
+    fn: Callable[[], Any]
+    timeout: float
+    on_timeout: Callable[[], None] | None
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.monotonic)
+    started_at: float = 0.0
+    timed_out: bool = False
+
+
+class BackgroundExecutor:
+    """
+    Slack の ack 後に行う処理（モーダルの保存・実行など）を流す共有のワーカープール。
+
+    - ワーカーは workers 本まで（必要になったときに起こす）。バーストでスレッドを際限なく増やさない
+    - 待ち行列は max_queue 件まで。超えたら submit が BackgroundQueueFullError（呼び出し側で「混み合っています」を返す）
+    - task_timeout 秒を超えて実行中のタスクは on_timeout を 1 回呼んで数える（Python のスレッドは止められないので、
+      打ち切りは Gemini の全体期限などタスク側に任せる）
+    - 停止時（SIGTERM → atexit）は新規を断り、drain_seconds まで実行中・待ち中のタスクの完了を待つ
+    タスクは submit した時点の contextvars（Flask の app context など）で実行する。
+    """
+
+    def __init__(
+        self,
+        *,
+        workers: int = 4,
+        max_queue: int = 64,
+        task_timeout: float = 300.0,
+        name: str = "slack-bg",
+    ) -> None:
+        self.workers = max(1, int(workers))
+        self.max_queue = max(0, int(max_queue))
+        self.task_timeout = max(0.0, float(task_timeout))
+        self.name = name
+        self._cond = threading.Condition()
+        self._queue: deque[_Task] = deque()
+        self._running: set[_Task] = set()
+        self._waiting: set[_Task] = set()
+        self._threads: list[threading.Thread] = []
+        self._idle = 0
+        self._closing = False
+        self._watchdog: threading.Thread | None = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.dropped = 0
+        self.overflowed = 0
+        self.max_active = 0
+        self._waits: deque[float] = deque(maxlen=512)
+        self._runs: deque[float] = deque(maxlen=512)
+
+    def submit(
+        self,
+        name: str,
+        fn: Callable[..., Any],
+        *args: Any,
+        timeout: float | None = None,
+        on_timeout: Callable[[], None] | None = None,
+        **kwargs: Any,
+    ) -> Future:
+        """fn(*args, **kwargs) を待ち行列に入れる。一杯なら BackgroundQueueFullError"""
+        ctx = contextvars.copy_context()
+        task = _Task(
+            name=name,
+            fn=lambda: ctx.run(fn, *args, **kwargs),
+            timeout=self.task_timeout if timeout is None else max(0.0, float(timeout)),
+            on_timeout=on_timeout,
+        )
+        with self._cond:
+            if self._closing or len(self._queue) >= self.max_queue + max(0, self._idle):
+                self.rejected += 1
+                raise BackgroundQueueFullError(
+                    f"background queue is full ({len(self._queue)} queued, {len(self._running)} running)"
+                )
+            self._queue.append(task)
+            self.submitted += 1
+            # 待ちが空きワーカーより多ければ、上限まで 1 本起こす（起きたばかりのワーカーが拾う前の分も数える）
+            if len(self._queue) > self._idle and len(self._threads) < self.workers:
+                self._start_worker_locked()
+            self._cond.notify()
+        return task.future
+
+    def when_done(
+        self,
+        name: str,
+        future: Future,
+        fn: Callable[[Future], Any],
+        *,
+        timeout: float | None = None,
+        on_timeout: Callable[[], None] | None = None,
+    ) -> Future:
+        """
+        future が終わったら fn(future) をプールで実行する（待つためにスレッドを塞がない）。fn の戻り値の Future を返す。
+        - fn は呼び出した時点の contextvars で実行する
+        - future が timeout 秒（既定 task_timeout）を超えても終わらなければ on_timeout を 1 回呼ぶ（submit と同じ扱い）
+        - プールが一杯（または停止中）なら、取りこぼさないように専用スレッドで実行する
+        """
+        ctx = contextvars.copy_context()
+        out: Future = Future()
+        wait = _Task(
+            name=name,
+            fn=lambda: None,
+            timeout=self.task_timeout if timeout is None else max(0.0, float(timeout)),
+            on_timeout=on_timeout,
+            started_at=time.monotonic(),
+        )
+
+        def _run(f: Future) -> None:
+            try:
+                out.set_result(ctx.run(fn, f))
+            except BaseException as e:
+                print(f"[bg] task {name} failed: {type(e).__name__} {e}")
+                out.set_exception(e)
+
+        def _resume(f: Future) -> None:
+            # 完了させたスレッド（イベントループなど）で呼ばれるので、ここでは渡すだけにする
+            with self._cond:
+                self._waiting.discard(wait)
+            try:
+                self.submit(name, _run, f)
+            except BackgroundQueueFullError:
+                with self._cond:
+                    self.overflowed += 1
+                threading.Thread(target=_run, args=(f,), name=f"{self.name}-overflow", daemon=True).start()
+
+        with self._cond:
+            self._waiting.add(wait)
+            if wait.timeout:
+                self._start_watchdog_locked()
+        future.add_done_callback(_resume)
+        return out
+
+    def _start_worker_locked(self) -> None:
+        t = threading.Thread(target=self._work, name=f"{self.name}-{len(self._threads) + 1}", daemon=True)
+        self._threads.append(t)
+        t.start()
+        if self.task_timeout > 0:
+            self._start_watchdog_locked()
+
+    def _start_watchdog_locked(self) -> None:
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name=f"{self.name}-watchdog", daemon=True)
+            self._watchdog.start()
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                self._idle += 1
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                self._idle -= 1
+                if not self._queue:
+                    return
+                task = self._queue.popleft()
+                task.started_at = time.monotonic()
+                self._running.add(task)
+                self.max_active = max(self.max_active, len(self._running))
+                self._waits.append(task.started_at - task.enqueued_at)
+            if task.future.set_running_or_notify_cancel():
+                try:
+                    task.future.set_result(task.fn())
+                    ok = True
+                except BaseException as e:
+                    print(f"[bg] task {task.name} failed: {type(e).__name__} {e}")
+                    task.future.set_exception(e)
+                    ok = False
+            else:
+                ok = True
+            with self._cond:
+                self._running.discard(task)
+                self._runs.append(time.monotonic() - task.started_at)
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self._cond.notify_all()
+
+    def _watch(self) -> None:
+        while True:
+            overdue: list[_Task] = []
+            with self._cond:
+                if self._closing and not self._running and not self._queue:
+                    return
+                now = time.monotonic()
+                for task in self._running | self._waiting:
+                    if task.timeout and not task.timed_out and now - task.started_at > task.timeout:
+                        task.timed_out = True
+                        self.timed_out += 1
+                        overdue.append(task)
+            for task in overdue:
+                print(f"[bg] task {task.name} exceeded {task.timeout:.0f}s; still running")
+                if task.on_timeout is not None:
+                    try:
+                        task.on_timeout()
+                    except Exception as e:
+                        print(f"[bg] on_timeout for {task.name} failed: {type(e).__name__} {e}")
+            time.sleep(1.0)
+
+    def shutdown(self, *, timeout: float = 8.0) -> bool:
+        """新規を断り、timeout 秒まで完了を待つ。待ちきれなかった待ち中のタスクは捨てる。すべて終われば True"""
+        deadline = time.monotonic() + max(0.0, timeout)
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+            while self._queue or self._running:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            drained = not self._queue and not self._running
+            dropped = list(self._queue)
+            self._queue.clear()
+            self.dropped += len(dropped)
+            running = len(self._running)
+        for task in dropped:
+            task.future.cancel()
+        if not drained:
+            print(f"[bg] shutdown: dropped {len(dropped)} queued task(s); {running} still running")
+        return drained
+
+    def stats(self) -> dict:
+        def _pct(xs: list[float], q: float) -> float | None:
+            return round(xs[min(len(xs) - 1, int(len(xs) * q))] * 1000.0, 1) if xs else None
+
+        with self._cond:
+            waits = sorted(self._waits)
+            runs = sorted(self._runs)
+            return {
+                "workers": self.workers,
+                "threads": len(self._threads),
+                "active": len(self._running),
+                "waiting": len(self._waiting),
+                "max_active": self.max_active,
+                "queued": len(self._queue),
+                "max_queue": self.max_queue,
+                "task_timeout_seconds": self.task_timeout,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "dropped": self.dropped,
+                "overflowed": self.overflowed,
+                "queue_wait_ms": {"p50": _pct(waits, 0.5), "p95": _pct(waits, 0.95), "max": _pct(waits, 1.0)},
+                "run_ms": {"p50": _pct(runs, 0.5), "p95": _pct(runs, 0.95), "max": _pct(runs, 1.0)},
+                "closing": self._closing,
+            }
+
+
+_shared: Shared[BackgroundExecutor] = Shared()
+
+
+def shared_background_executor() -> BackgroundExecutor:
+    """
+    プロセス内で共有するワーカープール（終了時に drain する）。
+    - `GEM_BG_WORKERS`: ワーカー数（既定 4）
+    - `GEM_BG_MAX_QUEUE`: 待ち行列の上限（既定 64）
+    - `GEM_BG_TASK_TIMEOUT_SECONDS`: これを超えて実行中のタスクを知らせる（既定 300。0 で無効）
+    - `GEM_BG_DRAIN_SECONDS`: 停止時に完了を待つ秒数（既定 8。Cloud Run は SIGTERM から 10 秒で強制終了）
+    """
+
+    def _build() -> BackgroundExecutor:
+        executor = BackgroundExecutor(
+            workers=env_int("GEM_BG_WORKERS", 4),
+            max_queue=env_int("GEM_BG_MAX_QUEUE", 64),
+            task_timeout=env_int("GEM_BG_TASK_TIMEOUT_SECONDS", 300),
+        )
+        atexit.register(executor.shutdown, timeout=env_int("GEM_BG_DRAIN_SECONDS", 8))
+        return executor
+
+    return _shared.get(_build)
@@ -2,17 +2,22 @@ from __future__ import annotations
 
 import json
 import shlex
-import threading
+from concurrent.futures import Future
 
 from flask import current_app
+from slack_bolt.context.respond import Respond
 from slack_sdk.errors import SlackApiError, SlackRequestError
 
 from ...ai import build_gemini_client
 from ...gems.store import build_store
-from ...gems.service import handle_gem_command, parse_public_flag
-from ...gems.store import validate_gem_name
+from ...gems.jobs import GemJob, new_job_id, shared_job_queue
+from ...gems.service import handle_gem_command, parse_public_flag, run_command_gem_name, start_gem_command
+from ...gems.store import parse_generation_config, validate_gem_name
 from ...gems.formats import INPUT_FORMATS, OUTPUT_FORMATS
 from ...metrics.store import MetricsStore, NoopMetricsStore
+from ..background import BackgroundQueueFullError, shared_background_executor
+from ..jobs import start_job_worker
+from ..progress import ChannelMessageProgress, ResponseUrlProgress
 
 
 def register(slack_app) -> None:  # noqa: ANN001
@@ -21,6 +26,8 @@ def register(slack_app) -> None:  # noqa: ANN001
     _store_error: str | None = None
     _metrics: MetricsStore | None = None
     _metrics_error: str | None = None
+    # ack 後の処理はスレッドを都度立てず、共有のワーカープールに流す（上限・停止時の drain つき）
+    background = shared_background_executor()
 
     def _get_store():  # noqa: ANN001
         nonlocal _store, _store_error
@@ -71,6 +78,126 @@ def register(slack_app) -> None:  # noqa: ANN001
         _metrics_error = "metrics store is not initialized"
         return _metrics, _metrics_error
 
+    def _submit_background(task_name, fn, *, client, channel_id, user_id, on_timeout=None) -> None:  # noqa: ANN001
+        try:
+            background.submit(task_name, fn, on_timeout=on_timeout)
+        except BackgroundQueueFullError as e:
+            print(f"[gem] {task_name} rejected: {e}")
+            if channel_id and user_id:
+                try:
+                    client.chat_postEphemeral(
+                        channel=channel_id,
+                        user=user_id,
+                        text="ただいま混み合っているため受け付けられませんでした。少し待ってからもう一度お試しください。",
+                    )
+                except Exception:
+                    pass
+
+    def _run_job(job: GemJob) -> tuple[dict, bool] | Future[tuple[dict, bool]]:
+        """
+        永続キューから取り出した Gem 実行（戻り値: 結果, 途中経過のメッセージで返答まで済ませたか）。
+        GEMINI_ASYNC=on の AI Gem は生成を待たずに Future を返す（返答は生成が終わってからプールで行う）
+        """
+        p = job.payload
+        channel_id = p.get("channel_id")
+        response_url = p.get("response_url")
+        store, store_err = _get_store()
+        if store is None:
+            message = (
+                "Gem の保存先（Firestore）の初期化に失敗したため、実行できません。\n"
+                f"原因: `{store_err or 'unknown'}`"
+            )
+            return {"ok": False, "message": message, "public": False}, False
+        client = slack_app.client
+        # placeholder: スラッシュコマンドの ack 直後に「実行中…」の ephemeral を投稿済み（結果で置き換える / 公開なら消す）
+        placeholder = bool(p.get("placeholder")) and bool(response_url)
+        progress = None
+        if p.get("public") and channel_id:
+            progress = ChannelMessageProgress(client, channel_id)
+        elif response_url:
+            progress = ResponseUrlProgress(Respond(response_url=response_url), posted=placeholder)
+        metrics_store, _ = _get_metrics()
+        started = start_gem_command(
+            store=store,
+            team_id=p.get("team_id") or "unknown",
+            user_id=p.get("user_id"),
+            text=p.get("text") or "",
+            gemini=gemini,
+            slack_client=client,
+            channel_id=channel_id,
+            metrics_store=metrics_store,
+            progress=progress,
+        )
+
+        def _settle(f: Future) -> tuple[dict, bool]:
+            try:
+                result = f.result()
+            except Exception:
+                if progress is not None:
+                    progress.abort()
+                raise
+            delivered = progress is not None and progress.finish(result)
+            if delivered and placeholder and isinstance(progress, ChannelMessageProgress):
+                try:
+                    Respond(response_url=response_url)(delete_original=True)
+                except Exception as e:
+                    print(f"[gem] placeholder delete failed: {type(e).__name__} {e}")
+            return {"ok": result.ok, "message": result.message, "public": result.public}, delivered
+
+        if started.done():
+            return _settle(started)
+        return background.when_done(f"gem-job-result:{job.id}", started, _settle)
+
+    def _deliver_job(job: GemJob, result: dict) -> None:
+        """結果を返す。スラッシュコマンドは保存した response_url（30 分有効）、使えなければチャンネルへ"""
+        p = job.payload
+        channel_id = p.get("channel_id")
+        user_id = p.get("user_id")
+        response_url = p.get("response_url")
+        text = str(result.get("message") or "")
+        public = bool(result.get("public"))
+        if response_url:
+            respond = Respond(response_url=response_url)
+            placeholder = bool(p.get("placeholder"))
+            if public and placeholder:
+                # ephemeral のプレースホルダは消してから、結果をチャンネルへ別に投稿する（1 回の呼び出しでは両方できない）
+                try:
+                    respond(delete_original=True)
+                except Exception as e:
+                    print(f"[gem] job {job.id} placeholder delete failed: {type(e).__name__} {e}")
+            if public:
+                kwargs = {"response_type": "in_channel"}
+            else:
+                kwargs = {"replace_original": placeholder or None}
+            try:
+                resp = respond(text=text, **kwargs)
+                if resp.status_code == 200:
+                    return
+                print(f"[gem] job {job.id} response_url failed: {resp.status_code} {resp.body}")
+            except Exception as e:
+                print(f"[gem] job {job.id} response_url failed: {type(e).__name__} {e}")
+        if not channel_id or not user_id:
+            return
+        if public:
+            slack_app.client.chat_postMessage(channel=channel_id, text=text)
+        else:
+            slack_app.client.chat_postEphemeral(channel=channel_id, user=user_id, text=text)
+
+    # Gem の実行は永続キューを通す（実行中にインスタンスが落ちても、別のインスタンスが取り直して返答する）。
+    # キューが無効 / 初期化できないときは従来どおりこのプロセス内で実行する
+    jobs = shared_job_queue()
+    job_worker = start_job_worker(queue=jobs, executor=background, run=_run_job, deliver=_deliver_job) if jobs else None
+
+    def _enqueue_run(payload: dict) -> bool:
+        if job_worker is None:
+            return False
+        try:
+            job_worker.submit(payload)
+            return True
+        except Exception as e:
+            print(f"[gem] job enqueue failed; running in-process: {type(e).__name__} {e}")
+            return False
+
     @slack_app.command("/gem")
     def gem_command(ack, respond, command, client):  # noqa: ANN001
         ack()
@@ -319,6 +446,52 @@ def register(slack_app) -> None:  # noqa: ANN001
                                     "options": output_options,
                                 },
                             },
+                            {
+                                "type": "input",
+                                "block_id": "model",
+                                "optional": True,
+                                "label": {"type": "plain_text", "text": "（任意）モデル"},
+                                "hint": {"type": "plain_text", "text": "空欄なら既定のモデル。画像Gemでは画像モデル"},
+                                "element": {
+                                    "type": "plain_text_input",
+                                    "action_id": "value",
+                                    "placeholder": {"type": "plain_text", "text": "例: gemini-2.5-flash-lite"},
+                                },
+                            },
+                            {
+                                "type": "input",
+                                "block_id": "thinking_budget",
+                                "optional": True,
+                                "label": {"type": "plain_text", "text": "（任意）thinking budget"},
+                                "hint": {"type": "plain_text", "text": "0 で無効（速い）、-1 で動的、空欄なら既定"},
+                                "element": {"type": "plain_text_input", "action_id": "value"},
+                            },
+                            {
+                                "type": "input",
+                                "block_id": "temperature",
+                                "optional": True,
+                                "label": {"type": "plain_text", "text": "（任意）temperature"},
+                                "element": {
+                                    "type": "plain_text_input",
+                                    "action_id": "value",
+                                    "placeholder": {"type": "plain_text", "text": "0〜2（例: 0.7）"},
+                                },
+                            },
+                            {
+                                "type": "input",
+                                "block_id": "max_output_tokens",
+                                "optional": True,
+                                "label": {"type": "plain_text", "text": "（任意）最大出力トークン数"},
+                                "element": {"type": "plain_text_input", "action_id": "value"},
+                            },
+                            {
+                                "type": "input",
+                                "block_id": "latency_slo_ms",
+                                "optional": True,
+                                "label": {"type": "plain_text", "text": "（任意）目標応答時間（ms）"},
+                                "hint": {"type": "plain_text", "text": "既定のモデルが遅いときは軽いモデルに切り替えます"},
+                                "element": {"type": "plain_text_input", "action_id": "value"},
+                            },
                             {
                                 "type": "input",
                                 "block_id": "body",
@@ -364,30 +537,144 @@ def register(slack_app) -> None:  # noqa: ANN001
                 respond(f"モーダル起動に失敗しました: `{type(e).__name__}`")
             return
 
-        try:
-            metrics_store, _ = _get_metrics()
-            result = handle_gem_command(
-                store=store,
-                team_id=team_id,
-                user_id=user_id,
-                text=text,
-                gemini=gemini,
-                slack_client=client,
-                channel_id=command.get("channel_id"),
-                metrics_store=metrics_store,
-            )
-        except Exception as e:
-            print(f"[gem] command error: {type(e).__name__} {e}")
-            respond(f"処理中にエラーが発生しました: `{type(e).__name__}`")
+        def _run_in_process() -> None:
+            # AI Gem は生成途中から表示する（公開: チャンネル投稿を chat.update / 非公開: response_url を置き換え）
+            if public_flag and channel_id:
+                progress = ChannelMessageProgress(client, channel_id)
+            else:
+                progress = ResponseUrlProgress(respond)
+            try:
+                metrics_store, _ = _get_metrics()
+                result = handle_gem_command(
+                    store=store,
+                    team_id=team_id,
+                    user_id=user_id,
+                    text=text,
+                    gemini=gemini,
+                    slack_client=client,
+                    channel_id=channel_id,
+                    metrics_store=metrics_store,
+                    progress=progress,
+                )
+            except Exception as e:
+                print(f"[gem] command error: {type(e).__name__} {e}")
+                progress.abort()
+                respond(f"処理中にエラーが発生しました: `{type(e).__name__}`")
+                return
+
+            if progress.finish(result):
+                return
+            if result.public:
+                respond(result.message, response_type="in_channel")
+            else:
+                respond(result.message)
+
+        gem_name = run_command_gem_name(text)
+        if gem_name is None:
+            # 管理系（create / list / show / delete）はストアの読み書きだけなのでこのまま返す。
+            # バッチは長いのでワーカープールで実行する（件数分やり直すと高くつくので永続キューには入れない）
+            if tokens2 and tokens2[0].lower() == "batch":
+                try:
+                    background.submit(f"gem-batch:{team_id}", _run_in_process)
+                except BackgroundQueueFullError as e:
+                    print(f"[gem] command rejected: {e}")
+                    respond("ただいま混み合っているため受け付けられませんでした。少し待ってからもう一度お試しください。")
+                return
+            _run_in_process()
             return
 
-        if result.public:
-            respond(result.message, response_type="in_channel")
-        else:
-            respond(result.message)
+        # Gem の実行は ack 直後にワーカープールへ渡し、このスレッドはすぐ返す（生成が長くてもリスナーのスレッドを占有しない）。
+        # 「実行中…」の ephemeral はここで先に出し、結果で置き換える（公開実行なら消して結果をチャンネルへ）
+        payload = {
+            "source": "command",
+            "team_id": team_id,
+            "user_id": user_id,
+            "channel_id": channel_id,
+            "text": text,
+            "public": public_flag,
+            "response_url": command.get("response_url"),
+            "placeholder": False,
+        }
+
+        if payload["response_url"]:
+            # プールの空き待ちや混雑に関係なく、ack の直後に出す（結果がプレースホルダより先に届くこともない）
+            note = "（結果はチャンネルに投稿します）" if public_flag and channel_id else ""
+            try:
+                resp = respond(f"⏳ Gem `{gem_name}` を実行中…{note}")
+                payload["placeholder"] = getattr(resp, "status_code", 200) == 200
+            except Exception as e:
+                print(f"[gem] placeholder respond failed: {type(e).__name__} {e}")
+
+        def _dispatch() -> None:
+            if _enqueue_run(payload):
+                return
+            job = GemJob(id=new_job_id(), payload=payload)
+
+            def _reply(f: Future) -> None:
+                try:
+                    result, delivered = f.result()
+                except Exception as e:
+                    print(f"[gem] command error: {type(e).__name__} {e}")
+                    result, delivered = {"ok": False, "message": f"処理中にエラーが発生しました: `{type(e).__name__}`", "public": False}, False
+                if not delivered:
+                    _deliver_job(job, result)
+
+            try:
+                out = _run_job(job)
+            except Exception as e:
+                out = Future()
+                out.set_exception(e)
+            if not isinstance(out, Future):
+                done: Future = Future()
+                done.set_result(out)
+                _reply(done)
+            elif out.done():
+                _reply(out)
+            else:
+                # GEMINI_ASYNC: 生成の間このスレッドは塞がず、終わったら返答だけプールで行う
+                background.when_done(f"gem-command-result:{gem_name}", out, _reply)
+
+        try:
+            background.submit(f"gem-command:{gem_name}", _dispatch)
+        except BackgroundQueueFullError as e:
+            print(f"[gem] command rejected: {e}")
+            respond(
+                "ただいま混み合っているため受け付けられませんでした。少し待ってからもう一度お試しください。",
+                replace_original=payload["placeholder"] or None,
+            )
 
     @slack_app.view("gem_create_modal")
     def gem_create_modal(ack, body, view, client):  # noqa: ANN001
+        state = (view.get("state") or {}).get("values") or {}
+
+        def _val(block_id: str) -> str:
+            b = state.get(block_id) or {}
+            a = b.get("value") or {}
+            # plain_text_input: {"type":"plain_text_input","value":"..."}
+            if isinstance(a, dict) and "value" in a:
+                return (a.get("value") or "").strip()
+            # static_select: {"type":"static_select","selected_option":{"value":"..."}}
+            selected = (a or {}).get("selected_option") or {}
+            return (selected.get("value") or "").strip()
+
+        # 生成設定の入力ミスはモーダル上で返す（I/O は無いので ack 前でも速い）
+        gen_errors: dict[str, str] = {}
+        for block_id in ("model", "thinking_budget", "temperature", "max_output_tokens", "latency_slo_ms"):
+            try:
+                parse_generation_config(**{block_id: _val(block_id)})
+            except ValueError as e:
+                gen_errors[block_id] = str(e)
+        if gen_errors:
+            ack(response_action="errors", errors=gen_errors)
+            return
+        generation = parse_generation_config(
+            model=_val("model"),
+            thinking_budget=_val("thinking_budget"),
+            temperature=_val("temperature"),
+            max_output_tokens=_val("max_output_tokens"),
+            latency_slo_ms=_val("latency_slo_ms"),
+        )
+
         # View submission は 3 秒以内に ack が必須。
         # Cloud Run の cold start / Firestore 遅延があってもタイムアウトしないよう、先に modal を閉じる。
         ack(response_action="clear")
@@ -403,18 +690,6 @@ def register(slack_app) -> None:  # noqa: ANN001
         user_id = meta.get("user_id")
         channel_id = meta.get("channel_id")
 
-        state = (view.get("state") or {}).get("values") or {}
-
-        def _val(block_id: str) -> str:
-            b = state.get(block_id) or {}
-            a = b.get("value") or {}
-            # plain_text_input: {"type":"plain_text_input","value":"..."}
-            if isinstance(a, dict) and "value" in a:
-                return (a.get("value") or "").strip()
-            # static_select: {"type":"static_select","selected_option":{"value":"..."}}
-            selected = (a or {}).get("selected_option") or {}
-            return (selected.get("value") or "").strip()
-
         summary = _val("summary")
         system_prompt = _val("system")
         input_format = _val("input_format")
@@ -444,6 +719,7 @@ def register(slack_app) -> None:  # noqa: ANN001
                     system_prompt=system_prompt,
                     input_format=input_format,
                     output_format=output_format,
+                    generation=generation,
                     created_by=user_id,
                 )
 
@@ -466,7 +742,9 @@ def register(slack_app) -> None:  # noqa: ANN001
                     except Exception:
                         pass
 
-        threading.Thread(target=_save_and_notify, daemon=True).start()
+        _submit_background(
+            f"gem-save:{name}", _save_and_notify, client=client, channel_id=channel_id, user_id=user_id
+        )
 
     @slack_app.view("gem_run_modal")
     def gem_run_modal(ack, body, view, client):  # noqa: ANN001
@@ -503,8 +781,24 @@ def register(slack_app) -> None:  # noqa: ANN001
 
         user_input = _plain("input")
         public = _checked_public() or meta_public
+        # 改行を保持するため、本文は newline で渡す（service 側で raw から復元）
+        cmd_text = f"run {name} " + ("--public\n" if public else "\n") + (user_input or "")
+
+        if _enqueue_run(
+            {
+                "source": "modal",
+                "team_id": team_id,
+                "user_id": user_id,
+                "channel_id": channel_id,
+                "text": cmd_text,
+                "public": public,
+                "response_url": None,
+            }
+        ):
+            return
 
         def _run_and_notify() -> None:
+            progress: ChannelMessageProgress | None = None
             try:
                 store, store_err = _get_store()
                 if store is None:
@@ -519,9 +813,11 @@ def register(slack_app) -> None:  # noqa: ANN001
                         )
                     return
 
-                # 改行を保持するため、本文は newline で渡す（service 側で raw から復元）
-                cmd_text = f"run {name} " + ("--public\n" if public else "\n") + (user_input or "")
-                result = handle_gem_command(
+                metrics_store, _ = _get_metrics()
+                # ephemeral は後から更新できないため、途中経過を流すのは公開実行のみ
+                if public and channel_id:
+                    progress = ChannelMessageProgress(client, channel_id)
+                started = start_gem_command(
                     store=store,
                     team_id=team_id,
                     user_id=user_id,
@@ -530,8 +826,24 @@ def register(slack_app) -> None:  # noqa: ANN001
                     slack_client=client,
                     channel_id=channel_id,
                     metrics_store=metrics_store,
+                    progress=progress,
+                )
+            except Exception as e:
+                _notify_failed(e, progress)
+                return
+            if started.done():
+                _notify(started, progress)
+            else:
+                # GEMINI_ASYNC: 生成の間このスレッドは塞がず、終わったら返答だけプールで行う
+                background.when_done(
+                    f"gem-run-result:{name}", started, lambda f: _notify(f, progress), on_timeout=_notify_slow
                 )
 
+        def _notify(f: Future, progress: ChannelMessageProgress | None) -> None:
+            try:
+                result = f.result()
+                if progress is not None and progress.finish(result):
+                    return
                 if not channel_id or not user_id:
                     return
                 if result.public:
@@ -539,15 +851,35 @@ def register(slack_app) -> None:  # noqa: ANN001
                 else:
                     client.chat_postEphemeral(channel=channel_id, user=user_id, text=result.message)
             except Exception as e:
-                print(f"[gem] run modal execution failed: {type(e).__name__} {e}")
-                if channel_id and user_id:
-                    try:
-                        client.chat_postEphemeral(
-                            channel=channel_id,
-                            user=user_id,
-                            text=f"Gem `{name}` の実行に失敗しました: `{type(e).__name__}`",
-                        )
-                    except Exception:
-                        pass
+                _notify_failed(e, progress)
+
+        def _notify_failed(e: Exception, progress: ChannelMessageProgress | None) -> None:
+            print(f"[gem] run modal execution failed: {type(e).__name__} {e}")
+            if progress is not None:
+                progress.abort()
+            if channel_id and user_id:
+                try:
+                    client.chat_postEphemeral(
+                        channel=channel_id,
+                        user=user_id,
+                        text=f"Gem `{name}` の実行に失敗しました: `{type(e).__name__}`",
+                    )
+                except Exception:
+                    pass
+
+        def _notify_slow() -> None:
+            if channel_id and user_id:
+                client.chat_postEphemeral(
+                    channel=channel_id,
+                    user=user_id,
+                    text=f"Gem `{name}` の実行に時間がかかっています。終わり次第結果を送ります。",
+                )
 
-        threading.Thread(target=_run_and_notify, daemon=True).start()
+        _submit_background(
+            f"gem-run:{name}",
+            _run_and_notify,
+            client=client,
+            channel_id=channel_id,
+            user_id=user_id,
+            on_timeout=_notify_slow,
+        )
@@ -0,0 +1,283 @@
+from __future__ import annotations
+
+import atexit
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Callable, Union
+
+from ..ai.aio import async_enabled
+from ..ai.resilience import is_transient_error
+from ..config import env_int
+from ..gems.jobs import GemJob, JobQueue
+from .background import BackgroundExecutor, BackgroundQueueFullError
+
+# run(job) -> (結果, 返答まで済ませたか)。生成を待たずに返すときはその Future / deliver(job, 結果)
+JobRunner = Callable[[GemJob], "Union[tuple[dict, bool], Future[tuple[dict, bool]]]"]
+JobDeliverer = Callable[[GemJob, dict], None]
+
+
+class GemJobWorker:
+    """
+    永続キュー（JobQueue）から Gem 実行を取り出し、共有のワーカープール（BackgroundExecutor）で実行する。
+
+    - 空きがある分だけ lease し、実行中は lease_seconds / 3 ごとに期限を延ばす
+    - 実行が終わったら結果を保存（complete）→ 返答（deliver）→ 完了（finish）。返答前に落ちても次は返答だけ行う
+    - run が Future を返したら（GEMINI_ASYNC）プールのスレッドはすぐ返し、完了後の保存・返答だけをプールで行う
+    - 一時的な失敗（通信エラー・429/5xx など）は指数バックオフで max_attempts 回まで再試行。それ以外の例外
+      （400 などやり直しても同じになるもの）は再試行せずにすぐ失敗にする。諦めたら本人に失敗を知らせる
+    - インスタンスが落ちて延長が止まったジョブは、期限が切れたら別のインスタンス（または再起動後のこのプロセス）が拾う
+    - 停止時は新しく lease せず、プールで待っている分は返す（release）。実行中の分はプールの drain に任せる
+    """
+
+    def __init__(
+        self,
+        *,
+        queue: JobQueue,
+        executor: BackgroundExecutor,
+        run: JobRunner,
+        deliver: JobDeliverer,
+        concurrency: int = 4,
+        lease_seconds: float = 60.0,
+        poll_seconds: float = 2.0,
+        max_attempts: int = 3,
+    ) -> None:
+        self.queue = queue
+        self.executor = executor
+        self._run_job = run
+        self._deliver = deliver
+        self.concurrency = max(1, int(concurrency))
+        self.lease_seconds = max(5.0, float(lease_seconds))
+        self.poll_seconds = max(0.1, float(poll_seconds))
+        self.max_attempts = max(1, int(max_attempts))
+        host = os.environ.get("K_REVISION") or socket.gethostname()
+        self.owner = f"{host}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._inflight: dict[str, GemJob] = {}
+        self._thread: threading.Thread | None = None
+        self.leased = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.released = 0
+        self.lost_leases = 0
+        self.redelivered = 0
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="gem-job-worker", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def submit(self, payload: dict) -> GemJob:
+        """ジョブを永続キューに入れ、すぐに取りに行く"""
+        job = self.queue.enqueue(payload)
+        self._wake.set()
+        return job
+
+    def _loop(self) -> None:
+        last_extend = 0.0
+        while not self._stop.is_set():
+            self._wake.clear()
+            now = time.monotonic()
+            if now - last_extend >= self.lease_seconds / 3:
+                last_extend = now
+                self._extend_leases()
+            try:
+                self._lease_more()
+            except Exception as e:
+                print(f"[jobs] lease failed: {type(e).__name__} {e}")
+            self._wake.wait(self.poll_seconds)
+
+    def _extend_leases(self) -> None:
+        with self._lock:
+            ids = list(self._inflight)
+        for job_id in ids:
+            try:
+                if not self.queue.extend(job_id, self.owner, lease_seconds=self.lease_seconds):
+                    with self._lock:
+                        self.lost_leases += 1
+                    print(f"[jobs] lease lost: {job_id}")
+            except Exception as e:
+                print(f"[jobs] lease extend failed: {job_id} {type(e).__name__} {e}")
+
+    def _lease_more(self) -> None:
+        with self._lock:
+            free = self.concurrency - len(self._inflight)
+        if free <= 0:
+            return
+        jobs = self.queue.lease(self.owner, lease_seconds=self.lease_seconds, limit=free)
+        for i, job in enumerate(jobs):
+            with self._lock:
+                self._inflight[job.id] = job
+                self.leased += 1
+            try:
+                future = self.executor.submit(f"gem-job:{job.id}", self._execute, job)
+            except BackgroundQueueFullError:
+                # プールが一杯: まだ渡していない分もまとめて返す（持ったままだと延長されずに期限切れになり、
+                # 実行していないのに試行回数だけ増えていく）
+                for rest in jobs[i:]:
+                    self._release(rest)
+                return
+            future.add_done_callback(lambda f, job=job: f.cancelled() and self._release(job))
+
+    def _release(self, job: GemJob) -> None:
+        with self._lock:
+            self._inflight.pop(job.id, None)
+            self.released += 1
+        try:
+            self.queue.release(job.id, self.owner)
+        except Exception as e:
+            print(f"[jobs] release failed: {job.id} {type(e).__name__} {e}")
+
+    def _execute(self, job: GemJob) -> None:
+        pending = False
+        try:
+            if job.attempts > self.max_attempts:
+                # 実行中（または返答中）のインスタンスが落ち続けた（延長が止まって期限切れのまま回ってきた）
+                if job.result is None:
+                    self._give_up(job, "lease expired")
+                else:
+                    self.queue.fail(job.id, self.owner, "delivery did not finish", retry_in=None)
+                    self._count("failed")
+                return
+            if job.result is not None:
+                # 前回は実行まで終わって返答前に落ちた: 実行し直さずに返答だけ行う
+                self._count("redelivered")
+                self._deliver(job, job.result)
+                self.queue.finish(job.id, self.owner)
+                self._count("completed")
+                return
+            try:
+                out = self._run_job(job)
+            except Exception as e:
+                self._run_failed(job, e)
+                return
+            if isinstance(out, Future):
+                # 生成は共有イベントループで進む: このスレッドは返し、終わったら続き（保存・返答）をプールで行う。
+                # 終わるまでは実行中（inflight）として数え、リースの延長も続ける
+                self.executor.when_done(f"gem-job-done:{job.id}", out, lambda f: self._after_run(job, f))
+                pending = True
+                return
+            self._complete(job, *out)
+        finally:
+            if not pending:
+                self._done(job)
+
+    def _after_run(self, job: GemJob, future: Future) -> None:
+        try:
+            try:
+                result, delivered = future.result()
+            except Exception as e:
+                self._run_failed(job, e)
+                return
+            self._complete(job, result, delivered)
+        finally:
+            self._done(job)
+
+    def _run_failed(self, job: GemJob, e: Exception) -> None:
+        error = f"{type(e).__name__}: {str(e) or type(e).__name__}"
+        transient = is_transient_error(e)
+        print(f"[jobs] job {job.id} failed (attempt {job.attempts}, transient={transient}): {error}")
+        if transient and job.attempts < self.max_attempts:
+            self.queue.fail(job.id, self.owner, error, retry_in=min(60.0, 5.0 * 2 ** (job.attempts - 1)))
+            self._count("retried")
+        elif transient:
+            self._give_up(job, error)
+        else:
+            # やり直しても同じ結果になる（Gemini の 400 など）: 課金される呼び出しを繰り返さずにすぐ知らせる
+            self._give_up(job, error, message=f"処理中にエラーが発生しました: `{type(e).__name__}`")
+
+    def _complete(self, job: GemJob, result: dict, delivered: bool) -> None:
+        if not self.queue.complete(job.id, self.owner, result):
+            # 期限切れで別のワーカーに取られた（そちらが返答する）
+            with self._lock:
+                self.lost_leases += 1
+            return
+        if not delivered:
+            self._deliver(job, result)
+        self.queue.finish(job.id, self.owner)
+        self._count("completed")
+
+    def _done(self, job: GemJob) -> None:
+        with self._lock:
+            self._inflight.pop(job.id, None)
+        self._wake.set()
+
+    def _give_up(
+        self, job: GemJob, error: str, *, message: str = "Gem の実行に失敗しました（再試行しても完了しませんでした）。"
+    ) -> None:
+        self.queue.fail(job.id, self.owner, error, retry_in=None)
+        self._count("failed")
+        try:
+            self._deliver(job, {"ok": False, "message": message, "public": False})
+        except Exception as e:
+            print(f"[jobs] failure notice failed: {job.id} {type(e).__name__} {e}")
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = {
+                "owner": self.owner,
+                "concurrency": self.concurrency,
+                "inflight": len(self._inflight),
+                "lease_seconds": self.lease_seconds,
+                "max_attempts": self.max_attempts,
+                "leased": self.leased,
+                "completed": self.completed,
+                "retried": self.retried,
+                "failed": self.failed,
+                "released": self.released,
+                "lost_leases": self.lost_leases,
+                "redelivered": self.redelivered,
+            }
+        try:
+            out["queue"] = self.queue.stats()
+        except Exception as e:
+            out["queue"] = {"error": f"{type(e).__name__}: {e}"}
+        return out
+
+
+_worker: GemJobWorker | None = None
+
+
+def start_job_worker(*, queue: JobQueue, executor: BackgroundExecutor, run: JobRunner, deliver: JobDeliverer) -> GemJobWorker:
+    """
+    プロセスに 1 つのワーカーを起動する（Slack の登録時に呼ぶ）。
+    - `GEM_JOB_CONCURRENCY`: 同時に実行するジョブ数（既定はプールのワーカー数。GEMINI_ASYNC=on では生成中に
+      スレッドを使わないので、その 16 倍。実際の同時呼び出し数は Gemini のレート制限で絞る）
+    - `GEM_JOB_LEASE_SECONDS`: リースの期限（既定 60。インスタンスが落ちてから再試行されるまでの時間）
+    - `GEM_JOB_POLL_SECONDS`: ほかのインスタンスが入れたジョブを見に行く間隔（既定 2）
+    - `GEM_JOB_MAX_ATTEMPTS`: 実行の試行回数（既定 3）
+    """
+    global _worker
+    if _worker is None:
+        _worker = GemJobWorker(
+            queue=queue,
+            executor=executor,
+            run=run,
+            deliver=deliver,
+            concurrency=env_int("GEM_JOB_CONCURRENCY", executor.workers * (16 if async_enabled() else 1)),
+            lease_seconds=env_int("GEM_JOB_LEASE_SECONDS", 60),
+            poll_seconds=env_int("GEM_JOB_POLL_SECONDS", 2),
+            max_attempts=env_int("GEM_JOB_MAX_ATTEMPTS", 3),
+        )
+        _worker.start()
+    return _worker
+
+
+def current_job_worker() -> GemJobWorker | None:
+    return _worker
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import time
+
+from ..gems.progress import RunProgress
+from ..gems.service import GemCommandResult
+
+# chat.update は Tier 3（1 メッセージあたり毎秒 1 回程度まで）なので、それより細かくは更新しない
+_CHANNEL_UPDATE_INTERVAL = 1.0
+# response_url は 30 分で 5 回までしか使えない（プレースホルダ 1 + 途中 2 + 最終 2。公開結果は削除と投稿で 2 回使う）
+_RESPONSE_URL_MAX_PARTIALS = 2
+_RESPONSE_URL_UPDATE_INTERVAL = 3.0
+
+_TYPING_SUFFIX = "\n\n_…生成中_"
+
+
+class ChannelMessageProgress(RunProgress):
+    """
+    公開実行（--public）用: チャンネルにプレースホルダを投稿し、生成途中の全文で chat.update し続ける。
+    finish で最終結果に置き換える。失敗時はプレースホルダを消して呼び出し元の通常経路に任せる。
+    """
+
+    def __init__(self, client, channel_id: str, *, min_interval: float = _CHANNEL_UPDATE_INTERVAL) -> None:  # noqa: ANN001
+        self._client = client
+        self._channel_id = channel_id
+        self._min_interval = min_interval
+        self._ts: str | None = None
+        self._last_update = 0.0
+        self._disabled = False
+
+    def started(self, *, gem_name: str) -> None:
+        try:
+            resp = self._client.chat_postMessage(channel=self._channel_id, text=f"⏳ Gem `{gem_name}` を実行中…")
+            self._ts = resp.get("ts")
+        except Exception as e:
+            # not_in_channel 等。ストリーミングせずに最後にまとめて返す
+            print(f"[gem] placeholder post failed: {type(e).__name__} {e}")
+            self._disabled = True
+
+    def partial(self, text: str) -> None:
+        if self._disabled or not self._ts or not text:
+            return
+        now = time.monotonic()
+        if now - self._last_update < self._min_interval:
+            return
+        self._last_update = now
+        try:
+            self._client.chat_update(channel=self._channel_id, ts=self._ts, text=text + _TYPING_SUFFIX)
+        except Exception as e:
+            print(f"[gem] progress chat.update failed: {type(e).__name__} {e}")
+            self._disabled = True
+
+    def finish(self, result: GemCommandResult) -> bool:
+        """最終結果をプレースホルダに反映できたら True（呼び出し元は改めて投稿しない）"""
+        if not self._ts:
+            return False
+        try:
+            if result.ok and result.public:
+                self._client.chat_update(channel=self._channel_id, ts=self._ts, text=result.message)
+                return True
+            # 失敗はチャンネルに残さない（呼び出し元が本人にだけ返す）
+            self._client.chat_delete(channel=self._channel_id, ts=self._ts)
+        except Exception as e:
+            print(f"[gem] progress finish failed: {type(e).__name__} {e}")
+        return False
+
+    def abort(self) -> None:
+        if not self._ts:
+            return
+        try:
+            self._client.chat_delete(channel=self._channel_id, ts=self._ts)
+        except Exception as e:
+            print(f"[gem] placeholder delete failed: {type(e).__name__} {e}")
+
+
+class ResponseUrlProgress(RunProgress):
+    """
+    非公開のスラッシュコマンド用: response_url（ephemeral）を replace_original で置き換えていく。
+    response_url は使用回数に上限があるため、途中経過は数回に間引く。
+    posted=True なら、プレースホルダは投稿済み（ack 直後に出したもの）として started では投稿しない。
+    """
+
+    def __init__(
+        self,
+        respond,  # noqa: ANN001
+        *,
+        max_partials: int = _RESPONSE_URL_MAX_PARTIALS,
+        min_interval: float = _RESPONSE_URL_UPDATE_INTERVAL,
+        posted: bool = False,
+    ) -> None:
+        self._respond = respond
+        self._max_partials = max_partials
+        self._min_interval = min_interval
+        self._posted = posted
+        self._partials = 0
+        self._last_update = time.monotonic() if posted else 0.0
+
+    def started(self, *, gem_name: str) -> None:
+        if self._posted:
+            return
+        try:
+            self._respond(f"⏳ Gem `{gem_name}` を実行中…")
+            self._posted = True
+            self._last_update = time.monotonic()
+        except Exception as e:
+            print(f"[gem] placeholder respond failed: {type(e).__name__} {e}")
+
+    def partial(self, text: str) -> None:
+        if not self._posted or not text or self._partials >= self._max_partials:
+            return
+        now = time.monotonic()
+        if now - self._last_update < self._min_interval:
+            return
+        self._last_update = now
+        self._partials += 1
+        try:
+            self._respond(text=text + _TYPING_SUFFIX, replace_original=True)
+        except Exception as e:
+            print(f"[gem] progress respond failed: {type(e).__name__} {e}")
+            self._partials = self._max_partials
+
+    def finish(self, result: GemCommandResult) -> bool:
+        if not self._posted:
+            return False
+        try:
+            if result.public:
+                # 公開結果は ephemeral の置き換えではなくチャンネルに出す。delete_original と一緒に送った text は
+                # 無視されるので、プレースホルダを消してから別の呼び出しで投稿する
+                try:
+                    self._respond(delete_original=True)
+                except Exception as e:
+                    print(f"[gem] placeholder delete failed: {type(e).__name__} {e}")
+                self._respond(text=result.message, response_type="in_channel")
+            else:
+                self._respond(text=result.message, replace_original=True)
+            return True
+        except Exception as e:
+            print(f"[gem] progress finish failed: {type(e).__name__} {e}")
+            return False
+
+    def abort(self) -> None:
+        if not self._posted:
+            return
+        try:
+            self._respond(delete_original=True)
+        except Exception as e:
+            print(f"[gem] placeholder delete failed: {type(e).__name__} {e}")
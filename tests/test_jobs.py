@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import time
+from concurrent.futures import Future
+
+import pytest
+import requests
+
+from gemsrack.gems.jobs import SqliteJobQueue
+from gemsrack.slack.background import BackgroundQueueFullError
+from gemsrack.slack.jobs import GemJobWorker
+
+
+@pytest.fixture
+def queue() -> SqliteJobQueue:
+    q = SqliteJobQueue(":memory:")
+    yield q
+    q.close()
+
+
+def _http_error(status: int) -> requests.HTTPError:
+    r = requests.Response()
+    r.status_code = status
+    return requests.HTTPError(f"{status} error", response=r)
+
+
+# ---- SqliteJobQueue ----
+
+
+def test_lease_hides_job_until_expiry(queue: SqliteJobQueue) -> None:
+    job = queue.enqueue({"text": "hello"})
+    [leased] = queue.lease("a", lease_seconds=30)
+    assert leased.id == job.id
+    assert leased.attempts == 1
+    assert queue.lease("b", lease_seconds=30) == []
+
+    # 延長が止まって期限が切れたら、別のワーカーが取り直せる（試行回数が増える）
+    assert queue.extend(job.id, "a", lease_seconds=-1)
+    [again] = queue.lease("b", lease_seconds=30)
+    assert again.lease_owner == "b"
+    assert again.attempts == 2
+    # 取り直された後の元の持ち主からの書き込みは無視される
+    assert not queue.extend(job.id, "a", lease_seconds=30)
+    assert not queue.complete(job.id, "a", {"ok": True})
+    assert not queue.finish(job.id, "a")
+
+
+def test_release_does_not_count_as_attempt(queue: SqliteJobQueue) -> None:
+    job = queue.enqueue({"text": "hello"})
+    queue.lease("a", lease_seconds=30)
+    assert queue.release(job.id, "a")
+    [leased] = queue.lease("a", lease_seconds=30)
+    assert leased.attempts == 1
+
+
+def test_complete_then_finish_drops_response_url(queue: SqliteJobQueue) -> None:
+    job = queue.enqueue({"text": "hello", "response_url": "https://hooks.slack.test/x"})
+    queue.lease("a", lease_seconds=30)
+    assert queue.complete(job.id, "a", {"ok": True, "message": "hi", "public": False})
+    saved = queue.get(job.id)
+    assert saved.status == "leased" and saved.result == {"ok": True, "message": "hi", "public": False}
+    assert queue.finish(job.id, "a")
+    done = queue.get(job.id)
+    assert done.status == "done"
+    assert "response_url" not in done.payload
+
+
+def test_fail_with_retry_keeps_payload_and_requeues(queue: SqliteJobQueue) -> None:
+    job = queue.enqueue({"text": "hello", "response_url": "https://hooks.slack.test/x"})
+    queue.lease("a", lease_seconds=30)
+    assert queue.fail(job.id, "a", "boom", retry_in=0)
+    retried = queue.get(job.id)
+    assert retried.status == "queued" and retried.error == "boom"
+    assert retried.payload["response_url"]
+
+    queue.lease("a", lease_seconds=30)
+    assert queue.fail(job.id, "a", "boom", retry_in=None)
+    failed = queue.get(job.id)
+    assert failed.status == "failed"
+    assert "response_url" not in failed.payload
+
+
+# ---- GemJobWorker ----
+
+
+class _RecordingExecutor:
+    """submit を受け付けるだけで実行しない（accept 件を超えたら BackgroundQueueFullError）"""
+
+    workers = 4
+
+    def __init__(self, *, accept: int | None = None) -> None:
+        self.accept = accept
+        self.submitted: list[str] = []
+
+    def submit(self, name, fn, *args, **kwargs) -> Future:  # noqa: ANN001
+        if self.accept is not None and len(self.submitted) >= self.accept:
+            raise BackgroundQueueFullError("full")
+        self.submitted.append(name)
+        f: Future = Future()
+        f.set_result(None)
+        return f
+
+
+def _worker(queue: SqliteJobQueue, run, *, executor=None, max_attempts: int = 3):  # noqa: ANN001, ANN202
+    delivered: list[tuple[str, dict]] = []
+    worker = GemJobWorker(
+        queue=queue,
+        executor=executor or _RecordingExecutor(),
+        run=run,
+        deliver=lambda job, result: delivered.append((job.id, result)),
+        max_attempts=max_attempts,
+    )
+    return worker, delivered
+
+
+def _lease_one(worker: GemJobWorker, queue: SqliteJobQueue):  # noqa: ANN202
+    [job] = queue.lease(worker.owner, lease_seconds=worker.lease_seconds)
+    return job
+
+
+def test_worker_runs_saves_and_delivers(queue: SqliteJobQueue) -> None:
+    worker, delivered = _worker(queue, lambda job: ({"ok": True, "message": "hi", "public": False}, False))
+    job = queue.enqueue({"text": "hello"})
+    worker._execute(_lease_one(worker, queue))
+    assert delivered == [(job.id, {"ok": True, "message": "hi", "public": False})]
+    assert queue.get(job.id).status == "done"
+    assert worker.stats()["completed"] == 1
+
+
+def test_worker_redelivers_saved_result_without_running(queue: SqliteJobQueue) -> None:
+    def run(job):  # noqa: ANN001, ANN202
+        raise AssertionError("must not run again")
+
+    worker, delivered = _worker(queue, run)
+    job = queue.enqueue({"text": "hello"})
+    # 前のワーカーが結果を保存した後、返答前に落ちた
+    queue.lease("dead", lease_seconds=30)
+    queue.complete(job.id, "dead", {"ok": True, "message": "saved", "public": False})
+    queue.extend(job.id, "dead", lease_seconds=-1)
+
+    worker._execute(_lease_one(worker, queue))
+    assert delivered == [(job.id, {"ok": True, "message": "saved", "public": False})]
+    assert queue.get(job.id).status == "done"
+    assert worker.stats()["redelivered"] == 1
+
+
+def test_worker_retries_transient_errors(queue: SqliteJobQueue) -> None:
+    def run(job):  # noqa: ANN001, ANN202
+        raise _http_error(503)
+
+    worker, delivered = _worker(queue, run)
+    job = queue.enqueue({"text": "hello"})
+    worker._execute(_lease_one(worker, queue))
+    retried = queue.get(job.id)
+    assert retried.status == "queued"
+    assert retried.visible_at > time.time()
+    assert delivered == []
+    assert worker.stats()["retried"] == 1
+
+
+@pytest.mark.parametrize("error", [_http_error(400), ValueError("bad input")])
+def test_worker_fails_fast_on_non_transient_errors(queue: SqliteJobQueue, error: Exception) -> None:
+    calls = []
+
+    def run(job):  # noqa: ANN001, ANN202
+        calls.append(job.id)
+        raise error
+
+    worker, delivered = _worker(queue, run)
+    job = queue.enqueue({"text": "hello"})
+    worker._execute(_lease_one(worker, queue))
+    assert calls == [job.id]
+    assert queue.get(job.id).status == "failed"
+    assert len(delivered) == 1 and delivered[0][1]["ok"] is False
+    assert worker.stats()["retried"] == 0
+
+
+def test_worker_gives_up_after_lease_expiries(queue: SqliteJobQueue) -> None:
+    worker, delivered = _worker(queue, lambda job: ({"ok": True, "message": "hi"}, False), max_attempts=1)
+    job = queue.enqueue({"text": "hello"})
+    queue.lease("dead", lease_seconds=-1)  # 実行中に落ちて延長されなかった
+
+    worker._execute(_lease_one(worker, queue))
+    assert queue.get(job.id).status == "failed"
+    assert queue.get(job.id).error == "lease expired"
+    assert len(delivered) == 1 and delivered[0][1]["ok"] is False
+
+
+def test_worker_releases_every_unsubmitted_job_when_pool_is_full(queue: SqliteJobQueue) -> None:
+    executor = _RecordingExecutor(accept=1)
+    worker, _ = _worker(queue, lambda job: ({"ok": True}, False), executor=executor)
+    ids = [queue.enqueue({"text": str(i)}).id for i in range(3)]
+
+    worker._lease_more()
+    assert len(executor.submitted) == 1
+    # 渡せなかった分は持ったままにせず、試行回数も戻して返す
+    for job_id in ids:
+        job = queue.get(job_id)
+        if f"gem-job:{job_id}" in executor.submitted:
+            continue
+        assert job.status == "queued" and job.lease_owner is None
+        assert job.attempts == 0
+    assert worker.stats()["inflight"] == 1
+    assert worker.stats()["released"] == 2
+
+
+def test_worker_returns_thread_while_async_run_is_pending(queue: SqliteJobQueue) -> None:
+    from gemsrack.slack.background import BackgroundExecutor
+
+    started: Future = Future()
+    executor = BackgroundExecutor(workers=1, max_queue=4, task_timeout=0)
+    worker, delivered = _worker(queue, lambda job: started, executor=executor)
+    job = queue.enqueue({"text": "hello"})
+    try:
+        worker._lease_more()
+        deadline = time.monotonic() + 5
+        while executor.stats()["completed"] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # 生成中: プールのスレッドは返っているが、ジョブは実行中のまま（リースも持ち続ける）
+        assert executor.stats()["active"] == 0
+        assert worker.stats()["inflight"] == 1
+        assert queue.get(job.id).status == "leased"
+        assert delivered == []
+
+        started.set_result(({"ok": True, "message": "hi", "public": False}, False))
+        deadline = time.monotonic() + 5
+        while queue.get(job.id).status != "done" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert queue.get(job.id).status == "done"
+        assert delivered == [(job.id, {"ok": True, "message": "hi", "public": False})]
+        assert worker.stats()["inflight"] == 0
+    finally:
+        executor.shutdown(timeout=1)